@@ -0,0 +1,34 @@
+"""Helpers for benchmarks (*_bench.py).
+
+A benchmark prints one line per result, or a JSON object if --json is
+given, so that results can be compared between releases.
+"""
+
+import json
+import sys
+import time
+
+
+def measure(func, repeat=5):
+  """Returns the best wall time of func() in seconds."""
+  best = None
+  for _ in xrange(repeat):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def report(benchmark, results):
+  """Prints results, a list of (name, value, unit)."""
+  if '--json' in sys.argv[1:]:
+    json.dump({'benchmark': benchmark,
+               'results': [{'name': name, 'value': value, 'unit': unit}
+                           for name, value, unit in results]},
+              sys.stdout, sort_keys=True)
+    print
+  else:
+    for name, value, unit in results:
+      print '%s.%s: %.6g %s' % (benchmark, name, value, unit)
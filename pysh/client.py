@@ -0,0 +1,167 @@
+"""A client of pysh daemon (pysh/daemon.py).
+
+This module is imported by bin/pysh before any other pysh module, so it
+must stay small and must not import pysh.shell.
+
+Protocol over a Unix stream socket:
+  client -> daemon: stdin, stdout and stderr (SCM_RIGHTS, see fdpass.py)
+  client -> daemon: a message of marshal-encoded request (see run)
+  daemon -> client: the pid of the worker process
+  daemon -> client: the exit status of the script
+A message is a 4-byte length followed by the data. pid and exit status are
+4-byte integers.
+"""
+
+# _socket is used instead of socket, which imports _ssl and slows down the
+# start of the client.
+import _socket
+import errno
+import marshal
+import os
+import signal
+import struct
+
+from pysh.fdpass import send_fds
+
+INT_FORMAT = '!i'
+INT_SIZE = struct.calcsize(INT_FORMAT)
+# Signals which are forwarded to the process group of the worker while a
+# script is running.
+FORWARDED_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP,
+                     signal.SIGQUIT)
+
+
+def recv_exactly(sock, size):
+  """Returns size bytes from sock or None if the connection is closed."""
+  chunks = []
+  while size > 0:
+    try:
+      chunk = sock.recv(size)
+    except _socket.error, e:
+      if e.errno == errno.EINTR:
+        continue
+      raise
+    if not chunk:
+      return None
+    chunks.append(chunk)
+    size -= len(chunk)
+  return ''.join(chunks)
+
+
+def send_int(sock, value):
+  sock.sendall(struct.pack(INT_FORMAT, value))
+
+
+def recv_int(sock):
+  data = recv_exactly(sock, INT_SIZE)
+  if data is None:
+    return None
+  return struct.unpack(INT_FORMAT, data)[0]
+
+
+def send_message(sock, data):
+  send_int(sock, len(data))
+  sock.sendall(data)
+
+
+def recv_message(sock):
+  size = recv_int(sock)
+  if size is None or size < 0:
+    return None
+  return recv_exactly(sock, size)
+
+
+def set_foreground(fd, pgrp):
+  """Makes pgrp the foreground process group of the terminal fd.
+
+  Returns False if fd is not the controlling terminal of this process.
+  """
+  # tcsetpgrp from a background process group raises SIGTTOU.
+  handler = signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+  try:
+    os.tcsetpgrp(fd, pgrp)
+    return True
+  except OSError:
+    return False
+  finally:
+    signal.signal(signal.SIGTTOU, handler)
+
+
+def foreground_terminal(pgrp):
+  """Returns the stdio fd of the terminal whose foreground is pgrp or None."""
+  for fd in (0, 1, 2):
+    try:
+      if os.tcgetpgrp(fd) == pgrp:
+        return fd
+    except OSError:
+      pass
+  return None
+
+
+def get_umask():
+  umask = os.umask(0)
+  os.umask(umask)
+  return umask
+
+
+def run(path, argv):
+  """Runs pysh with argv (sys.argv) in the daemon listening on path.
+
+  Returns the exit status of the script, or None if the daemon is not
+  available. In that case, nothing has run and the caller should run the
+  script by itself.
+  """
+  sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+  try:
+    try:
+      sock.connect(path)
+      send_fds(sock.fileno(), [0, 1, 2])
+      send_message(sock, marshal.dumps({
+            'argv': list(argv),
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+            'umask': get_umask(),
+            'pgrp': os.getpgrp(),
+            }))
+      pid = recv_int(sock)
+    except (_socket.error, OSError):
+      return None
+    if pid is None:
+      # The daemon rejected the request.
+      return None
+    return wait_status(sock, pid)
+  finally:
+    sock.close()
+
+
+def wait_status(sock, pid):
+  def forward(signum, frame):
+    # The worker is the leader of the process group of the script and its
+    # commands.
+    try:
+      os.killpg(pid, signum)
+    except OSError:
+      try:
+        os.kill(pid, signum)
+      except OSError:
+        pass
+  handlers = {}
+  for signum in FORWARDED_SIGNALS:
+    handlers[signum] = signal.signal(signum, forward)
+  try:
+    try:
+      status = recv_int(sock)
+    except _socket.error:
+      status = None
+  finally:
+    for signum, handler in handlers.iteritems():
+      signal.signal(signum, handler)
+    # The worker gives the terminal back before it sends the status, but it
+    # may have been killed.
+    fd = foreground_terminal(pid)
+    if fd is not None:
+      set_foreground(fd, os.getpgrp())
+  if status is None:
+    os.write(2, 'pysh: the daemon worker exited unexpectedly.\n')
+    return 1
+  return status
@@ -0,0 +1,174 @@
+import errno
+import hashlib
+import imp
+import marshal
+import os
+import tempfile
+import time
+
+import pysh
+
+# Files which affect how scripts are converted and run, relative to the
+# directory of the pysh package.
+IMPLEMENTATION_FILES = ('converter.py', 'shell/tokenizer.py',
+                        'shell/parser.py', 'shell/runner.py',
+                        'shell/evaluator.py')
+# The cache keeps at most this many scripts. Entries which have not been
+# used for MAX_AGE seconds are removed too.
+MAX_ENTRIES = 1000
+MAX_AGE = 30 * 24 * 60 * 60
+
+__implementation_stamp = None
+
+
+def default_cache_dir():
+  """Returns $PYSH_CACHE_DIR or $XDG_CACHE_HOME/pysh (~/.cache/pysh)."""
+  dir = os.environ.get('PYSH_CACHE_DIR')
+  if dir:
+    return dir
+  base = os.environ.get('XDG_CACHE_HOME')
+  if not base:
+    base = os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(base, 'pysh')
+
+
+def implementation_stamp():
+  """Returns a str which changes when files of pysh implementation change.
+
+  mtimes and sizes are used instead of contents not to read the files
+  every time a script runs.
+  """
+  global __implementation_stamp
+  if __implementation_stamp is None:
+    base = os.path.dirname(os.path.abspath(pysh.__file__))
+    stamps = []
+    for name in IMPLEMENTATION_FILES:
+      try:
+        st = os.stat(os.path.join(base, name))
+        stamps.append('%s:%r:%d' % (name, st.st_mtime, st.st_size))
+      except OSError:
+        stamps.append('%s:missing' % name)
+    __implementation_stamp = '\0'.join(stamps)
+  return __implementation_stamp
+
+
+class CompileCache(object):
+  """A cache of converted pysh scripts and their bytecode.
+
+  Entries are keyed by the hash of the script content, pysh version and
+  implementation files, and bytecode format. Files are written atomically
+  (write to a temporary file and rename it), so concurrent processes can
+  share a cache directory. The least recently used entries are removed
+  when a new entry is stored.
+  """
+
+  def __init__(self, dir, stamp=None, max_entries=MAX_ENTRIES,
+               max_age=MAX_AGE):
+    self.__dir = dir
+    if stamp is None:
+      stamp = implementation_stamp()
+    self.__stamp = stamp
+    self.__max_entries = max_entries
+    self.__max_age = max_age
+
+  def key(self, source):
+    hash = hashlib.sha1()
+    hash.update(pysh.__version__)
+    hash.update('\0')
+    hash.update(self.__stamp)
+    hash.update('\0')
+    hash.update(imp.get_magic())
+    hash.update('\0')
+    hash.update(source)
+    return hash.hexdigest()
+
+  def source_path(self, key):
+    """The path of the converted script, which is used in tracebacks."""
+    return os.path.join(self.__dir, key + '.py')
+
+  def compiled_path(self, key):
+    return os.path.join(self.__dir, key + '.pyc')
+
+  def load(self, key):
+    """Returns the cached code object or None."""
+    path = self.compiled_path(key)
+    try:
+      data = file(path, 'rb').read()
+    except IOError:
+      return None
+    if data[:4] != imp.get_magic():
+      return None
+    try:
+      code = marshal.loads(data[8:])
+    except (EOFError, ValueError, TypeError):
+      return None
+    # mtime of the entry is the last time it was used.
+    try:
+      os.utime(path, None)
+    except OSError:
+      pass
+    return code
+
+  def store(self, key, converted):
+    """Compiles converted script and stores it.
+
+    Returns the code object. Failures to write files are ignored because
+    the cache directory may be read-only.
+    """
+    code = compile(converted, self.source_path(key), 'exec')
+    try:
+      self.__makedirs()
+      self.__write(self.source_path(key), converted)
+      # The same format as *.pyc. The mtime field is not used.
+      self.__write(self.compiled_path(key),
+                   imp.get_magic() + '\0' * 4 + marshal.dumps(code))
+      self.prune()
+    except (IOError, OSError):
+      pass
+    return code
+
+  def prune(self):
+    """Removes entries beyond max_entries or older than max_age."""
+    now = time.time()
+    entries = []
+    for name in os.listdir(self.__dir):
+      path = os.path.join(self.__dir, name)
+      try:
+        mtime = os.stat(path).st_mtime
+      except OSError:
+        continue
+      if name.startswith('.tmp'):
+        # Left by a process which was killed while writing.
+        if mtime < now - 60 * 60:
+          self.__remove(path)
+      elif name.endswith('.pyc'):
+        entries.append((mtime, name[:-len('.pyc')]))
+    entries.sort(reverse=True)
+    for i, (mtime, key) in enumerate(entries):
+      if i >= self.__max_entries or mtime < now - self.__max_age:
+        self.__remove(self.compiled_path(key))
+        self.__remove(self.source_path(key))
+
+  def __makedirs(self):
+    try:
+      os.makedirs(self.__dir, 0700)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+
+  def __remove(self, path):
+    try:
+      os.unlink(path)
+    except OSError:
+      pass
+
+  def __write(self, path, data):
+    fd, tmp = tempfile.mkstemp(dir=self.__dir, prefix='.tmp')
+    try:
+      f = os.fdopen(fd, 'wb')
+      f.write(data)
+      f.close()
+      os.rename(tmp, path)
+    except:
+      os.unlink(tmp)
+      raise
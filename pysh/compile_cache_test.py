@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from pysh.compile_cache import CompileCache
+from pysh.compile_cache import default_cache_dir
+from pysh.compile_cache import implementation_stamp
+
+
+class CompileCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def testStoreAndLoad(self):
+    cache = CompileCache(os.path.join(self.dir, 'cache'))
+    key = cache.key('> echo foo')
+    self.assertEquals(None, cache.load(key))
+    code = cache.store(key, 'x = 3 + 4\n')
+    namespace = {}
+    exec cache.load(key) in namespace
+    self.assertEquals(7, namespace['x'])
+    self.assertEquals(cache.source_path(key), code.co_filename)
+    self.assertEquals('x = 3 + 4\n', file(cache.source_path(key)).read())
+    self.assertEquals(['%s.py' % key, '%s.pyc' % key],
+                      sorted(os.listdir(os.path.join(self.dir, 'cache'))))
+
+  def testKey(self):
+    cache = CompileCache(self.dir)
+    self.assertEquals(cache.key('foo'), cache.key('foo'))
+    self.assertNotEquals(cache.key('foo'), cache.key('bar'))
+
+  def testKeyDependsOnImplementation(self):
+    self.assertEquals(implementation_stamp(), implementation_stamp())
+    self.assertEquals(CompileCache(self.dir).key('foo'),
+                      CompileCache(self.dir, implementation_stamp()).key('foo'))
+    self.assertNotEquals(CompileCache(self.dir, 'old').key('foo'),
+                         CompileCache(self.dir, 'new').key('foo'))
+
+  def testPruneByCount(self):
+    cache = CompileCache(self.dir)
+    keys = [cache.key(str(i)) for i in xrange(3)]
+    now = time.time()
+    for i, key in enumerate(keys):
+      cache.store(key, 'x = %d\n' % i)
+      os.utime(cache.compiled_path(key), (now - 100 + i, now - 100 + i))
+    # Loading an entry makes it the most recently used.
+    self.assertTrue(cache.load(keys[0]) is not None)
+    CompileCache(self.dir, max_entries=2).prune()
+    self.assertEquals(None, cache.load(keys[1]))
+    self.assertFalse(os.path.exists(cache.source_path(keys[1])))
+    self.assertTrue(cache.load(keys[0]) is not None)
+    self.assertTrue(cache.load(keys[2]) is not None)
+
+  def testPruneByAge(self):
+    cache = CompileCache(self.dir, max_age=60)
+    old = cache.key('old')
+    cache.store(old, 'x = 1\n')
+    past = time.time() - 120
+    os.utime(cache.compiled_path(old), (past, past))
+    tmp = os.path.join(self.dir, '.tmpabc')
+    file(tmp, 'w').close()
+    os.utime(tmp, (past - 3600, past - 3600))
+    new = cache.key('new')
+    cache.store(new, 'x = 2\n')
+    self.assertEquals(['%s.py' % new, '%s.pyc' % new],
+                      sorted(os.listdir(self.dir)))
+
+  def testBrokenFile(self):
+    cache = CompileCache(self.dir)
+    key = cache.key('foo')
+    file(cache.compiled_path(key), 'w').write('broken')
+    self.assertEquals(None, cache.load(key))
+
+  def testNotWritable(self):
+    path = os.path.join(self.dir, 'file')
+    file(path, 'w').close()
+    cache = CompileCache(os.path.join(path, 'cache'))
+    key = cache.key('foo')
+    code = cache.store(key, 'x = 10\n')
+    self.assertTrue(code is not None)
+    self.assertEquals(None, cache.load(key))
+
+  def testDefaultCacheDir(self):
+    environ = os.environ.copy()
+    try:
+      os.environ['PYSH_CACHE_DIR'] = '/tmp/pysh_cache'
+      self.assertEquals('/tmp/pysh_cache', default_cache_dir())
+      del os.environ['PYSH_CACHE_DIR']
+      os.environ['XDG_CACHE_HOME'] = '/tmp/xdg_cache'
+      self.assertEquals('/tmp/xdg_cache/pysh', default_cache_dir())
+    finally:
+      os.environ.clear()
+      os.environ.update(environ)
+
+
+if __name__ == '__main__':
+  unittest.main()
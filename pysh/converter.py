@@ -1,11 +1,14 @@
+import re
 import StringIO
 import sys
 
 from pysh.shell.tokenizer import Tokenizer
+from pysh.shell.parser import AndOr
 from pysh.shell.parser import Assign
-from pysh.shell.parser import BinaryOp
 from pysh.shell.parser import Parser
+from pysh.shell.parser import Pipeline
 from pysh.shell.parser import Process
+from pysh.shell.parser import Sequence
 
 
 SIGNATURE = ('# -*- coding: utf-8 -*-\n'
@@ -13,19 +16,37 @@ SIGNATURE = ('# -*- coding: utf-8 -*-\n'
              '# Don\'t edit this by hand.\n')
 
 
+SPACES_PATTERN = re.compile(r'[ \t\f\v]*')
+CONTENT_PATTERN = re.compile(r'[^\'"#\r\n\\]*')
+STRING_PATTERNS = {
+  '\'': re.compile(r'[^\'\\\r\n]*'),
+  '"': re.compile(r'[^"\\\r\n]*'),
+  }
+# A line without string literals, comments and backslashes.
+SIMPLE_LINE_PATTERN = re.compile(r'([ \t\f\v]*)(>[ \t\f\v]*)?([^\'"#\r\n\\]*)\n')
+HERE_DOCUMENT_PATTERNS = {
+  '\'': re.compile(r'[^\'\\]*'),
+  '"': re.compile(r'[^"\\]*'),
+  }
+
+
 class RoughLexer(object):
+  """Splits pysh script into lines of (indent, mode, content).
+
+  The input is read a line at a time and is scanned with regular
+  expressions instead of character by character.
+  """
+
   def __init__(self, reader):
     self.reader = reader
-    self.c = None
+    self.__buf = ''
+    self.__pos = 0
     # Used for indent prediction.
     self.__indent_stack = []
 
   def __iter__(self):
     return self
 
-  def is_space(self, c):
-    return c == ' ' or c == '\t' or c == '\f' or c == '\v'
-
   def __indent_width(self, indent):
     return sum(map(lambda c: 1 if c == ' ' else 8, indent))
 
@@ -63,129 +84,182 @@ class RoughLexer(object):
   def _predict_shellmode(self, prediction):
     pass
 
-  def read(self):
-    self.c = self.reader.read(1)
-    return self.c
+  def __fill(self):
+    """Reads the next line if the buffer is consumed.
+
+    Returns False if there is no more input."""
+    if self.__pos < len(self.__buf):
+      return True
+    self.__buf = self.reader.readline()
+    self.__pos = 0
+    return bool(self.__buf)
+
+  def __peek(self):
+    """Returns the next character or '' on EOF."""
+    if self.__pos < len(self.__buf) or self.__fill():
+      return self.__buf[self.__pos]
+    return ''
 
-  def seek_string_literal(self, content):
-    first = self.c
-    self.read()
-    if self.c == first:
-      if self.read() != first:
+  def __scan(self, pattern):
+    """Consumes and returns the longest prefix of the input which matches
+    pattern."""
+    result = []
+    while self.__fill():
+      end = pattern.match(self.__buf, self.__pos).end()
+      result.append(self.__buf[self.__pos:end])
+      self.__pos = end
+      if end < len(self.__buf):
+        break
+    return ''.join(result)
+
+  def __seek_string_literal(self, content):
+    quote = self.__peek()
+    self.__pos += 1
+    if self.__peek() == quote:
+      self.__pos += 1
+      if self.__peek() != quote:
         # empty literal
-        content.write(first * 2)
+        content.append(quote * 2)
       else:
-        content.write(first * 3)
-        self.read()
-        self.seek_here_document(content, first)
+        self.__pos += 1
+        content.append(quote * 3)
+        self.__seek_here_document(content, quote)
     else:
-      content.write(first)
-      self.seek_simple_string_literal(content, first)
+      content.append(quote)
+      self.__seek_simple_string_literal(content, quote)
 
-  def seek_here_document(self, content, quote):
+  def __seek_here_document(self, content, quote):
+    pattern = HERE_DOCUMENT_PATTERNS[quote]
     count = 0
     while True:
-      cur = self.c
-      self.read()
-      if cur == '':
+      chunk = self.__scan(pattern)
+      if chunk:
+        content.append(chunk)
+        count = 0
+      c = self.__peek()
+      if c == '':
         raise Exception('EOF while scanning here document')
-      elif cur == quote:
-        content.write(cur)
+      self.__pos += 1
+      if c == quote:
+        content.append(c)
         count += 1
         if count == 3:
           break
-      elif cur == '\\':
-        if self.c == '\r' or self.c == '\n':
-          self.seek_backslash(content)
-        else:
-          content.write('\\' + self.c)
-          self.read()
       else:
-        content.write(cur)
-        count = 0
+        # Please note that escaped characters don't reset count.
+        self.__seek_escape(content)
 
-  def seek_simple_string_literal(self, content, quote):
+  def __seek_simple_string_literal(self, content, quote):
+    pattern = STRING_PATTERNS[quote]
     while True:
-      cur = self.c
-      self.read()
-      if cur == '':
+      content.append(self.__scan(pattern))
+      c = self.__peek()
+      if c == '':
         raise Exception('EOF while scanning string literal')
-      elif cur == '\r' or cur == '\n':
+      elif c == '\r' or c == '\n':
         raise Exception('EOL while scanning string literal')
-      elif cur == '\\':
-        if self.c == '\r' or self.c == '\n':
-          self.seek_backslash(content)
-        else:
-          content.write('\\' + self.c)
-          self.read()
+      self.__pos += 1
+      if c == quote:
+        content.append(c)
+        break
       else:
-        content.write(cur)
-        if cur == quote:
-          break
+        self.__seek_escape(content)
+
+  def __seek_escape(self, content):
+    """Handles a character after backslash in string literals."""
+    c = self.__peek()
+    if c == '\r' or c == '\n':
+      self.__seek_backslash(content)
+    else:
+      content.append('\\' + c)
+      if c:
+        self.__pos += 1
 
-  def seek_backslash(self, writer):
-    if self.c == '\n':
-      self.read()
-    elif self.c == '\r':
-      if self.read() == '\n':
-        self.read()
+  def __seek_backslash(self, content):
+    """Skips a newline after backslash."""
+    c = self.__peek()
+    if c == '\n':
+      self.__pos += 1
+    elif c == '\r':
+      self.__pos += 1
+      if self.__peek() == '\n':
+        self.__pos += 1
     else:
-      writer.write('\\')
+      content.append('\\')
+
+  def __skip_comment(self):
+    """Skips a comment and a newline which follows it."""
+    while self.__fill():
+      end = self.__buf.find('\n', self.__pos)
+      if end != -1:
+        self.__pos = end + 1
+        return
+      self.__pos = len(self.__buf)
 
   def next(self):
-    if self.c is None:
-      self.c = self.reader.read(1)
+    if self.__fill():
+      match = SIMPLE_LINE_PATTERN.match(self.__buf, self.__pos)
+      if match:
+        self.__pos = match.end()
+        indent, shell, content = match.groups()
+        mode = 'shell' if shell else 'python'
+        self._predict_shellmode(mode == 'shell')
+        self.__predict_next_indent(indent, mode, content)
+        return indent, mode, content
 
-    indent_writer = StringIO.StringIO()
-    while self.is_space(self.c):
-      indent_writer.write(self.c)
-      self.read()
+    indent = self.__scan(SPACES_PATTERN)
 
     mode = 'python'
-    if self.c == '>':
+    if self.__peek() == '>':
       mode = 'shell'
-      while self.is_space(self.read()):
-        pass
-      
-    content = StringIO.StringIO()
+      self.__pos += 1
+      self.__scan(SPACES_PATTERN)
+
+    content = []
+    # Whether the line is terminated by EOF (not by a newline).
+    eof = False
     while True:
-      if self.c == '':
+      content.append(self.__scan(CONTENT_PATTERN))
+      c = self.__peek()
+      if c == '':
+        eof = True
         break
-      elif self.c == '\'' or self.c == '"':
-        self.seek_string_literal(content)
-      elif self.c == '#':
-        while self.c != '\n' and self.c != '':
-          self.read()
-        self.read() # discard '\n'
+      elif c == '\'' or c == '"':
+        self.__seek_string_literal(content)
+      elif c == '#':
+        self.__skip_comment()
+        eof = self.__peek() == ''
         break
-      elif self.c == '\r':
-        if self.read() == '\n':
-          self.c = None  # discard '\n'
+      elif c == '\r':
+        self.__pos += 1
+        if self.__peek() == '\n':
+          self.__pos += 1
+        else:
+          eof = self.__peek() == ''
         break
-      elif self.c == '\n':
-        self.c = None  # discard '\n'
+      elif c == '\n':
+        self.__pos += 1
         break
-      elif self.c == '\\':
-        self.read()
-        self.seek_backslash(content)
       else:
-        content.write(self.c)
-        self.read()
-    content_value = content.getvalue()
-    if self.c == '' and not content_value:
+        # backslash
+        self.__pos += 1
+        self.__seek_backslash(content)
+    content_value = ''.join(content)
+    if eof and not content_value:
       raise StopIteration()
     else:
-      indent = indent_writer.getvalue()
       self._predict_shellmode(mode == 'shell')
       self.__predict_next_indent(indent, mode, content_value)
       return indent, mode, content_value
 
 
 class Converter(object):
-  def __init__(self, lexer, writer, run_funcname='pysh.shell.runner.run'):
+  def __init__(self, lexer, writer, run_funcname='pysh.shell.runner.run_ast',
+               parse_funcname='pysh.shell.runner.parse'):
     self.lexer = lexer
     self.writer = writer
     self.__fun_func_name = run_funcname
+    self.__parse_func_name = parse_funcname
 
   def extractResponseNames(self, content):
     parser = Parser(Tokenizer(content))
@@ -195,37 +269,53 @@ class Converter(object):
     return names
 
   def extractResponseNamesInternal(self, ast, names):
-    if not ast or not (isinstance(ast, Process) or
-                       isinstance(ast, BinaryOp) or
-                       isinstance(ast, Assign)):
-      return
-    if isinstance(ast, Process):
-      for redirect in ast.redirects:
-        if redirect[0] == '=>':
-          names.append(redirect[1])
-      return
-    if isinstance(ast, Assign):
-      self.extractResponseNamesInternal(ast.cmd, names)
-      names.append(ast.name)
-      return
-    for e in (ast.left, ast.right):
-      self.extractResponseNamesInternal(e, names)
+    # Names are appended in the order of appearance. A name of -> is pushed
+    # to the stack as str so that it follows the names in its command.
+    stack = [ast]
+    while stack:
+      ast = stack.pop()
+      if isinstance(ast, str):
+        names.append(ast)
+      elif isinstance(ast, Process):
+        for redirect in ast.redirects:
+          if redirect[0] == '=>':
+            names.append(redirect[1])
+      elif isinstance(ast, Assign):
+        stack.append(ast.name)
+        stack.append(ast.cmd)
+      elif (isinstance(ast, Pipeline) or isinstance(ast, Sequence) or
+            isinstance(ast, AndOr)):
+        stack.extend(reversed(ast.cmds))
 
   def convert(self, with_signature):
-    if with_signature:
-      self.writer.write(SIGNATURE)
-    self.writer.write('import pysh.shell.runner\n')
+    # Shell commands are parsed once when the converted script is loaded,
+    # not every time they are executed. The parsed commands are stored to
+    # module-level variables, which must precede the body.
+    body = StringIO.StringIO()
+    ast_vars = {}  # content -> variable name
+    contents = []
     for indent, mode, content in self.lexer:
-      self.writer.write(indent)
+      body.write(indent)
       if mode == 'python':
-        self.writer.write(content)
+        body.write(content)
       elif content:
         names = self.extractResponseNames(content)
+        if content not in ast_vars:
+          ast_vars[content] = '_pysh_ast%d' % len(contents)
+          contents.append(content)
         if names:
-          self.writer.write(', '.join(names + ['']) + '= ')
-        self.writer.write('%s(%s, locals(), globals(), %s)' % (
-            self.__fun_func_name, `content`, `names`))
-      self.writer.write('\n')
+          body.write(', '.join(names + ['']) + '= ')
+        body.write('%s(%s, locals(), globals(), %s)' % (
+            self.__fun_func_name, ast_vars[content], `names`))
+      body.write('\n')
+
+    if with_signature:
+      self.writer.write(SIGNATURE)
+    self.writer.write('import pysh.shell.runner\n')
+    for content in contents:
+      self.writer.write('%s = %s(%s)\n' % (
+          ast_vars[content], self.__parse_func_name, `content`))
+    self.writer.write(body.getvalue())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,52 @@
+"""Benchmark of RoughLexer and Converter on a large generated script."""
+
+import os
+import StringIO
+import tempfile
+
+from pysh.benchlib import measure
+from pysh.benchlib import report
+from pysh.converter import Converter
+from pysh.converter import RoughLexer
+
+BLOCK = ('import os\n'
+         'for i in xrange(100):  # loop\n'
+         '    index = "%02d" % i\n'
+         '    message = \'it\\\'s \' + str(i)\n'
+         '    > mv from$index.txt to$index.txt\n'
+         '    > echo ${message} \\\n'
+         '        | cat => out\n'
+         'doc = """Here document\n'
+         'with "quotes" and \\"escapes\\".\n'
+         '"""\n'
+         '\n')
+
+
+def generate(lines):
+  return BLOCK * (lines / BLOCK.count('\n'))
+
+
+def main():
+  source = generate(20000)
+  lines = source.count('\n')
+  fd, path = tempfile.mkstemp()
+  try:
+    os.write(fd, source)
+    os.close(fd)
+    lex_string = measure(lambda: list(RoughLexer(StringIO.StringIO(source))))
+    lex_file = measure(lambda: list(RoughLexer(file(path))))
+  finally:
+    os.unlink(path)
+  convert = measure(lambda: Converter(
+      RoughLexer(StringIO.StringIO(source)),
+      StringIO.StringIO()).convert(True), repeat=3)
+  report('converter', [
+      ('lex_stringio', lex_string, 's'),
+      ('lex_file', lex_file, 's'),
+      ('lex_file_lines_per_sec', lines / lex_file, 'lines/s'),
+      ('convert', convert, 's'),
+      ])
+
+
+if __name__ == '__main__':
+  main()
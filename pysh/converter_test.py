@@ -154,6 +154,25 @@ class ConverterTest(unittest.TestCase):
       '(echo foo -> bar && echo baz => qux) -> piyo')
     self.assertEquals(['bar', 'qux', 'piyo'], names)
 
+  def testConvert(self):
+    reader = StringIO.StringIO('for i in xrange(3):\n'
+                               '  > echo $i => out\n'
+                               '  > echo $i => out\n'
+                               '> echo foo\n')
+    writer = StringIO.StringIO()
+    Converter(RoughLexer(reader), writer).convert(False)
+    self.assertEquals(
+      'import pysh.shell.runner\n'
+      '_pysh_ast0 = pysh.shell.runner.parse(\'echo $i => out\')\n'
+      '_pysh_ast1 = pysh.shell.runner.parse(\'echo foo\')\n'
+      'for i in xrange(3):\n'
+      '  out, = pysh.shell.runner.run_ast('
+      '_pysh_ast0, locals(), globals(), [\'out\'])\n'
+      '  out, = pysh.shell.runner.run_ast('
+      '_pysh_ast0, locals(), globals(), [\'out\'])\n'
+      'pysh.shell.runner.run_ast(_pysh_ast1, locals(), globals(), [])\n',
+      writer.getvalue())
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,305 @@
+"""pysh daemon which runs pysh scripts in pre-forked workers.
+
+The daemon imports pysh modules once and forks workers in advance. Each
+worker accepts one connection from bin/pysh (see pysh/client.py), runs the
+script with the stdio, argv, working directory and environment of the
+client, sends back the exit status and exits. So a script starts without
+the cost of starting Python and importing pysh.
+"""
+
+import errno
+import marshal
+import optparse
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import threading
+import traceback
+
+# Modules which are imported in advance for workers.
+import pysh.main
+import pysh.shell.builtin
+import pysh.shell.evaluator
+import pysh.shell.runner
+import pysh.shell.spawn
+from pysh.client import foreground_terminal
+from pysh.client import recv_message
+from pysh.client import send_int
+from pysh.client import set_foreground
+import pysh.fdpass
+from pysh.fdpass import recv_fds
+
+DEFAULT_WORKERS = 4
+# SO_PEERCRED is not defined by socket module of Python 2.
+SO_PEERCRED = 17
+PID_FORMAT = 'i'
+PID_SIZE = struct.calcsize(PID_FORMAT)
+
+
+def exit_status(e):
+  """Converts SystemExit to an exit status like Python does."""
+  if e.code is None:
+    return 0
+  if isinstance(e.code, int):
+    return e.code
+  try:
+    print >> sys.stderr, e.code
+  except:
+    pass
+  return 1
+
+
+def python_path_entries(pythonpath):
+  """Returns the entries which PYTHONPATH adds to sys.path."""
+  return [os.path.abspath(path) for path in pythonpath.split(os.pathsep)
+          if path]
+
+
+def client_sys_path(daemon_pythonpath, client_pythonpath):
+  """Returns sys.path with PYTHONPATH of the client instead of the daemon's.
+
+  Like Python does, entries of PYTHONPATH are put after sys.path[0].
+  """
+  daemon_entries = set(python_path_entries(daemon_pythonpath))
+  rest = [path for path in sys.path[1:]
+          if os.path.abspath(path) not in daemon_entries]
+  return sys.path[:1] + python_path_entries(client_pythonpath) + rest
+
+
+def peer_uid(conn):
+  if not sys.platform.startswith('linux'):
+    return None
+  cred = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                         struct.calcsize('3i'))
+  return struct.unpack('3i', cred)[1]
+
+
+class Worker(object):
+  """Runs a script requested via conn in this process."""
+
+  def __init__(self, conn):
+    self.__conn = conn
+
+  def run(self):
+    """Returns False if the request is rejected."""
+    uid = peer_uid(self.__conn)
+    if uid is not None and uid != os.getuid():
+      return False
+    fds = recv_fds(self.__conn.fileno(), 3)
+    if len(fds) != 3:
+      for fd in fds:
+        os.close(fd)
+      return False
+    data = recv_message(self.__conn)
+    if data is None:
+      return False
+    request = marshal.loads(data)
+    # The client sends signals to the process group, so that they reach
+    # the commands run by the script too.
+    os.setpgid(0, 0)
+    for target, fd in enumerate(fds):
+      os.dup2(fd, target)
+    for fd in fds:
+      if fd > 2:
+        os.close(fd)
+    # If the client runs in the foreground of the terminal which is also the
+    # controlling terminal of the daemon (e.g. `pyshd &`), the script takes
+    # the foreground. Otherwise, commands reading the terminal are stopped by
+    # SIGTTIN.
+    client_pgrp = request.get('pgrp')
+    tty = foreground_terminal(client_pgrp)
+    if tty is not None and not set_foreground(tty, os.getpgrp()):
+      tty = None
+    send_int(self.__conn, os.getpid())
+
+    os.chdir(request['cwd'])
+    sys.path[:] = client_sys_path(os.environ.get('PYTHONPATH', ''),
+                                  request['env'].get('PYTHONPATH', ''))
+    os.environ.clear()
+    os.environ.update(request['env'])
+    os.umask(request['umask'])
+    sys.argv = request['argv']
+    try:
+      try:
+        pysh.main.main()
+      finally:
+        # Like the exit of Python, waits for non-daemon threads and then
+        # runs atexit functions.
+        threading._shutdown()
+        if hasattr(sys, 'exitfunc'):
+          sys.exitfunc()
+      status = 0
+    except SystemExit, e:
+      status = exit_status(e)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if tty is not None:
+      set_foreground(tty, client_pgrp)
+    send_int(self.__conn, status)
+    return True
+
+
+class Daemon(object):
+  """Keeps the given number of idle workers listening on path."""
+
+  def __init__(self, path, workers=DEFAULT_WORKERS):
+    self.__path = path
+    self.__workers = workers
+    self.__idle = set()
+    self.__listener = None
+    # Workers write their pids to this pipe when they become busy.
+    self.__busy_r, self.__busy_w = None, None
+
+  def serve(self):
+    self.__listener = self.__listen()
+    self.__busy_r, self.__busy_w = os.pipe()
+    try:
+      while True:
+        while len(self.__idle) < self.__workers:
+          self.__spawn()
+        try:
+          # Timeout so that idle workers which died are replaced.
+          readable, _, _ = select.select([self.__busy_r], [], [], 1.0)
+        except select.error, e:
+          if e.args[0] != errno.EINTR:
+            raise
+          readable = []
+        if readable:
+          data = os.read(self.__busy_r, PID_SIZE * 64)
+          for i in xrange(0, len(data), PID_SIZE):
+            pid, = struct.unpack(PID_FORMAT, data[i:i + PID_SIZE])
+            self.__idle.discard(pid)
+        self.__reap()
+    finally:
+      self.__shutdown()
+
+  def __listen(self):
+    if os.path.exists(self.__path):
+      probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+        probe.connect(self.__path)
+      except socket.error, e:
+        if e.errno != errno.ECONNREFUSED:
+          raise
+        # A stale socket of a daemon which is not running.
+        os.unlink(self.__path)
+      else:
+        raise Exception('pysh daemon is already running on %s' % self.__path)
+      finally:
+        probe.close()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the owner can connect to the daemon.
+    umask = os.umask(0077)
+    try:
+      listener.bind(self.__path)
+    finally:
+      os.umask(umask)
+    listener.listen(64)
+    return listener
+
+  def __spawn(self):
+    pid = os.fork()
+    if pid == 0:
+      status = 1
+      try:
+        self.__run_worker()
+        status = 0
+      except:
+        traceback.print_exc()
+      finally:
+        os._exit(status)
+    self.__idle.add(pid)
+
+  def __run_worker(self):
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.close(self.__busy_r)
+    # Load the C library for posix_spawnp and pidfd while waiting for a
+    # connection.
+    pysh.shell.spawn.LoadLibc()
+    while True:
+      try:
+        conn, _ = self.__listener.accept()
+        break
+      except socket.error, e:
+        if e.errno != errno.EINTR:
+          raise
+    os.write(self.__busy_w, struct.pack(PID_FORMAT, os.getpid()))
+    os.close(self.__busy_w)
+    self.__listener.close()
+    try:
+      Worker(conn).run()
+    finally:
+      conn.close()
+
+  def __reap(self):
+    while True:
+      try:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+      except OSError, e:
+        if e.errno == errno.EINTR:
+          continue
+        if e.errno == errno.ECHILD:
+          return
+        raise
+      if pid == 0:
+        return
+      self.__idle.discard(pid)
+
+  def __shutdown(self):
+    if self.__listener:
+      self.__listener.close()
+      try:
+        os.unlink(self.__path)
+      except OSError:
+        pass
+    for pid in self.__idle:
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except OSError:
+        pass
+
+
+def terminate(signum, frame):
+  sys.exit(0)
+
+
+def ensure_stdio():
+  """Opens /dev/null for closed stdio so that they are not reused."""
+  for fd in (0, 1, 2):
+    try:
+      os.fstat(fd)
+    except OSError:
+      os.open(os.devnull, os.O_RDWR)
+
+
+def main():
+  parser = optparse.OptionParser(
+      usage='Usage: pyshd [-w WORKERS] [SOCKET]\n\n'
+      'SOCKET defaults to $PYSH_DAEMON_SOCKET.')
+  parser.add_option('-w', '--workers', type='int', default=DEFAULT_WORKERS,
+                    help='the number of idle workers [default: %default]')
+  options, args = parser.parse_args()
+  if len(args) > 1 or options.workers < 1:
+    parser.error('wrong arguments')
+  path = args[0] if args else os.environ.get('PYSH_DAEMON_SOCKET')
+  if not path:
+    parser.error('SOCKET or $PYSH_DAEMON_SOCKET must be specified')
+  try:
+    pysh.fdpass.load()
+  except OSError:
+    print >> sys.stderr, 'pysh daemon is not supported on this platform.'
+    sys.exit(1)
+  ensure_stdio()
+  signal.signal(signal.SIGTERM, terminate)
+  try:
+    Daemon(path, options.workers).serve()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,195 @@
+import errno
+import os
+import pty
+import select
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import termios
+import time
+import unittest
+
+BIN = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'bin')
+PYSH = os.path.join(BIN, 'pysh')
+PYSHD = os.path.join(BIN, 'pyshd')
+
+
+class DaemonTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.socket = os.path.join(self.dir, 'pysh.sock')
+    self.env = os.environ.copy()
+    self.env['PYSH_CACHE_DIR'] = os.path.join(self.dir, 'cache')
+    self.env['PYSH_DAEMON_SOCKET'] = self.socket
+    self.daemon = subprocess.Popen(['python', PYSHD, '--workers=2',
+                                    self.socket])
+    for i in xrange(100):
+      if os.path.exists(self.socket):
+        break
+      time.sleep(0.05)
+
+  def tearDown(self):
+    self.daemon.terminate()
+    self.daemon.wait()
+    self.assertFalse(os.path.exists(self.socket))
+    shutil.rmtree(self.dir)
+
+  def pysh(self, args, input=None, env=None):
+    proc = subprocess.Popen(['python', PYSH] + args, env=env or self.env,
+                            cwd=self.dir, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(input)
+    return proc.returncode, out, err
+
+  def testCommandLine(self):
+    self.env['FOO'] = 'bar'
+    script = ('import os, sys\n'
+              'print os.getppid() == %d\n'
+              'print sys.argv, os.getcwd() == %r, os.environ["FOO"]\n'
+              '> echo foo | cat\n' % (self.daemon.pid, self.dir))
+    # Workers are replaced after they run scripts.
+    for i in xrange(4):
+      rc, out, err = self.pysh(['-c', script, 'a'])
+      self.assertEquals('', err)
+      self.assertEquals(0, rc)
+      self.assertEquals("True\n['-c', 'a'] True bar\nfoo\n", out)
+
+  def testEnvironmentAndPythonPath(self):
+    lib = os.path.join(self.dir, 'lib')
+    os.mkdir(lib)
+    file(os.path.join(lib, 'mylib.py'), 'w').write('NAME = "from-mylib"\n')
+    self.env['PYTHONPATH'] = lib
+    self.env['FOO'] = 'bar'
+    rc, out, err = self.pysh(['-c', 'import os, mylib\n'
+                              'print mylib.NAME, os.environ["FOO"]\n'
+                              '> echo $FOO'])
+    self.assertEquals('', err)
+    self.assertEquals(0, rc)
+    self.assertEquals('from-mylib bar\nbar\n', out)
+    # Not importable by the next script without PYTHONPATH.
+    del self.env['PYTHONPATH']
+    rc, _, err = self.pysh(['-c', 'import mylib'])
+    self.assertEquals(1, rc)
+    self.assertTrue('ImportError' in err)
+
+  def testWaitNonDaemonThreads(self):
+    rc, out, _ = self.pysh(['-c', 'import threading, time\n'
+                            'def run():\n'
+                            '  time.sleep(0.2)\n'
+                            '  print "thread"\n'
+                            'threading.Thread(target=run).start()\n'
+                            'print "main"\n'])
+    self.assertEquals(0, rc)
+    self.assertEquals('main\nthread\n', out)
+
+  def testSignalReachesCommands(self):
+    if not sys.platform.startswith('linux'):
+      return
+    pid_path = os.path.join(self.dir, 'pid.txt')
+    file(os.path.join(self.dir, 'sleep.sh'), 'w').write(
+      'echo $$ > pid.txt.tmp\nmv pid.txt.tmp pid.txt\nexec sleep 30\n')
+    proc = subprocess.Popen(['python', PYSH, '-c', '> sh sleep.sh'],
+                            env=self.env, cwd=self.dir)
+    for i in xrange(100):
+      if os.path.exists(pid_path):
+        break
+      time.sleep(0.05)
+    pid = int(file(pid_path).read())
+    proc.send_signal(signal.SIGTERM)
+    proc.wait()
+    for i in xrange(100):
+      try:
+        state = file('/proc/%d/stat' % pid).read().split()[2]
+      except IOError:
+        break
+      if state == 'Z':
+        break
+      time.sleep(0.05)
+    else:
+      os.kill(pid, signal.SIGKILL)
+      self.fail('sleep is still running.')
+
+  def testTerminalInDaemonSession(self):
+    # pyshd runs in the session of the terminal of the client, e.g. it was
+    # started with `pyshd &`. Commands of the script read the terminal in the
+    # foreground.
+    master, slave = pty.openpty()
+    attrs = termios.tcgetattr(slave)
+    attrs[3] &= ~termios.ECHO
+    termios.tcsetattr(slave, termios.TCSANOW, attrs)
+    socket = os.path.join(self.dir, 'tty.sock')
+    file(os.path.join(self.dir, 'tty.pysh'), 'w').write(
+        'import os, sys\n'
+        'print os.getppid() == int(sys.argv[1])\n'
+        '> head -1\n')
+    file(os.path.join(self.dir, 'tty.sh'), 'w').write(
+        'python %(pyshd)s --workers=1 %(socket)s &\n'
+        'while [ ! -S %(socket)s ]; do sleep 0.05; done\n'
+        'PYSH_DAEMON_SOCKET=%(socket)s python %(pysh)s tty.pysh $!\n'
+        'echo rc=$?\n'
+        'python -c "import os; print os.tcgetpgrp(0) == os.getpgrp()"\n'
+        'kill $!\n' % {'pyshd': PYSHD, 'pysh': PYSH, 'socket': socket})
+    tty = os.ttyname(slave)
+    def new_session():
+      os.setsid()
+      # The terminal becomes the controlling terminal of the new session.
+      os.close(os.open(tty, os.O_RDWR))
+    proc = subprocess.Popen(['sh', 'tty.sh'], stdin=slave, stdout=slave,
+                            stderr=slave, env=self.env, cwd=self.dir,
+                            preexec_fn=new_session)
+    os.close(slave)
+    os.write(master, 'hello\n')
+    out = ''
+    deadline = time.time() + 10
+    while time.time() < deadline:
+      readable, _, _ = select.select([master], [], [], 0.1)
+      if not readable:
+        continue
+      try:
+        data = os.read(master, 1024)
+      except OSError, e:
+        # EIO when all the processes closed the terminal.
+        if e.errno != errno.EIO:
+          raise
+        data = ''
+      if not data:
+        break
+      out += data
+    os.close(master)
+    if proc.poll() is None:
+      os.killpg(proc.pid, signal.SIGKILL)
+      proc.wait()
+    self.assertEquals('True\r\nhello\r\nrc=0\r\nTrue\r\n', out)
+
+  def testStdin(self):
+    rc, out, _ = self.pysh(['-', 'a'], 'import sys\nprint sys.argv\n'
+                           '> echo foo\n')
+    self.assertEquals(0, rc)
+    self.assertEquals("['-c', 'a']\nfoo\n", out)
+
+  def testScript(self):
+    file(os.path.join(self.dir, 'script.pysh'), 'w').write(
+        'import sys\nprint sys.argv, raw_input()\n> cat\n')
+    rc, out, _ = self.pysh(['script.pysh', 'a'], 'foo\nbar\n')
+    self.assertEquals(0, rc)
+    self.assertEquals("['script.pysh', 'a'] foo\nbar\n", out)
+
+  def testExitCode(self):
+    rc, _, _ = self.pysh(['-c', 'import sys\nsys.exit(3)'])
+    self.assertEquals(3, rc)
+    rc, _, err = self.pysh(['-c', 'raise Exception("error!")'])
+    self.assertEquals(1, rc)
+    self.assertTrue(err.endswith('Exception: error!\n'))
+
+  def testFallback(self):
+    self.env['PYSH_DAEMON_SOCKET'] = os.path.join(self.dir, 'no_daemon')
+    rc, out, _ = self.pysh(['-c', 'import os\nprint os.getppid() == %d' %
+                            os.getpid()])
+    self.assertEquals(0, rc)
+    self.assertEquals('True\n', out)
+
+
+if __name__ == '__main__':
+  unittest.main()
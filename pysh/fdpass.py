@@ -0,0 +1,127 @@
+"""Passes file descriptors over Unix sockets (SCM_RIGHTS).
+
+socket module of Python 2 doesn't have sendmsg and recvmsg, so they are
+called via ctypes. Only Linux is supported because the layout of msghdr
+differs between platforms. Functions raise OSError if fds can not be
+passed.
+"""
+
+import errno
+import os
+import struct
+import sys
+
+SOL_SOCKET = 1
+SCM_RIGHTS = 1
+MSG_CTRUNC = 0x8
+MSG_CMSG_CLOEXEC = 0x40000000
+# struct cmsghdr {size_t cmsg_len; int cmsg_level; int cmsg_type;}
+# size_t is unsigned long on Linux.
+CMSGHDR_FORMAT = '@Lii'
+FD_FORMAT = '@i'
+
+__libc = None
+
+
+def cmsg_align(size):
+  align = struct.calcsize('@L')
+  return (size + align - 1) & ~(align - 1)
+
+
+def cmsg_space(size):
+  return cmsg_align(struct.calcsize(CMSGHDR_FORMAT)) + cmsg_align(size)
+
+
+def cmsg_len(size):
+  return cmsg_align(struct.calcsize(CMSGHDR_FORMAT)) + size
+
+
+def load():
+  """Returns (ctypes, libc, msghdr, iovec) and loads them if necessary."""
+  global __libc
+  if __libc is None:
+    if not sys.platform.startswith('linux'):
+      raise OSError(errno.ENOSYS, 'fd passing is not supported')
+    try:
+      import ctypes
+    except ImportError:
+      raise OSError(errno.ENOSYS, 'fd passing is not supported')
+
+    class iovec(ctypes.Structure):
+      _fields_ = [('iov_base', ctypes.c_void_p),
+                  ('iov_len', ctypes.c_size_t)]
+
+    class msghdr(ctypes.Structure):
+      _fields_ = [('msg_name', ctypes.c_void_p),
+                  ('msg_namelen', ctypes.c_uint32),
+                  ('msg_iov', ctypes.POINTER(iovec)),
+                  ('msg_iovlen', ctypes.c_size_t),
+                  ('msg_control', ctypes.c_void_p),
+                  ('msg_controllen', ctypes.c_size_t),
+                  ('msg_flags', ctypes.c_int)]
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    for func in (libc.sendmsg, libc.recvmsg):
+      func.argtypes = [ctypes.c_int, ctypes.POINTER(msghdr), ctypes.c_int]
+      func.restype = ctypes.c_ssize_t
+    __libc = (ctypes, libc, msghdr, iovec)
+  return __libc
+
+
+def call(ctypes, func, *args):
+  while True:
+    result = func(*args)
+    if result >= 0:
+      return result
+    err = ctypes.get_errno()
+    if err != errno.EINTR:
+      raise OSError(err, os.strerror(err))
+
+
+def send_fds(sock_fd, fds):
+  """Sends fds with a byte of data to sock_fd."""
+  ctypes, libc, msghdr, iovec = load()
+  data = ctypes.create_string_buffer('\0', 1)
+  iov = iovec(ctypes.cast(data, ctypes.c_void_p), 1)
+  payload = struct.pack('@%di' % len(fds), *fds)
+  control = ctypes.create_string_buffer(
+      struct.pack(CMSGHDR_FORMAT, cmsg_len(len(payload)), SOL_SOCKET,
+                  SCM_RIGHTS) + payload, cmsg_space(len(payload)))
+  msg = msghdr(None, 0, ctypes.pointer(iov), 1,
+               ctypes.cast(control, ctypes.c_void_p), len(control), 0)
+  if call(ctypes, libc.sendmsg, sock_fd, ctypes.byref(msg), 0) != 1:
+    raise OSError(errno.EIO, 'failed to send fds')
+
+
+def recv_fds(sock_fd, max_fds):
+  """Receives fds sent by send_fds from sock_fd.
+
+  The returned fds are close-on-exec."""
+  ctypes, libc, msghdr, iovec = load()
+  data = ctypes.create_string_buffer(1)
+  iov = iovec(ctypes.cast(data, ctypes.c_void_p), 1)
+  fd_size = struct.calcsize(FD_FORMAT)
+  control = ctypes.create_string_buffer(cmsg_space(fd_size * max_fds))
+  msg = msghdr(None, 0, ctypes.pointer(iov), 1,
+               ctypes.cast(control, ctypes.c_void_p), len(control), 0)
+  if call(ctypes, libc.recvmsg, sock_fd, ctypes.byref(msg),
+          MSG_CMSG_CLOEXEC) != 1:
+    raise OSError(errno.EIO, 'connection closed while receiving fds')
+  fds = []
+  raw = control.raw[:msg.msg_controllen]
+  header_size = struct.calcsize(CMSGHDR_FORMAT)
+  offset = 0
+  while offset + header_size <= len(raw):
+    length, level, type = struct.unpack_from(CMSGHDR_FORMAT, raw, offset)
+    if length < header_size:
+      break
+    if level == SOL_SOCKET and type == SCM_RIGHTS:
+      start = offset + cmsg_len(0)
+      for i in xrange((length - cmsg_len(0)) / fd_size):
+        fds.extend(struct.unpack_from(FD_FORMAT, raw, start + i * fd_size))
+    offset += cmsg_align(length)
+  if msg.msg_flags & MSG_CTRUNC:
+    for fd in fds:
+      os.close(fd)
+    raise OSError(errno.EMSGSIZE, 'too many fds')
+  return fds
@@ -0,0 +1,40 @@
+import fcntl
+import os
+import socket
+import unittest
+
+from pysh.fdpass import recv_fds
+from pysh.fdpass import send_fds
+
+
+class FdPassTest(unittest.TestCase):
+  def testSendAndRecv(self):
+    left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    r, w = os.pipe()
+    try:
+      send_fds(left.fileno(), [r, w])
+      left.sendall('data')
+      fds = recv_fds(right.fileno(), 2)
+      self.assertEquals(2, len(fds))
+      for fd in fds:
+        self.assertTrue(fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
+      self.assertEquals('data', right.recv(4))
+      os.write(fds[1], 'hello')
+      self.assertEquals('hello', os.read(r, 5))
+      for fd in fds:
+        os.close(fd)
+    finally:
+      for fd in (r, w):
+        os.close(fd)
+      left.close()
+      right.close()
+
+  def testClosed(self):
+    left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    left.close()
+    self.assertRaises(OSError, recv_fds, right.fileno(), 1)
+    right.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
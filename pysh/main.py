@@ -1,8 +1,11 @@
+import imp
 import os
 import re
 import sys
 import StringIO
 
+from pysh.compile_cache import CompileCache
+from pysh.compile_cache import default_cache_dir
 from pysh.converter import Converter, RoughLexer
 from pysh.shell.tokenizer import Tokenizer
 from pysh.shell.parser import Parser
@@ -14,36 +17,72 @@ def usage_exit():
   sys.exit(1)
 
 
+def convert(reader, with_signature):
+  writer = StringIO.StringIO()
+  Converter(RoughLexer(reader), writer).convert(with_signature)
+  return writer.getvalue()
+
+
+def compile_script(script):
+  """Returns the code object of script, using the cache if possible."""
+  cache = CompileCache(default_cache_dir())
+  source = file(script, 'r').read()
+  key = cache.key(source)
+  code = cache.load(key)
+  if code is None:
+    code = cache.store(key, convert(StringIO.StringIO(source), True))
+  return code
+
+
+def run_code(code, argv, path0, filename=None):
+  """Runs code as __main__ module in this process like python command.
+
+  sys.argv is set to argv and sys.path[0] is set to path0.
+  """
+  main_module = imp.new_module('__main__')
+  if filename:
+    main_module.__file__ = filename
+  main_module.__builtins__ = __builtins__
+  # Keep the original __main__ module alive. Otherwise, its globals are
+  # cleared while they are used by the caller.
+  original_main = sys.modules['__main__']
+  sys.modules['__main__'] = main_module
+  sys.argv = argv
+  sys.path[0] = path0
+  try:
+    exec code in main_module.__dict__
+  except SystemExit:
+    raise
+  except:
+    type, value, tb = sys.exc_info()
+    # Hide this frame from the traceback.
+    sys.excepthook(type, value, tb.tb_next)
+    sys.exit(1)
+
+
 def main():
   if len(sys.argv) < 2:
     usage_exit()
   if sys.argv[1] == '-':
-    reader = sys.stdin
-    writer = StringIO.StringIO()
-    Converter(RoughLexer(reader), writer).convert(False)
-    argv = sys.argv[2:]
-    os.execlp('python', 'python', '-c', writer.getvalue(), *argv)
+    code = compile(convert(sys.stdin, False), '<string>', 'exec')
+    run_code(code, ['-c'] + sys.argv[2:], '')
   elif sys.argv[1] == '-c':
     if len(sys.argv) < 3:
       usage_exit()
-    reader = StringIO.StringIO(sys.argv[2])
-    writer = StringIO.StringIO()
-    Converter(RoughLexer(reader), writer).convert(False)
-    argv = sys.argv[3:]
-    os.execlp('python', 'python', '-c', writer.getvalue(), *argv)
+    code = compile(convert(StringIO.StringIO(sys.argv[2]), False),
+                   '<string>', 'exec')
+    run_code(code, ['-c'] + sys.argv[3:], '')
   else:
     script = sys.argv[1]
     name, ext = os.path.splitext(script)
     if ext == ".py":
       print >> sys.stderr, 'An input file shoundn\'t be *.py.'
       sys.exit(1)
-    py = name + '.py'
-    reader = file(script, 'r')
-    writer = file(py, 'w')
-    Converter(RoughLexer(reader), writer).convert(True)
-    writer.close()
-    argv = sys.argv[2:]
-    os.execlp('python', 'python', py, *argv)
+    # Converted scripts are cached in the cache directory instead of being
+    # written next to the script. If the cache has the script, it runs
+    # without conversion.
+    run_code(compile_script(script), sys.argv[1:],
+             os.path.dirname(os.path.abspath(script)), script)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,126 @@
+"""Benchmark of the startup time of bin/pysh.
+
+It measures the end-to-end time of `pysh -c`, `pysh -` and `pysh script`
+with a cold cache (an empty cache directory for each run) and a warm cache,
+and breaks the startup down into imports, conversion, compilation and the
+first run of shell commands in a new interpreter.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from pysh.benchlib import report
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PYSH = os.path.join(ROOT, 'bin', 'pysh')
+REPEAT = 20
+
+SCRIPT = ('import os\n'
+          'names = []\n'
+          'for i in xrange(3):\n'
+          '  names.append("file%d" % i)\n'
+          '> true ${names} > /dev/null\n'
+          '> echo foo | cat > /dev/null\n'
+          '> true && true || false\n')
+
+# Runs in a new interpreter and prints times of startup steps as JSON.
+BREAKDOWN = r'''
+import json, StringIO, sys, time
+times = []
+start = time.time()
+import pysh.main
+times.append(('import_main', time.time() - start))
+start = time.time()
+import pysh.shell.runner
+times.append(('import_runner', time.time() - start))
+from pysh.converter import Converter, RoughLexer
+source = sys.stdin.read()
+start = time.time()
+writer = StringIO.StringIO()
+Converter(RoughLexer(StringIO.StringIO(source)), writer).convert(False)
+times.append(('convert', time.time() - start))
+start = time.time()
+code = compile(writer.getvalue(), '<string>', 'exec')
+times.append(('compile', time.time() - start))
+for name in ('first_run', 'second_run'):
+  start = time.time()
+  exec code in {'__name__': '__main__'}
+  times.append((name, time.time() - start))
+sys.stdout.write(json.dumps(times))
+'''
+
+
+def environ(cache_dir):
+  env = dict(os.environ)
+  env['PYSH_CACHE_DIR'] = cache_dir
+  # Measure pysh itself, not pysh daemon.
+  env.pop('PYSH_DAEMON_SOCKET', None)
+  path = env.get('PYTHONPATH')
+  env['PYTHONPATH'] = ROOT + (':' + path if path else '')
+  return env
+
+
+def run_pysh(args, env, input=None):
+  start = time.time()
+  proc = subprocess.Popen([sys.executable, PYSH] + args, env=env,
+                          stdin=subprocess.PIPE)
+  proc.communicate(input)
+  elapsed = time.time() - start
+  if proc.returncode != 0:
+    raise Exception('pysh %r failed' % args)
+  return elapsed
+
+
+def measure_startup(dir, args, input=None):
+  """Returns the best times of pysh with cold and warm caches."""
+  cold = None
+  for i in xrange(REPEAT):
+    elapsed = run_pysh(args, environ(os.path.join(dir, 'cold%d' % i)), input)
+    cold = elapsed if cold is None else min(cold, elapsed)
+  env = environ(os.path.join(dir, 'warm'))
+  run_pysh(args, env, input)
+  warm = min(run_pysh(args, env, input) for _ in xrange(REPEAT))
+  return cold, warm
+
+
+def measure_breakdown(dir):
+  """Returns the best time of each startup step."""
+  best = {}
+  for _ in xrange(REPEAT):
+    proc = subprocess.Popen([sys.executable, '-c', BREAKDOWN],
+                            env=environ(os.path.join(dir, 'breakdown')),
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out, _ = proc.communicate(SCRIPT)
+    for name, elapsed in json.loads(out):
+      best[name] = min(best.get(name, elapsed), elapsed)
+  return best
+
+
+def main():
+  dir = tempfile.mkdtemp()
+  try:
+    script = os.path.join(dir, 'script.pysh')
+    file(script, 'w').write(SCRIPT)
+    results = []
+    for mode, args, input in (('c', ['-c', SCRIPT], None),
+                              ('stdin', ['-'], SCRIPT),
+                              ('script', [script], None)):
+      cold, warm = measure_startup(dir, args, input)
+      results.append(('%s_cold' % mode, cold, 's'))
+      results.append(('%s_warm' % mode, warm, 's'))
+    breakdown = measure_breakdown(dir)
+    for name in ('import_main', 'import_runner', 'convert', 'compile',
+                 'first_run', 'second_run'):
+      results.append((name, breakdown[name], 's'))
+  finally:
+    shutil.rmtree(dir)
+  report('main', results)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,4 +1,64 @@
+import os
+import shutil
+import subprocess
+import tempfile
 import unittest
 
+PYSH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                    '..', 'bin', 'pysh')
+
+
+class MainTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.env = os.environ.copy()
+    self.env['PYSH_CACHE_DIR'] = os.path.join(self.dir, 'cache')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def pysh(self, args, input=None):
+    proc = subprocess.Popen(['python', PYSH] + args, env=self.env,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    out, err = proc.communicate(input)
+    return proc.returncode, out, err
+
+  def testCommandLine(self):
+    rc, out, _ = self.pysh(['-c', 'import sys\n'
+                            'print sys.argv, __name__\n'
+                            '> echo foo', 'a', 'b'])
+    self.assertEquals(0, rc)
+    self.assertEquals("['-c', 'a', 'b'] __main__\nfoo\n", out)
+
+  def testStdin(self):
+    rc, out, _ = self.pysh(['-', 'a'], 'import sys\n'
+                           'print sys.argv\n'
+                           '> echo foo\n')
+    self.assertEquals(0, rc)
+    self.assertEquals("['-c', 'a']\nfoo\n", out)
+
+  def testScript(self):
+    script = os.path.join(self.dir, 'script.pysh')
+    file(script, 'w').write('import sys\n'
+                            'print sys.argv[1:], __file__ == sys.argv[0]\n'
+                            'print sys.path[0] == %r\n'
+                            '> echo foo\n' % self.dir)
+    for i in xrange(2):
+      rc, out, _ = self.pysh([script, 'a'])
+      self.assertEquals(0, rc)
+      self.assertEquals("['a'] True\nTrue\nfoo\n", out)
+    # The converted script is not written next to the script.
+    self.assertEquals(['cache', 'script.pysh'], sorted(os.listdir(self.dir)))
+    self.assertEquals(2, len(os.listdir(os.path.join(self.dir, 'cache'))))
+
+  def testExitCode(self):
+    rc, _, _ = self.pysh(['-c', 'import sys\nsys.exit(3)'])
+    self.assertEquals(3, rc)
+    rc, _, err = self.pysh(['-c', 'raise Exception("error!")'])
+    self.assertEquals(1, rc)
+    self.assertTrue(err.endswith('Exception: error!\n'))
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -2,6 +2,7 @@ import collections
 import csv
 import datetime
 import grp
+import itertools
 import os
 import stat
 import optparse
@@ -9,9 +10,11 @@ import pwd
 import StringIO
 import sys
 
+from pysh.shell.pycmd import batches
 from pysh.shell.pycmd import register_pycmd
 from pysh.shell.pycmd import pycmd
 from pysh.shell.pycmd import IOType
+from pysh.shell.records import Records, get_record_format
 from pysh.shell.table import PyshTable, CreateTableFromIterableRows
 
 # TODO(yunabe): Writes tests for all commands.
@@ -47,43 +50,37 @@ class Permission(int):
     return ''.join(result)
 
 
-@pycmd(name='echo', inType=IOType.No)
+@pycmd(name='echo', inType=IOType.No, batch=True)
 def pycmd_echo(args, input, options):
   line = []
   for arg in args[1:]:
     if not isinstance(arg, basestring) and (
       isinstance(arg, collections.Iterable)):
       if line:
-        yield ' '.join(line)
+        yield [' '.join(line)]
         line = []
-      for e in arg:
-        yield e
+      for batch in batches(arg):
+        yield batch
     else:
       line.append(str(arg))
   if line:
-    yield ' '.join(line)
+    yield [' '.join(line)]
 
 
-@pycmd(name='map')
+@pycmd(name='map', batch=True)
 def pycmd_map(args, input, options):
   assert len(args) == 2
-  if isinstance(input, file):
-    input = file_to_array(input)
   f = args[1]
   assert callable(f)
-  return (f(x) for x in input)
+  return (map(f, batch) for batch in input)
 
 
-@pycmd(name='filter')
+@pycmd(name='filter', batch=True)
 def pycmd_filter(args, input, options):
   assert len(args) == 2
-  if isinstance(input, file):
-    input = file_to_array(input)
   cond = args[1]
   assert callable(cond)
-  for x in input:
-    if cond(x):
-      yield x
+  return ([x for x in batch if cond(x)] for batch in input)
 
 
 @pycmd(name='reduce')
@@ -161,24 +158,24 @@ def pycmd_pyls(args, input, options):
                    generator())
 
 
-@pycmd(name='select')
+@pycmd(name='select', batch=True)
 def pycmd_where(args, input, options):
   assert len(args) == 2
-  table = CreateTableFromIterableRows(input)
+  table = CreateTableFromIterableRows(itertools.chain.from_iterable(input))
   return table.select(args[1], options.globals(), options.locals())
 
 
-@pycmd(name='where')
+@pycmd(name='where', batch=True)
 def pycmd_where(args, input, options):
   assert len(args) == 2
-  table = CreateTableFromIterableRows(input)
+  table = CreateTableFromIterableRows(itertools.chain.from_iterable(input))
   return table.where(args[1], options.globals(), options.locals())
 
 
-@pycmd(name='orderby')
+@pycmd(name='orderby', batch=True)
 def pycmd_orderby(args, input, options):
   assert len(args) == 2 or len(args) == 3
-  table = CreateTableFromIterableRows(input)
+  table = CreateTableFromIterableRows(itertools.chain.from_iterable(input))
   asc = True
   if len(args) == 3:
     args2 = args[2].lower()
@@ -189,15 +186,15 @@ def pycmd_orderby(args, input, options):
   return table.orderby(args[1], asc, options.globals(), options.locals())
 
 
-@pycmd(name='tocsv')
+@pycmd(name='tocsv', batch=True)
 def pycmd_tocsv(args, input, options):
-  table = CreateTableFromIterableRows(input)
+  table = CreateTableFromIterableRows(itertools.chain.from_iterable(input))
   io = StringIO.StringIO()
   w = csv.writer(io)
   w.writerow(table.columns)
   for row in table:
     w.writerow(row.values())
-  return io.getvalue().split('\r\n')[:-1]
+  return [io.getvalue().split('\r\n')[:-1]]
 
 
 @pycmd(name='fromcsv')
@@ -213,6 +210,12 @@ def pycmd_fromcsv(args, input, options):
   return PyshTable(tuple(row0), it)
 
 
+@pycmd(name='records', batch=True)
+def pycmd_records(args, input, options):
+  assert len(args) == 2
+  return Records(input, get_record_format(args[1]))
+
+
 @pycmd(name='cd', inType=IOType.No, outType=IOType.No)
 def pycmd_cd(args, input, options):
   assert len(args) == 2 or len(args) == 1
@@ -67,6 +67,12 @@ class BuiltinTest(unittest.TestCase):
              'map ${lambda x: x * x} > out.txt', globals(), locals())
     self.assertEquals('1\n4\n9\n16\n25\n', file('out.txt').read())
 
+  def testMapFilterPython(self):
+    data = range(3000)
+    rc = run('echo $data | map ${lambda x: x * 2} |'
+             'filter ${lambda x: x % 3 == 0} => out', globals(), locals())
+    self.assertEquals(range(0, 6000, 6), rc['out'])
+
   def testFilterCmd(self):
     run('/bin/echo "cupcake\\ndonut\\nfroyo\\nginger" |'
              'filter ${lambda l: "e" in l} > out.txt',
@@ -100,6 +106,48 @@ class BuiltinTest(unittest.TestCase):
     self.assertEquals(10, len(rc['out']))
     self.assertEquals(9, rc['out'][0].b)
 
+  def testSelect(self):
+    table = PyshTable(('a', 'b'),
+                      ((i, i * i % 10) for i in xrange(3)))
+    rc = run('echo $table | select "b, a + 1 as c" => out',
+             globals(), locals())
+    self.assertEquals([(0, 1), (1, 2), (4, 3)],
+                      [(row.b, row.c) for row in rc['out']])
+
+  def testToCsv(self):
+    table = PyshTable(('a', 'b'),
+                      ((i, i * i % 10) for i in xrange(3)))
+    rc = run('echo $table | tocsv => out', globals(), locals())
+    self.assertEquals(['a,b', '0,0', '1,1', '2,4'], rc['out'])
+
+  def testWherePrint(self):
+    table = PyshTable(('a', 'b'),
+                      ((i, i * i % 10) for i in xrange(10)))
+    run('echo $table | where "a == 3" > out.txt', globals(), locals())
+    self.assertEquals(['a |b', '----', '3 |9'],
+                      file('out.txt').read().splitlines())
+
+  def testRecordsNul(self):
+    data = ['a b', 'c\nd']
+    run('echo $data | records nul | xargs -0 -n 1 echo > out.txt',
+        globals(), locals())
+    self.assertEquals('a b\nc\nd\n', file('out.txt').read())
+
+  def testRecordsJsonRedirect(self):
+    data = ['a\nb', 1]
+    run('echo $data | records json > out.txt', globals(), locals())
+    self.assertEquals('"a\\nb"\n1\n', file('out.txt').read())
+    run('echo $data | records json > out.txt; true', globals(), locals())
+    self.assertEquals('"a\\nb"\n1\n', file('out.txt').read())
+    run('echo $data | records repr | cat > out.txt', globals(), locals())
+    self.assertEquals("'a\\nb'\n1\n", file('out.txt').read())
+
+  def testRecordsToPython(self):
+    data = ['a\nb', 1]
+    rc = run('echo $data | records json | map ${lambda x: x} => out',
+             globals(), locals())
+    self.assertEquals(['a\nb', 1], rc['out'])
+
 
 if __name__ == '__main__':
   unittest.main()
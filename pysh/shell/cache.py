@@ -0,0 +1,97 @@
+import collections
+import threading
+
+
+class LRUCache(object):
+  """A size-bounded dict which discards the least recently used entry.
+
+  It counts hits, misses and evictions. Please see stats."""
+
+  def __init__(self, capacity):
+    assert capacity > 0
+    self.__capacity = capacity
+    self.__entries = collections.OrderedDict()
+    self.__lock = threading.Lock()
+    self.__hits = 0
+    self.__misses = 0
+    self.__evictions = 0
+
+  def get(self, key, default=None):
+    self.__lock.acquire()
+    try:
+      try:
+        value = self.__entries.pop(key)
+      except KeyError:
+        self.__misses += 1
+        return default
+      # Move the entry to the most recently used end.
+      self.__entries[key] = value
+      self.__hits += 1
+      return value
+    finally:
+      self.__lock.release()
+
+  def put(self, key, value):
+    self.__lock.acquire()
+    try:
+      self.__entries.pop(key, None)
+      self.__entries[key] = value
+      while len(self.__entries) > self.__capacity:
+        self.__entries.popitem(last=False)
+        self.__evictions += 1
+    finally:
+      self.__lock.release()
+
+  def clear(self):
+    self.__lock.acquire()
+    try:
+      self.__entries.clear()
+    finally:
+      self.__lock.release()
+
+  def __len__(self):
+    self.__lock.acquire()
+    try:
+      return len(self.__entries)
+    finally:
+      self.__lock.release()
+
+  def stats(self):
+    self.__lock.acquire()
+    try:
+      return {'hits': self.__hits,
+              'misses': self.__misses,
+              'evictions': self.__evictions,
+              'size': len(self.__entries),
+              'capacity': self.__capacity}
+    finally:
+      self.__lock.release()
+
+
+class AliasMapVersions(object):
+  """Gives versions to alias maps.
+
+  version returns the same number for the same alias map as long as its
+  contents are not modified. Different alias maps never share versions, so
+  (cmd_str, version) can be used as a cache key of tokenized commands.
+  """
+
+  def __init__(self, capacity=16):
+    # id(alias_map) -> (alias_map, snapshot of alias_map, version).
+    # alias_map is kept so that its id is not reused by other objects.
+    self.__snapshots = LRUCache(capacity)
+    self.__lock = threading.Lock()
+    self.__last_version = 0
+
+  def version(self, alias_map):
+    entry = self.__snapshots.get(id(alias_map))
+    if entry and entry[0] is alias_map and entry[1] == alias_map:
+      return entry[2]
+    self.__lock.acquire()
+    try:
+      self.__last_version += 1
+      version = self.__last_version
+    finally:
+      self.__lock.release()
+    self.__snapshots.put(id(alias_map), (alias_map, dict(alias_map), version))
+    return version
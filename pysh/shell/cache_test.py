@@ -0,0 +1,59 @@
+import unittest
+
+from pysh.shell.cache import AliasMapVersions
+from pysh.shell.cache import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+  def test(self):
+    cache = LRUCache(2)
+    self.assertEquals(None, cache.get('a'))
+    cache.put('a', 1)
+    cache.put('b', 2)
+    self.assertEquals(1, cache.get('a'))
+    # b is evicted because a was used more recently.
+    cache.put('c', 3)
+    self.assertEquals(None, cache.get('b'))
+    self.assertEquals(1, cache.get('a'))
+    self.assertEquals(3, cache.get('c'))
+    self.assertEquals({'hits': 3, 'misses': 2, 'evictions': 1,
+                       'size': 2, 'capacity': 2}, cache.stats())
+
+  def testPutExistingKey(self):
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('a', 2)
+    self.assertEquals(2, cache.get('a'))
+    self.assertEquals(1, len(cache))
+    self.assertEquals(0, cache.stats()['evictions'])
+
+  def testClear(self):
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.clear()
+    self.assertEquals(None, cache.get('a'))
+
+
+class AliasMapVersionsTest(unittest.TestCase):
+  def test(self):
+    versions = AliasMapVersions()
+    alias_map0 = {'ls': ('ls -la', False)}
+    alias_map1 = {'ls': ('ls -la', False)}
+    v0 = versions.version(alias_map0)
+    v1 = versions.version(alias_map1)
+    self.assertNotEquals(v0, v1)
+    self.assertEquals(v0, versions.version(alias_map0))
+    self.assertEquals(v1, versions.version(alias_map1))
+
+  def testModified(self):
+    versions = AliasMapVersions()
+    alias_map = {'ls': ('ls -la', False)}
+    v0 = versions.version(alias_map)
+    alias_map['ls'] = ('ls -l', False)
+    v1 = versions.version(alias_map)
+    self.assertNotEquals(v0, v1)
+    self.assertEquals(v1, versions.version(alias_map))
+
+
+if __name__ == '__main__':
+  unittest.main()
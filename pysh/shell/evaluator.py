@@ -1,13 +1,15 @@
-import atexit
 import collections
+import errno
 import functools
 import glob
+import itertools
 import os
 import re
 import StringIO
 import traceback
 import sys
 import threading
+import types
 
 from pysh.shell.tokenizer import (
   SPACE,
@@ -26,39 +28,61 @@ from pysh.shell.tokenizer import (
   SEMICOLON,
   BACKQUOTE,
   EOF,
+  CONSTANT,
+  TOKEN_NAMES,
+  Token,
 )
 
+from pysh.shell.cache import LRUCache
+from pysh.shell.ioloop import IOLoop
+from pysh.shell.ioloop import WaitPid
+from pysh.shell.ioloop import orphans
+from pysh.shell.parser import AndOr
 from pysh.shell.parser import Assign
+from pysh.shell.parser import CompiledSubstitution
+from pysh.shell.parser import CopyAst
+from pysh.shell.parser import FoldConstants
+from pysh.shell.parser import HasGlobPattern
 from pysh.shell.parser import Parser
+from pysh.shell.parser import Pipeline
 from pysh.shell.parser import Process
-from pysh.shell.parser import BinaryOp
+from pysh.shell.parser import Sequence
+from pysh.shell.parser import SubstitutionExpr
+from pysh.shell.pycmd import batches
 from pysh.shell.pycmd import get_pycmd
 from pysh.shell.pycmd import IOType
 from pysh.shell.pycmd import PyCmdOption
+from pysh.shell.records import write_records
+from pysh.shell import spawn
 from pysh.shell.tokenizer import Tokenizer
-from pysh.shell.task_manager import Runner, IdentityTask
+from pysh.shell.tokenizer import alias_map_versions
+from pysh.shell.task_manager import Runner
 
 
 PYVAR_PATTERN = re.compile(r'^[_a-zA-Z][_a-zA-Z0-9]*$')
 
+PARSE_CACHE_SIZE = 256
+
+# The size hint in bytes to read lines of a native command for batch pycmds.
+FILE_BATCH_SIZE = 65536
+
 
 class ProxyPyOutToNative(object):
   """A class that represents convversion from python outputs of child ast
   to native output."""
+  __slots__ = ('ast', 'inType', 'outType')
+
   def __init__(self, ast):
     self.ast = ast
 
 
 def GetArg0Name(tok, vardict):
-  if tok[0] == LITERAL or tok[0] == SINGLE_QUOTED_STRING:
-    return tok[1]
-  if tok[0] != SUBSTITUTION:
+  kind = tok.kind
+  if kind == CONSTANT or kind == LITERAL or kind == SINGLE_QUOTED_STRING:
+    return tok.text
+  if kind != SUBSTITUTION:
     return None
-  value = tok[1]
-  if value.startswith('${'):
-    value = value[2:-1]
-  else:
-    value = value[1:]
+  value = SubstitutionExpr(tok.text)
   if not PYVAR_PATTERN.match(value):
     return None
   value = vardict.get(value, None)
@@ -124,53 +148,62 @@ def DiagnoseIOTypeInternal(ast, vardict):
     ast.inType = ast.cmd.inType
     ast.outType = ast.cmd.outType
     return ast
-  else:
-    assert isinstance(ast, BinaryOp)
-    ast.left = DiagnoseIOTypeInternal(ast.left, vardict)
-    ast.right = DiagnoseIOTypeInternal(ast.right, vardict)
-    if ast.op == '|':
-      ast.inType = ast.left.inType
-      ast.outType = ast.right.outType
-      if ast.left.outType == 'MIX' and ast.right.inType == 'PY':
+  elif isinstance(ast, Pipeline):
+    cmds = ast.cmds
+    for i, cmd in enumerate(cmds):
+      cmds[i] = DiagnoseIOTypeInternal(cmd, vardict)
+    for i in xrange(1, len(cmds)):
+      left, right = cmds[i - 1], cmds[i]
+      if left.outType == 'MIX' and right.inType == 'PY':
         raise Exception('Can not pipe combination of python outputs and '
                         'file outputs to commands that read python data.')
-      if not IsFileTypeIO(ast.left.outType) and IsFileTypeIO(ast.right.inType):
-        ast.left = ProxyPyOutToNative(ast.left)
-        ast.left.inType = ast.inType
-        ast.left.outType = 'ST'
-    else:
-      inMerged = MergeIOType(ast.left.inType, ast.right.inType)
-      outMerged = MergeIOType(ast.left.outType, ast.right.outType)
+      if not IsFileTypeIO(left.outType) and IsFileTypeIO(right.inType):
+        cmds[i - 1] = ProxyPyOutToNative(left)
+        cmds[i - 1].inType = left.inType
+        cmds[i - 1].outType = 'ST'
+    ast.inType = cmds[0].inType
+    ast.outType = cmds[-1].outType
+    return ast
+  else:
+    assert isinstance(ast, Sequence) or isinstance(ast, AndOr)
+    cmds = ast.cmds
+    for i, cmd in enumerate(cmds):
+      cmd = DiagnoseIOTypeInternal(cmd, vardict)
+      cmds[i] = cmd
+      if i == 0:
+        inMerged = cmd.inType
+        outMerged = cmd.outType
+        continue
+      inMerged = MergeIOType(inMerged, cmd.inType)
+      outMerged = MergeIOType(outMerged, cmd.outType)
       if inMerged == 'MIX':
         raise Exception('Can not combile cmd that reads python object and '
                         'cmd that reads file stream.')
-      ast.inType = inMerged
-      ast.outType = outMerged
-      if IsFileTypeIO(ast.outType):
-        if not IsFileTypeIO(ast.left.outType):
-          ast.left = ProxyPyOutToNative(ast.left)
-        if not IsFileTypeIO(ast.right.outType):
-          ast.right = ProxyPyOutToNative(ast.right)
-
+    ast.inType = inMerged
+    ast.outType = outMerged
+    if IsFileTypeIO(ast.outType):
+      for i, cmd in enumerate(cmds):
+        if not IsFileTypeIO(cmd.outType):
+          cmds[i] = ProxyPyOutToNative(cmd)
     return ast
 
 
 def DiagnoseProcessIOType(proc, vardict):
   is_pycmd, proc.inType, proc.outType = GetProcIOType(proc, vardict)
   for arg in proc.args:
-    for i, (tok, ast) in enumerate(arg):
-      if tok != 'bquote':
+    for i, tok in enumerate(arg):
+      if tok.kind != BACKQUOTE:
         continue
-      ast = DiagnoseIOTypeInternal(ast, vardict)
+      ast = DiagnoseIOTypeInternal(tok.text, vardict)
       merged_intype = MergeIOType(ast.inType,  proc.inType)
       if merged_intype == 'MIX':
         raise Exception('Can not combile cmd that reads python object and '
                         'cmd that reads file stream.')
       proc.inType = merged_intype
       if ast.outType == 'PY':
-        arg[i] = (tok, ProxyPyOutToNative(ast))
+        arg[i] = Token(BACKQUOTE, ProxyPyOutToNative(ast))
       else:
-        arg[i] = (tok, ast)
+        arg[i] = Token(BACKQUOTE, ast)
   if is_pycmd and proc.outType == 'ST':
     original_proc = proc
     proc = ProxyPyOutToNative(proc)
@@ -179,12 +212,80 @@ def DiagnoseProcessIOType(proc, vardict):
   return proc
 
 
-class VarDict(dict):
-  # VarDict must be a real dict because it is passed to eval as globals.
+class VarDict(object):
+  """Variables of a command: locals over globals over os.environ.
+
+  Variables are looked up in each layer without copying them. VarDict is
+  created once per command.
+  """
+
   def __init__(self, globals, locals):
-    for d in (os.environ, globals, locals):
-      for key in d:
-        self[key] = d[key]
+    self.__layers = (locals, globals, os.environ)
+    self.__merged = None
+    # Globals of eval. eval adds __builtins__ to it.
+    self.__eval_globals = {}
+
+  def __getitem__(self, key):
+    for layer in self.__layers:
+      if key in layer:
+        return layer[key]
+    raise KeyError(key)
+
+  def __contains__(self, key):
+    for layer in self.__layers:
+      if key in layer:
+        return True
+    return False
+
+  def get(self, key, default=None):
+    for layer in self.__layers:
+      if key in layer:
+        return layer[key]
+    return default
+
+  def merged(self):
+    """Returns a dict which has all variables. It is built at the first call.
+    """
+    if self.__merged is None:
+      locals, globals, environ = self.__layers
+      merged = dict(environ)
+      merged.update(globals)
+      merged.update(locals)
+      self.__merged = merged
+    return self.__merged
+
+  def eval(self, code):
+    """Evaluates code (a code object or a string) with the variables."""
+    if isinstance(code, str):
+      code = compile(code, '<string>', 'eval')
+    if HasNestedCode(code):
+      # Free variables in lambda and generator expressions are looked up
+      # in globals directly, so globals must be a real dict of variables
+      # (http://goo.gl/bfVW9).
+      return eval(code, self.merged(), {})
+    else:
+      return eval(code, self.__eval_globals, EvalLocals(self))
+
+
+class EvalLocals(dict):
+  """Locals of eval which falls back to VarDict.
+
+  Names set in eval (e.g. variables of list comprehensions) are stored in
+  the dict itself, so they don't leak to other evaluations.
+  """
+
+  def __init__(self, vardict):
+    self.__vardict = vardict
+
+  def __missing__(self, key):
+    return self.__vardict[key]
+
+
+def HasNestedCode(code):
+  for const in code.co_consts:
+    if isinstance(const, types.CodeType):
+      return True
+  return False
 
 
 class PipeFd(object):
@@ -204,23 +305,46 @@ class PipeFd(object):
 
 
 class PyPipe(object):
-  """A object that pipes iterators give by add_generator to __iter__."""
+  """A object that pipes iterators give by add_generator to __iter__.
+
+  Generators are read in the order they are added. Items are not queued:
+  the reader pulls them from the generators in its own thread, so a writer
+  never runs ahead of the reader.
+
+  A generator added with batch=True yields lists of items. The reader gets
+  items with __iter__ or lists of them with batches, whichever way the
+  generators were added.
+  """
 
   def __init__(self, reader_type):
     self.__reader_type = reader_type
     self.__generators = collections.deque()
     self.__close = False
     self.__cond = threading.Condition()
+    self.__added = 0
+    self.__max_depth = 0
 
-  def add_generator(self, generator):
+  def add_generator(self, generator, batch=False):
     self.__cond.acquire()
-    self.__generators.append(generator)
+    self.__generators.append((generator, batch))
+    self.__added += 1
+    if len(self.__generators) > self.__max_depth:
+      self.__max_depth = len(self.__generators)
     self.__cond.notify()
     self.__cond.release()
 
   def reader_type(self):
     return self.__reader_type
 
+  def stats(self):
+    """Returns the numbers of generators queued now, at most and in total."""
+    self.__cond.acquire()
+    stats = {'depth': len(self.__generators),
+             'max_depth': self.__max_depth,
+             'generators': self.__added}
+    self.__cond.release()
+    return stats
+
   def close(self):
     if self.__close:
       return
@@ -230,41 +354,65 @@ class PyPipe(object):
     self.__cond.release()
 
   def __iter__(self):
+    # chain yields items of generators without a Python frame per item.
+    return itertools.chain.from_iterable(self.__iter_generators(False))
+
+  def batches(self):
+    """Returns an iterator of lists of items."""
+    return itertools.chain.from_iterable(self.__iter_generators(True))
+
+  def __iter_generators(self, batch):
     while True:
       self.__cond.acquire()
       while not (self.__close or self.__generators):
         self.__cond.wait()
       if self.__generators:
-        generator = self.__generators.pop()
+        generator, is_batch = self.__generators.popleft()
       else:
         generator = None
       self.__cond.release()
 
-      if generator:
-        for e in generator:
-          yield e
-      else:
+      if generator is None:
         assert self.__close
         break
+      if is_batch == batch:
+        yield generator
+      elif is_batch:
+        yield itertools.chain.from_iterable(generator)
+      else:
+        yield batches(generator)
+
+
+def IsBatchPyCmd(pycmd):
+  return hasattr(pycmd, 'batch') and pycmd.batch()
+
+
+def FileBatches(f):
+  """Yields lists of lines of f without newlines."""
+  while True:
+    lines = f.readlines(FILE_BATCH_SIZE)
+    if not lines:
+      break
+    yield [line.rstrip('\r\n') for line in lines]
 
 
 class TaskArg(object):
   """A class which is used to share resources amoung tasks."""
 
-  def __init__(self, rc, pool, write_done, cond,
+  def __init__(self, rc, pool, ioloop,
                after_fork, exec_fail,
-               globals, locals):
+               globals, locals, vardict):
     self.rc = rc
     self.pool = pool
     self.all_r = set()
     self.all_w = set()
     self.files = {}
-    self.write_done = write_done
-    self.condition = cond
+    self.ioloop = ioloop
     self.after_fork = after_fork
     self.exec_fail = exec_fail
     self.globals = globals
     self.locals = locals
+    self.vardict = vardict
 
   def ospipe(self):
     rw = os.pipe()
@@ -319,16 +467,14 @@ class EvalAstTask(object):
     ast = self.__ast
     if isinstance(ast, Process):
       cont.call(EvalProcessTask(self.__arg, self.__pipefd, ast), 'wait')
-    elif isinstance(ast, BinaryOp):
-      op = ast.op
-      if op == '&&' or op == '||' or op == ';':
-        cont.call(
-          SemiAndOrTask(self.__arg, self.__pipefd, op, ast.left, ast.right),
-          'wait')
-      elif op == '|':
-        self.invokePipeTask(cont, ast.left, ast.right)
-      else:
-        raise Exception('Unknown op:', op)
+    elif isinstance(ast, Pipeline):
+      cont.call(PipelineTask(self.__arg, self.__pipefd, ast.cmds), 'wait')
+    elif isinstance(ast, AndOr):
+      cont.call(SemiAndOrTask(self.__arg, self.__pipefd, ast.cmds, ast.ops),
+                'wait')
+    elif isinstance(ast, Sequence):
+      cont.call(SemiAndOrTask(self.__arg, self.__pipefd, ast.cmds, None),
+                'wait')
     elif isinstance(ast, Assign):
       cont.call(AssignTask(
           self.__arg, self.__pipefd, ast.cmd, ast.name), 'wait')
@@ -337,35 +483,32 @@ class EvalAstTask(object):
     else:
       raise Exception('Unexpected ast: ', ast)
 
-  def invokePipeTask(self, cont, left, right):
-    assert (IsFileTypeIO(left.outType) or not IsFileTypeIO(right.inType))
-    if not IsFileTypeIO(left.outType):
-      cont.call(PipePyToPyTask(self.__arg, self.__pipefd, left, right), 'wait')
-    else:
-      cont.call(PipeNativeToNativeTask(self.__arg, self.__pipefd, left, right),
-                'wait')
-
   def resume(self, cont, state, response):
     assert state == 'wait'
     cont.done(response)
 
 
 class WriteThread(threading.Thread):
-  """A thread to write python data to file stream."""
+  """A thread to write python data to file stream.
+
+  on_done is called in the thread after output is flushed.
+  """
   
-  def __init__(self, input, output):
+  def __init__(self, input, output, on_done):
     threading.Thread.__init__(self)
     self.__input = input
     self.__output = output
+    self.__on_done = on_done
 
   def run(self):
-    for e in self.__input:
-      self.__output.write(str(e))
-      self.__output.write('\n')
+    try:
+      write_records(self.__input.batches(), self.__output)
+    finally:
+      self.__on_done()
 
 
 class WritePyCmdRedirectThread(threading.Thread):
-  """A thread to write python data to file stream.
+  """A thread to write lists of python data to file stream.
 
   TODO(yunabe): Integrate this to WriteThread.
   """
@@ -376,9 +519,7 @@ class WritePyCmdRedirectThread(threading.Thread):
     self.__file = out
 
   def run(self):
-    for e in self.__input:
-      self.__file.write(str(e))
-      self.__file.write('\n')
+    write_records(self.__input, self.__file)
 
 
 class WritePyCmdRedirectPyOutThread(threading.Thread):
@@ -390,86 +531,7 @@ class WritePyCmdRedirectPyOutThread(threading.Thread):
     self.__output = output
 
   def run(self):
-    for e in self.__input:
-      self.__output.append(e)
-
-
-class WriteToPyOutThread(threading.Thread):
-  """A thread to write file stream to python list (redirect to python)."""
-
-  def __init__(self, input, output):
-    threading.Thread.__init__(self)
-    self.__input = input
-    self.__output = output
-
-  def run(self):
-    for line in self.__input:
-      self.__output.append(line.rstrip('\r\n'))
-
-
-global_wait_thread = None
-global_wait_thread_lock = threading.Lock()
-
-
-class WaitChildThread(threading.Thread):
-  """A thread which catches termination of child processes.
-
-  It calls callbacks registered by other threads via register_callback."""
-  
-  def __init__(self):
-    threading.Thread.__init__(self)
-    # setDaemon so that Python can exit if the thread is running.
-    self.setDaemon(True)
-    self.__callbacks = {}
-    self.__unhandled = {}  # {pid: rc}
-    self.__stop = False
-    self.__cond = threading.Condition()
-
-  def register_callback(self, pid, callback):
-    """Register callback for the end of process.
-
-    Please note that this method is called by other threads."""
-    self.__cond.acquire()
-    unhandled_rc = None
-    if pid in self.__unhandled:
-      unhandled_rc = self.__unhandled[pid]
-      del self.__unhandled[pid]
-    else:
-      assert not pid in self.__callbacks
-      self.__callbacks[pid] = callback
-      if len(self.__callbacks) == 1:
-        self.__cond.notify()  # notify to the wait thread
-    self.__cond.release()
-    if unhandled_rc is not None:
-      callback(unhandled_rc)
-
-  def stop(self):
-    self.__cond.acquire()
-    self.__stop = True
-    self.__cond.notify()
-    self.__cond.release()
-
-  def run(self):
-    while True:
-      self.__cond.acquire()
-      while len(self.__callbacks) == 0 and not self.__stop:
-        self.__cond.wait()
-      done = len(self.__callbacks) == 0
-      self.__cond.release()
-
-      if done:
-        break
-      pid, rc = os.wait()
-      callback = None
-      self.__cond.acquire()
-      if pid in self.__callbacks:
-        callback = self.__callbacks[pid]
-        del self.__callbacks[pid]
-      else:
-        self.__unhandled[pid] = rc
-      self.__cond.release()
-      if callback:
-        callback(rc)
+    self.__output.extend(self.__input)
 
 
 class ProxyPyOutToNativeTask(object):
@@ -481,12 +543,16 @@ class ProxyPyOutToNativeTask(object):
     self.__ast = ast
     self.__new_w = None
     self.__write_th = None
+    self.__response = None
+    self.__waiting = 2
 
   def start(self, cont):
     new_w = None
     new_w = PyPipe('ST')
-    self.__write_th = WriteThread(new_w,
-                                  self.__arg.tofile(self.__pipefd.stdout))
+    ioloop = self.__arg.ioloop
+    self.__write_th = WriteThread(
+      new_w, self.__arg.tofile(self.__pipefd.stdout),
+      lambda: ioloop.post((cont, 'written', None)))
     self.__write_th.start()
     self.__new_w = new_w
     cont.call(EvalAstTask(
@@ -495,7 +561,16 @@ class ProxyPyOutToNativeTask(object):
         self.__ast.ast), 'wait')
 
   def resume(self, cont, state, response):
-    cont.done(response)
+    # Waits for the thread in the loop instead of join in dispose because
+    # the thread may write to a pipe captured by the loop.
+    if state == 'wait':
+      self.__response = response
+      self.__new_w.close()
+    else:
+      assert state == 'written'
+    self.__waiting -= 1
+    if not self.__waiting:
+      cont.done(self.__response)
 
   def dispose(self):
     if self.__new_w:
@@ -504,97 +579,91 @@ class ProxyPyOutToNativeTask(object):
 
 
 class SemiAndOrTask(object):
-  def __init__(self, arg, pipefd, op, left, right):
-    self.__arg = arg
-    self.__pipefd = pipefd
-    self.__op = op
-    self.__left = left
-    self.__right = right
-
-  def start(self, cont):
-    cont.call(EvalAstTask(self.__arg, self.__pipefd, self.__left), 'left')
+  """Runs cmds of Sequence or AndOr (with ops) one by one."""
 
-  def resume(self, cont, state, response):
-    if state == 'left':
-      ok = response == 0
-      if (ok and self.__op == '||') or (not ok and self.__op == '&&'):
-        cont.done(response)
-        return
-      cont.call(EvalAstTask(self.__arg, self.__pipefd, self.__right), 'right')
-    else:
-      assert state == 'right'
-      cont.done(response)
-
-class PipePyToPyTask(object):
-  def __init__(self, arg, pipefd, left, right):
+  def __init__(self, arg, pipefd, cmds, ops):
     self.__arg = arg
     self.__pipefd = pipefd
-    self.__left = left
-    self.__right = right
+    self.__cmds = cmds
+    self.__ops = ops
 
   def start(self, cont):
-    self.__pypipe = PyPipe('PY')
-    cont.call(EvalAstTask(self.__arg,
-                          PipeFd(self.__pipefd, None, self.__pypipe),
-                          self.__left),
-              'left')
-    cont.call(EvalAstTask(self.__arg,
-                          PipeFd(self.__pipefd, self.__pypipe, None),
-                          self.__right),
-              'right')
+    cont.call(EvalAstTask(self.__arg, self.__pipefd, self.__cmds[0]), 0)
 
   def resume(self, cont, state, response):
-    if state == 'left':
-      self.__pypipe.close()
-    else:
-      assert state == 'right'
-      # it's okay?
-      cont.done(response)
+    cmds = self.__cmds
+    ops = self.__ops
+    i = state + 1
+    while i < len(cmds):
+      if ops is not None:
+        ok = response == 0
+        op = ops[i - 1]
+        if (ok and op == '||') or (not ok and op == '&&'):
+          # Skip cmds[i] and keep the last response.
+          i += 1
+          continue
+      cont.call(EvalAstTask(self.__arg, self.__pipefd, cmds[i]), i)
+      return
+    cont.done(response)
 
-  def dispose(self):
-    # close pypipe even if error occurrs.
-    self.__pypipe.close()
 
+class PipelineTask(object):
+  """Runs cmds of Pipeline connecting cmds[i] and cmds[i + 1] with a pipe.
+
+  The pipe is PyPipe if cmds[i] outputs python objects. Otherwise it is an
+  OS pipe."""
 
-class PipeNativeToNativeTask(object):
-  def __init__(self, arg, pipefd, left, right):
+  def __init__(self, arg, pipefd, cmds):
     self.__arg = arg
     self.__pipefd = pipefd
-    self.__left = left
-    self.__right = right
+    self.__cmds = cmds
+    # [r, w] of pipes between cmds. PyPipe is stored to both.
+    self.__pipes = []
 
   def start(self, cont):
-    r, w = self.__arg.ospipe()
-    self.__r = r
-    self.__w = w
-    cont.call(EvalAstTask(self.__arg, PipeFd(self.__pipefd, None, self.__w),
-                          self.__left), 'left')
-    cont.call(EvalAstTask(self.__arg, PipeFd(self.__pipefd, self.__r, None),
-                          self.__right), 'right')
-
-  def __close_r(self):
-    if self.__r is not None:
-      self.__arg.close(self.__r)
-      self.__r = None
-
-  def __close_w(self):
-    if self.__w is not None:
-      self.__arg.close(self.__w)
-      self.__w = None
+    cmds = self.__cmds
+    for i in xrange(len(cmds) - 1):
+      left, right = cmds[i], cmds[i + 1]
+      assert IsFileTypeIO(left.outType) or not IsFileTypeIO(right.inType)
+      if not IsFileTypeIO(left.outType):
+        pypipe = PyPipe('PY')
+        self.__pipes.append([pypipe, pypipe])
+      else:
+        self.__pipes.append(list(self.__arg.ospipe()))
+    last = len(cmds) - 1
+    for i, cmd in enumerate(cmds):
+      stdin = self.__pipes[i - 1][0] if i > 0 else None
+      stdout = self.__pipes[i][1] if i < last else None
+      cont.call(EvalAstTask(self.__arg, PipeFd(self.__pipefd, stdin, stdout),
+                            cmd), i)
+
+  def __close(self, i, end):
+    pipe = self.__pipes[i]
+    if pipe[end] is None:
+      return
+    if isinstance(pipe[end], PyPipe):
+      pipe[end].close()
+    else:
+      self.__arg.close(pipe[end])
+    pipe[end] = None
 
   def resume(self, cont, state, response):
-    if state == 'left':
-      self.__close_w()
-    else:
-      assert state == 'right'
-      self.__close_r()
+    if state == len(self.__cmds) - 1:
       # it's okay?
       cont.done(response)
+      return
+    # Nothing is written to the pipe after cmds[state]. Pipes before it are
+    # not used anymore as well.
+    for i in xrange(state + 1):
+      self.__close(i, 1)
+    for i in xrange(state):
+      self.__close(i, 0)
 
   def dispose(self):
-    # close pipe even if error occurrs.
-    self.__close_w()
-    self.__close_r()
+    # close pipes even if error occurrs.
+    for i in xrange(len(self.__pipes)):
+      self.__close(i, 1)
+      self.__close(i, 0)
 
 
 class AssignTask(object):
@@ -613,39 +682,110 @@ class AssignTask(object):
     cont.done(response)
 
 
+def HasBackQuote(arg):
+  for tok in arg:
+    if tok.kind == BACKQUOTE:
+      return True
+  return False
+
+
+def EvalSubstitution(tok, vardict):
+  if isinstance(tok, CompiledSubstitution):
+    return vardict.eval(tok.code)
+  else:
+    return vardict.eval(SubstitutionExpr(tok.text))
+
+
+def EvalArg(arg, vardict):
+  """Evaluates arg which has no backquote to a list of values."""
+  if not arg:
+    # e.g. backquoted command has no output
+    return []
+  if len(arg) == 1 and arg[0].kind == CONSTANT:
+    return [os.path.expanduser(arg[0].text)]
+  if not HasGlobPattern(arg):
+    return EvalArgNoGlob(arg, vardict)
+  else:
+    return EvalArgGlob(arg, vardict)
+
+
+def EvalArgNoGlob(arg, vardict):
+  values = []
+  for tok in arg:
+    kind = tok.kind
+    if kind == LITERAL or kind == CONSTANT:
+      values.append(tok.text)
+    elif kind == SINGLE_QUOTED_STRING:
+      values.append(eval(tok.text))
+    elif kind == SUBSTITUTION:
+      values.append(EvalSubstitution(tok, vardict))
+    else:
+      raise Exception('Unexpected token: %s' % TOKEN_NAMES[kind])
+  if len(values) > 1:
+    result = ''.join(map(str, values))
+  else:
+    result = values[0]
+  if isinstance(result, str):
+    result = os.path.expanduser(result)
+  return [result]
+
+
+def EvalArgGlob(arg, vardict):
+  values = []
+  for tok in arg:
+    kind = tok.kind
+    if kind == LITERAL:
+      values.append(tok.text)
+    elif kind == CONSTANT:
+      values.append(tok.text.replace('*', '[*]').replace('?', '[?]'))
+    elif kind == SINGLE_QUOTED_STRING:
+      values.append(eval(tok.text).replace('*', '[*]').replace('?', '[?]'))
+    elif kind == SUBSTITUTION:
+      values.append(
+        EvalSubstitution(tok, vardict).replace('*', '[*]').replace('?', '[?]'))
+    else:
+      raise Exception('Unexpected token: %s' % TOKEN_NAMES[kind])
+  result = ''.join(map(str, values))
+  expanded = glob.glob(os.path.expanduser(result))
+  # Make order of glob expansion stable.
+  expanded.sort()
+  return expanded
+
+
 class EvalArgTask(object):
+  """Evaluates an arg which has backquotes.
+
+  Args without backquotes are evaluated by EvalArg directly.
+  """
   def __init__(self, arg, pipefd, target):
     self.__arg = arg
     self.__pipefd = pipefd
     self.__target = target
     self.__result = [None] * len(self.__target)
     self.__pipe = [None] * len(self.__target)
-    self.__thread = [None] * len(self.__target)
-    self.__not_ready = set(range(len(self.__target)))
+    # The number of backquotes which are running.
+    self.__not_ready = 0
 
   def start(self, cont):
-    self.evalBackquotedCmd(cont, self.__arg.globals, self.__arg.locals)
+    self.evalBackquotedCmd(cont)
+    if not self.__not_ready:
+      self.finish(cont)
 
   def resume(self, cont, state, response):
-    i = state[0]
-    if len(state) == 1:
-      self.__result[i] = response
-    else:
-      _, out = state
-      pipe = self.__pipe[i]
-      self.__pipe[i] = None
-      th = self.__thread[i]
-      self.__thread[i] = None
-      self.__arg.close(pipe[1])
-      th.join()
-      self.__arg.close(pipe[0])
-      # backquoted arg is split by white spaces.
-      out = ' '.join(out).split()
-      self.__result[i] = [(SINGLE_QUOTED_STRING, repr(e)) for e in out]
-    self.__not_ready.remove(i)
-    if self.__not_ready:
-      return
-
+    i, out = state
+    pipe = self.__pipe[i]
+    self.__pipe[i] = None
+    self.__arg.close(pipe[1])
+    self.__arg.ioloop.finish_capture(pipe[0])
+    self.__arg.close(pipe[0])
+    # backquoted arg is split by white spaces.
+    out = ' '.join(out).split()
+    self.__result[i] = [Token(CONSTANT, e) for e in out]
+    self.__not_ready -= 1
+    if not self.__not_ready:
+      self.finish(cont)
+
+  def finish(self, cont):
     entry = []
     new_result = [entry]
     for result in self.__result:
@@ -657,106 +797,76 @@ class EvalArgTask(object):
           entry.append(e)
       else:
         entry.append(result)
-    for i, result in enumerate(new_result):
-      new_result[i] = self.evalArg(
-        result, self.__arg.globals, self.__arg.locals)
-    cont.done(reduce(lambda x, y: x + y, new_result))
+    values = []
+    for result in new_result:
+      values.extend(EvalArg(result, self.__arg.vardict))
+    cont.done(values)
 
   def dispose(self):
     for i, pipe in enumerate(self.__pipe):
       if pipe:
-        th = self.__thread[i]
-        assert th
         self.__pipe[i] = None
-        self.__thread[i] = None
         self.__arg.close(pipe[1])
-        # Need stop the thread before close(pipe[0]) to avoid
-        # IO operation conflict
-        th.join()
+        # Need to stop reading pipe[0] before closing it.
+        self.__arg.ioloop.finish_capture(pipe[0])
         self.__arg.close(pipe[0])
 
-  def evalSubstitution(self, value, globals, locals):
-    if value.startswith('${'):
-      # remove ${ and }
-      name = value[2:-1]
-    else:
-      # remove $
-      name = value[1:]
-    # We need to pass VarDict as globals because free variable in lambda is
-    # treated as global variable in eval (http://goo.gl/bfVW9).
-    return eval(name,
-                VarDict(self.__arg.globals, self.__arg.locals), {})
-
-  def evalArg(self, arg, globals, locals):
-    if not arg:
-      # e.g. backquoted command has no output
-      return []
-    if not self.hasGlobPattern(arg):
-      return self.evalArgNoGlob(arg, globals, locals)
-    else:
-      return self.evalArgGlob(arg, globals, locals)
-
-  def evalBackquotedCmd(self, cont, globals, locals):
+  def evalBackquotedCmd(self, cont):
     for i, tok in enumerate(self.__target):
-      if tok[0] == BACKQUOTE:
-        ast = tok[1]
+      if tok.kind == BACKQUOTE:
+        ast = tok.text
         self.__pipe[i] = self.__arg.ospipe()
         r, w = self.__pipe[i]
         out = []
-        th = WriteToPyOutThread(self.__arg.tofile(r), out)
-        self.__thread[i] = th
-        th.start()
+        self.__arg.ioloop.capture(r, out)
+        self.__not_ready += 1
         cont.call(EvalAstTask(self.__arg,
                               PipeFd(self.__pipefd, None, w),
                               ast),
                   (i, out))
       else:
-        cont.call(IdentityTask(tok), (i,))
-  
-  def evalArgNoGlob(self, arg, globals, locals):
-    values = []
-    for tok in arg:
-      if tok[0] == LITERAL:
-        values.append(tok[1])
-      elif tok[0] == SINGLE_QUOTED_STRING:
-        values.append(eval(tok[1]))
-      elif tok[0] == SUBSTITUTION:
-        values.append(self.evalSubstitution(tok[1], globals, locals))
-      else:
-        raise Exception('Unexpected token: %s' % tok[0])
-    if len(values) > 1:
-      result = ''.join(map(str, values))
-    else:
-      result = values[0]
-    if isinstance(result, str):
-      result = os.path.expanduser(result)
-    return [result]
+        self.__result[i] = tok
 
-  def evalArgGlob(self, arg, globals, locals):
-    values = []
-    for tok in arg:
-      if tok[0] == LITERAL:
-        values.append(tok[1])
-      elif tok[0] == SINGLE_QUOTED_STRING:
-        values.append(eval(tok[1]).replace('*', '[*]').replace('?', '[?]'))
-      elif tok[0] == SUBSTITUTION:
-        values.append(
-          self.evalSubstitution(tok[1], globals, locals).replace(
-            '*', '[*]').replace('?', '[?]'))
-      else:
-        raise Exception('Unexpected token: %s' % tok[0])
-    result = ''.join(map(str, values))
-    expanded = glob.glob(os.path.expanduser(result))
-    # Make order of glob expansion stable.
-    expanded.sort()
-    return expanded
-
-  def hasGlobPattern(self, arg):
-    for tok in arg:
-      if tok[0] == LITERAL:
-        if '*' in tok[1] or '?' in tok[1]:
-          return True
-    return False
+
+def ProcessPyCmd(arg, pycmd, args, stdin, reader_type, batch, on_done):
+  """Runs pycmd. Yields its output items, or lists of them if batch.
+
+  on_done is called with the return code after the outputs are consumed.
+  """
+  inType = pycmd.inType() if hasattr(pycmd, 'inType') else None
+  if inType == IOType.No:
+    stdin = None
+  if type(stdin) is int:
+    stdin = arg.tofile(stdin)
+    if batch and inType != IOType.File:
+      stdin = FileBatches(stdin)
+  elif batch and stdin is not None:
+    stdin = stdin.batches()
+  no_output = hasattr(pycmd, 'outType') and pycmd.outType() == IOType.No
+  try:
+    output = pycmd(args, stdin, PyCmdOption(arg.globals, arg.locals))
+    if reader_type == 'ST' and hasattr(output, 'pretty_print'):
+      io = StringIO.StringIO()
+      output.pretty_print(io)
+      printed = io.getvalue().rstrip('\r\n')
+      yield [printed] if batch else printed
+    else:
+      if reader_type == 'ST' and hasattr(output, 'encoded_batches'):
+        output = output.encoded_batches()
+        if not batch:
+          output = itertools.chain.from_iterable(output)
+      elif batch and hasattr(output, 'batches'):
+        output = output.batches()
+      for e in output:
+        if no_output and (e or not batch):
+          raise Exception('A pycmd with [outType= No] outputs something.')
+        else:
+          yield e
+    rc = 0
+  except Exception, e:
+    traceback.print_exc(file=sys.stderr)
+    rc = 1
+  on_done(rc)
 
 
 class EvalProcessTask(object):
@@ -769,49 +879,34 @@ class EvalProcessTask(object):
     self.__pycmd_redirect_th = None
 
     self.__pyout_rs = set()
-    self.__pyout_thread = []
 
     self.__evaled_args = None
-    self.__evaled_args_not_ready = None
     self.__evaled_redirects = None
-    self.__evaled_redirects_not_ready = None
+    # The number of args and redirects evaluated by EvalArgTask.
+    self.__not_ready = 0
 
   def resume(self, cont, state, response):
-    invoke_if_ready = False
-    if isinstance(state, tuple) and len(state) == 2 and state[0] == 'evalarg':
-      self.__evaled_args[state[1]] = response
-      self.__evaled_args_not_ready.remove(state[1])
-      invoke_if_ready = True
-
-    elif isinstance(state, tuple) and len(state) == 2 and (
-      state[0] == 'putredirect'):
-      self.__evaled_redirects[state[1]] = response
-      self.__evaled_redirects_not_ready.remove(state[1])
-      invoke_if_ready = True
-
-    elif isinstance(state, tuple) and len(state) == 3 and (
-      state[0] == 'evalredirect'):
-      redirect = state[2]
-      self.__evaled_redirects[state[1]] = (
-        redirect[0], redirect[1], 'file', str(response[0]))
-      self.__evaled_redirects_not_ready.remove(state[1])
-      invoke_if_ready = True
-
-    if invoke_if_ready:
-      if not self.__evaled_args_not_ready and (
-        not self.__evaled_redirects_not_ready):
+    if isinstance(state, tuple):
+      if state[0] == 'evalarg':
+        self.__evaled_args[state[1]] = response
+      else:
+        assert state[0] == 'evalredirect'
+        redirect = state[2]
+        self.__evaled_redirects[state[1]] = (
+          redirect[0], redirect[1], 'file', str(response[0]))
+      self.__not_ready -= 1
+      if not self.__not_ready:
         self.invokeProcess(cont)
       return
-    
+
     assert state == 'pycmd_done' or state == 'cmd_done'
     if self.__pycmd_redirect_th:
       self.__pycmd_redirect_th.join()
     if self.__pycmd_redirect_out:
       self.__arg.close(self.__pycmd_redirect_out.fileno())
       self.__pycmd_redirect_out = None
-    for th in self.__pyout_thread:
-      th.join()
     for r in self.__pyout_rs:
+      self.__arg.ioloop.finish_capture(r)
       self.__arg.close(r)
     self.__pyout_rs = None
     cont.done(response)
@@ -821,37 +916,10 @@ class EvalProcessTask(object):
       self.__arg.close(self.__pycmd_redirect_out.fileno())
       self.__pycmd_redirect_out = None
     for r in self.__pyout_rs:
+      self.__arg.ioloop.finish_capture(r)
       self.__arg.close(r)
     self.__pyout_rs = None
 
-  def processPyCmd(self, cont, pycmd, args, stdin, reader_type):
-    if hasattr(pycmd, 'inType') and pycmd.inType() == IOType.No:
-      stdin = None
-    if type(stdin) is int:
-      stdin = self.__arg.tofile(stdin)
-    no_output = hasattr(pycmd, 'outType') and pycmd.outType() == IOType.No
-    try:
-      output = pycmd(args, stdin,
-                     PyCmdOption(self.__arg.globals, self.__arg.locals))
-      if reader_type == 'ST' and hasattr(output, 'pretty_print'):
-        io = StringIO.StringIO()
-        output.pretty_print(io)
-        yield io.getvalue().rstrip('\r\n')
-      else:
-        for e in output:
-          if no_output:
-            raise Exception('A pycmd with [outType= No] outputs something.')
-          else:
-            yield e
-      rc = 0
-    except Exception, e:
-      traceback.print_exc(file=sys.stderr)
-      rc = 1
-    self.__arg.condition.acquire()
-    self.__arg.write_done.append((cont, 'pycmd_done', rc))
-    self.__arg.condition.notify()
-    self.__arg.condition.release()
-
   def convertToCmdArgs(self, arg):
     if isinstance(arg, list):
       return map(str, arg)
@@ -859,23 +927,48 @@ class EvalProcessTask(object):
       return [str(arg)]
 
   def start(self, cont):
+    self.evalArgs(cont)
+    if not self.__not_ready:
+      self.invokeProcess(cont)
+
+  def spawn(self):
+    """Starts the native command without tasks and returns its pid.
+
+    The command must not be a pycmd nor have backquotes or =>.
+    """
+    self.evalArgs(None)
+    args = []
+    for arg in self.__evaled_args:
+      args.extend(arg)
+    return self.startNative(args, self.__evaled_redirects, ())
+
+  def evalArgs(self, cont):
+    # Args and redirects without backquotes are evaluated here. Only the
+    # ones with backquotes need tasks to run the backquoted commands.
     proc = self.__proc
-    self.__evaled_args = [None] * len(proc.args)
-    self.__evaled_args_not_ready = set(range(len(proc.args)))
-    self.__evaled_redirects = [None] * len(proc.redirects)
-    self.__evaled_redirects_not_ready = set(range(len(proc.redirects)))
+    vardict = self.__arg.vardict
+    evaled_args = [None] * len(proc.args)
+    evaled_redirects = [None] * len(proc.redirects)
+    self.__evaled_args = evaled_args
+    self.__evaled_redirects = evaled_redirects
     for i, arg in enumerate(proc.args):
-      cont.call(EvalArgTask(self.__arg, self.__pipefd, arg), ('evalarg', i))
+      if HasBackQuote(arg):
+        self.__not_ready += 1
+        cont.call(EvalArgTask(self.__arg, self.__pipefd, arg), ('evalarg', i))
+      else:
+        evaled_args[i] = EvalArg(arg, vardict)
     for i, redirect in enumerate(proc.redirects):
       if redirect[0] == '=>':
-        cont.call(IdentityTask((False, 1, 'pyout', redirect[1])),
-                  ('putredirect', i))
+        evaled_redirects[i] = (False, 1, 'pyout', redirect[1])
       elif isinstance(redirect[2], int):
-        cont.call(IdentityTask((redirect[0], redirect[1], 'num', redirect[2])),
-                  ('putredirect', i))
-      else:
+        evaled_redirects[i] = (redirect[0], redirect[1], 'num', redirect[2])
+      elif HasBackQuote(redirect[2]):
+        self.__not_ready += 1
         cont.call(EvalArgTask(self.__arg, self.__pipefd, redirect[2]),
-                  (('evalredirect', i, redirect)))
+                  ('evalredirect', i, redirect))
+      else:
+        evaled_redirects[i] = (redirect[0], redirect[1], 'file',
+                               str(EvalArg(redirect[2], vardict)[0]))
 
   def invokeCmd(self, cont):
     cmd = self.__proc.cmd
@@ -893,6 +986,9 @@ class EvalProcessTask(object):
     redirects = self.__evaled_redirects
     pycmd = get_pycmd(args[0])
     if pycmd:
+      batch = IsBatchPyCmd(pycmd)
+      ioloop = self.__arg.ioloop
+      on_done = lambda rc: ioloop.post((cont, 'pycmd_done', rc))
       assert len(redirects) < 2
       if redirects:
         redirect = redirects[0]
@@ -904,22 +1000,29 @@ class EvalProcessTask(object):
           else:
             mode = 'w'  # >
           self.__pycmd_redirect_out = self.__arg.filew(redirect[3], mode)
+          output = ProcessPyCmd(self.__arg, pycmd, args, self.__pipefd.stdin,
+                                'ST', batch, on_done)
+          if not batch:
+            output = batches(output)
           self.__pycmd_redirect_th = WritePyCmdRedirectThread(
-            self.processPyCmd(cont, pycmd, args, self.__pipefd.stdin, 'ST'),
-            self.__pycmd_redirect_out)
+            output, self.__pycmd_redirect_out)
           self.__pycmd_redirect_th.start()
         else:
           assert redirect[2] == 'pyout'
           pyout_list = []
           self.__arg.rc[redirect[3]] = pyout_list
+          output = ProcessPyCmd(self.__arg, pycmd, args, self.__pipefd.stdin,
+                                'PY', batch, on_done)
+          if batch:
+            output = itertools.chain.from_iterable(output)
           self.__pycmd_redirect_th = WritePyCmdRedirectPyOutThread(
-            self.processPyCmd(cont, pycmd, args, self.__pipefd.stdin, 'PY'),
-            pyout_list)
+            output, pyout_list)
           self.__pycmd_redirect_th.start()
       else:
         self.__pipefd.stdout.add_generator(
-          self.processPyCmd(cont, pycmd, args, self.__pipefd.stdin,
-                            self.__pipefd.stdout.reader_type()))
+          ProcessPyCmd(self.__arg, pycmd, args, self.__pipefd.stdin,
+                       self.__pipefd.stdout.reader_type(), batch, on_done),
+          batch)
       return
 
     pyout_ws = set()
@@ -932,56 +1035,320 @@ class EvalProcessTask(object):
       self.__pyout_rs.add(pyout_r)
       pyout_ws.add(pyout_w)
       redirects[i] = (redirect[0], redirect[1], redirect[2], pyout_w)
-      th = WriteToPyOutThread(self.__arg.tofile(pyout_r), pyout_list)
-      th.start()
-      self.__pyout_thread.append(th)
-
+      self.__arg.ioloop.capture(pyout_r, pyout_list)
+
+    pid = self.startNative(args, redirects, pyout_ws)
+    for pyout_w in pyout_ws:
+      self.__arg.close(pyout_w)
+    ioloop = self.__arg.ioloop
+    ioloop.watch_child(pid, lambda rc: ioloop.post((cont, 'cmd_done', rc)))
+
+  def startNative(self, args, redirects, pyout_ws):
+    str_args = []
+    for arg in args:
+      str_args.extend(self.convertToCmdArgs(arg))
+    pid = None
+    if spawn.available():
+      pid = self.spawnProcess(str_args, redirects, pyout_ws)
+    if pid is None:
+      pid = self.forkProcess(str_args, redirects, pyout_ws)
+    return pid
+
+  def spawnProcess(self, str_args, redirects, pyout_ws):
+    """Starts a native command with posix_spawnp.
+
+    The setup of fds is the same as forkProcess. Returns None if forkProcess
+    should be used instead. Errors are left to forkProcess so that the
+    child reports them to its (redirected) stderr.
+    """
+    files = []
+    targets = set(redirect[1] for redirect in redirects)
+    actions = spawn.FileActions()
+    try:
+      stdin = self.__pipefd.stdin
+      stdout = self.__pipefd.stdout
+      for fd in self.__arg.all_w:
+        if fd != stdout and fd not in pyout_ws:
+          actions.close(fd)
+      for fd in self.__arg.all_r:
+        if fd != stdin:
+          actions.close(fd)
+      if stdout and stdout != sys.stdout.fileno():
+        actions.dup2(stdout, sys.stdout.fileno())
+      if stdin and stdin != sys.stdin.fileno():
+        actions.dup2(stdin, sys.stdin.fileno())
+      for redirect in redirects:
+        if redirect[2] == 'num' or redirect[2] == 'pyout':
+          if redirect[3] != redirect[1]:
+            actions.dup2(redirect[3], redirect[1])
+        else:
+          if redirect[0]:
+            mode = 'a'  # >>
+          else:
+            mode = 'w'  # >
+          f = file(redirect[3], mode)
+          files.append(f)
+          if f.fileno() in targets:
+            # The fd would be overwritten by another redirect before it is
+            # used. The child opens files one by one after fork.
+            return None
+          actions.dup2(f.fileno(), redirect[1])
+          actions.close(f.fileno())
+      # Close fds inherited from pysh which are not tracked by TaskArg.
+      actions.closefrom(max([sys.stderr.fileno()] + list(targets)) + 1)
+      pid = spawn.spawnp(str_args, actions)
+    except EnvironmentError:
+      # e.g. The command is not found or a file can not be opened.
+      return None
+    finally:
+      actions.destroy()
+      for f in files:
+        f.close()
+    self.__arg.after_fork(pid)
+    return pid
+
+  def forkProcess(self, str_args, redirects, pyout_ws):
     pid = os.fork()
     if pid != 0:
       self.__arg.after_fork(pid)
-      for pyout_w in pyout_ws:
-        self.__arg.close(pyout_w)
-      def process_done_callback(rc):
-        self.__arg.condition.acquire()
-        self.__arg.write_done.append((cont, 'cmd_done', rc))
-        self.__arg.condition.notify()
-        self.__arg.condition.release()
-      global_wait_thread.register_callback(pid, process_done_callback)
-    else:
-      try:
-        self.__arg.after_fork(0)
-        for fd in self.__arg.all_w:
-          if fd != self.__pipefd.stdout and fd not in pyout_ws:
-            os.close(fd)
-        for fd in self.__arg.all_r:
-          if fd != self.__pipefd.stdin:
-            os.close(fd)
-        if self.__pipefd.stdout:
-          # dup2 does nothing args are same.
-          os.dup2(self.__pipefd.stdout, sys.stdout.fileno())
-        if self.__pipefd.stdin:
-          os.dup2(self.__pipefd.stdin, sys.stdin.fileno())
-        for redirect in redirects:
-          if redirect[2] == 'num':
-            os.dup2(redirect[3], redirect[1])
-          elif redirect[2] == 'pyout':
-            os.dup2(redirect[3], redirect[1])
+      return pid
+    try:
+      self.__arg.after_fork(0)
+      for fd in self.__arg.all_w:
+        if fd != self.__pipefd.stdout and fd not in pyout_ws:
+          os.close(fd)
+      for fd in self.__arg.all_r:
+        if fd != self.__pipefd.stdin:
+          os.close(fd)
+      if self.__pipefd.stdout:
+        # dup2 does nothing args are same.
+        os.dup2(self.__pipefd.stdout, sys.stdout.fileno())
+      if self.__pipefd.stdin:
+        os.dup2(self.__pipefd.stdin, sys.stdin.fileno())
+      for redirect in redirects:
+        if redirect[2] == 'num':
+          os.dup2(redirect[3], redirect[1])
+        elif redirect[2] == 'pyout':
+          os.dup2(redirect[3], redirect[1])
+        else:
+          if redirect[0]:
+            mode = 'a'  # >>
           else:
-            if redirect[0]:
-              mode = 'a'  # >>
-            else:
-              mode = 'w'  # >
-            f = file(redirect[3], mode)
-            os.dup2(f.fileno(), redirect[1])
-        str_args = []
-        for arg in args:
-          str_args.extend(self.convertToCmdArgs(arg))
-        os.execvp(str_args[0], str_args)
-      except Exception, e:
-        self.__arg.exec_fail(e)
-        print >> sys.stderr, e
-        sys.stderr.flush()
-        os._exit(1)
+            mode = 'w'  # >
+          f = file(redirect[3], mode)
+          os.dup2(f.fileno(), redirect[1])
+      os.execvp(str_args[0], str_args)
+    except Exception, e:
+      self.__arg.exec_fail(e)
+      print >> sys.stderr, e
+      sys.stderr.flush()
+      os._exit(1)
+
+
+def IsNativeAst(ast, vardict):
+  """Returns True if ast only runs native commands without backquotes or =>.
+
+  Such an ast is run by RunNativeAst without tasks.
+  """
+  if isinstance(ast, Process):
+    if ast.inType != 'ST' or ast.outType != 'ST':
+      return False
+    arg0 = ast.args[0]
+    if len(arg0) != 1 or not isinstance(GetArg0Name(arg0[0], vardict), str):
+      # The command may be a pycmd given by an expression.
+      return False
+    for arg in ast.args:
+      if HasBackQuote(arg):
+        return False
+    for redirect in ast.redirects:
+      if redirect[0] == '=>' or (not isinstance(redirect[2], int) and
+                                 HasBackQuote(redirect[2])):
+        return False
+    return True
+  elif isinstance(ast, Pipeline):
+    # Other asts in a pipeline must run concurrently.
+    for cmd in ast.cmds:
+      if not isinstance(cmd, Process) or not IsNativeAst(cmd, vardict):
+        return False
+    return True
+  elif isinstance(ast, Assign):
+    return IsNativeAst(ast.cmd, vardict)
+  elif isinstance(ast, Sequence) or isinstance(ast, AndOr):
+    for cmd in ast.cmds:
+      if not IsNativeAst(cmd, vardict):
+        return False
+    return True
+  return False
+
+
+def RunNativeAst(arg, pipefd, ast):
+  """Runs ast checked by IsNativeAst in the calling thread.
+
+  Commands of a pipeline are started at once, then waited for with
+  waitpid. Returns the exit status of the last command.
+  """
+  if isinstance(ast, Process):
+    return WaitPids(
+      [EvalProcessTask(arg, pipefd, ast).spawn()])
+  elif isinstance(ast, Pipeline):
+    pids = []
+    try:
+      r = None
+      last = len(ast.cmds) - 1
+      for i, cmd in enumerate(ast.cmds):
+        w = None
+        if i < last:
+          next_r, w = arg.ospipe()
+        pids.append(EvalProcessTask(arg, PipeFd(pipefd, r, w), cmd).spawn())
+        if r is not None:
+          arg.close(r)
+          r = None
+        if w is not None:
+          arg.close(w)
+          r = next_r
+    except:
+      orphans.update(pids)
+      raise
+    finally:
+      for fd in list(arg.all_r) + list(arg.all_w):
+        arg.close(fd)
+    return WaitPids(pids)
+  elif isinstance(ast, Assign):
+    rc = RunNativeAst(arg, pipefd, ast.cmd)
+    arg.rc[ast.name] = rc
+    return rc
+  else:
+    cmds = ast.cmds
+    ops = ast.ops if isinstance(ast, AndOr) else None
+    rc = RunNativeAst(arg, pipefd, cmds[0])
+    for i in xrange(1, len(cmds)):
+      if ops is not None:
+        ok = rc == 0
+        op = ops[i - 1]
+        if (ok and op == '||') or (not ok and op == '&&'):
+          continue
+      rc = RunNativeAst(arg, pipefd, cmds[i])
+    return rc
+
+
+def WaitPids(pids):
+  """Waits for pids and returns the status of the last one."""
+  for i, pid in enumerate(pids):
+    try:
+      status = WaitPid(pid, 0)
+    except:
+      orphans.update(pids[i:])
+      raise
+  return status
+
+
+def FusiblePyCmds(ast):
+  """Returns (procs, var) if ast is a pipeline of pycmds only, or None.
+
+  var is the name given with -> or None. The pipeline doesn't start any
+  process, so RunPyCmdPipeline runs it in the calling thread.
+  """
+  if not isinstance(ast, ProxyPyOutToNative):
+    return None
+  ast = ast.ast
+  var = None
+  if isinstance(ast, Assign):
+    var = ast.name
+    ast = ast.cmd
+  if isinstance(ast, Process):
+    procs = [ast]
+  elif isinstance(ast, Pipeline):
+    procs = ast.cmds
+  else:
+    return None
+  last = len(procs) - 1
+  for i, proc in enumerate(procs):
+    # Native commands and pycmds reading or writing files have ST inType or
+    # outType.
+    if not isinstance(proc, Process):
+      return None
+    if proc.inType != 'PY' and not (i == 0 and proc.inType == 'NO'):
+      return None
+    if proc.outType != 'PY' and not (i == last and proc.outType == 'NO'):
+      return None
+    for arg in proc.args:
+      if HasBackQuote(arg):
+        return None
+    redirects = proc.redirects
+    if redirects and (i < last or len(redirects) > 1):
+      return None
+    for redirect in redirects:
+      if redirect[0] != '=>' and (redirect[1] != 1 or
+                                  isinstance(redirect[2], int) or
+                                  HasBackQuote(redirect[2])):
+        return None
+  return procs, var
+
+
+def RunPyCmdPipeline(arg, procs, var):
+  """Runs procs returned by FusiblePyCmds as a chain of generators.
+
+  Outputs are consumed in the calling thread, so no task, thread or IOLoop
+  is used. Returns the return code of the last pycmd.
+  """
+  vardict = arg.vardict
+  cmds = []
+  for proc in procs:
+    args = []
+    for a in proc.args:
+      args.extend(EvalArg(a, vardict))
+    pycmd = get_pycmd(args[0])
+    assert pycmd
+    cmds.append((pycmd, args))
+  redirects = procs[-1].redirects
+  out = None
+  if not redirects:
+    out = sys.stdout
+  elif redirects[0][0] != '=>':
+    path = str(EvalArg(redirects[0][2], vardict)[0])
+    out = file(path, 'a' if redirects[0][0] else 'w')
+
+  result = []
+  last = len(cmds) - 1
+  output = None
+  for i, (pycmd, args) in enumerate(cmds):
+    stdin = sys.stdin.fileno()
+    if output is not None:
+      stdin = PyPipe('PY')
+      stdin.add_generator(output, batch)
+      stdin.close()
+    batch = IsBatchPyCmd(pycmd)
+    if i < last:
+      output = ProcessPyCmd(arg, pycmd, args, stdin, 'PY', batch,
+                            lambda rc: None)
+    else:
+      output = ProcessPyCmd(arg, pycmd, args, stdin,
+                            'ST' if out else 'PY', batch, result.append)
+  if out is None:
+    if batch:
+      output = itertools.chain.from_iterable(output)
+    pyout_list = []
+    arg.rc[redirects[0][1]] = pyout_list
+    pyout_list.extend(output)
+  else:
+    if not batch:
+      output = batches(output)
+    try:
+      write_records(output, out)
+    except (IOError, OSError), e:
+      # The reader exited early, e.g. a script run as `pysh s.pysh | head -1`.
+      # The rest of the output is discarded and the caller goes on as it did
+      # when a thread wrote the output.
+      if e.errno != errno.EPIPE:
+        raise
+    finally:
+      if out is not sys.stdout:
+        out.close()
+  # The last pycmd did not finish if its output was discarded.
+  rc = result[0] if result else 0
+  if var is not None:
+    arg.rc[var] = rc
+  return rc
 
 
 class Evaluator(object):
@@ -1001,57 +1368,79 @@ class Evaluator(object):
     return self.__rc
 
   def execute(self, globals, locals):
-    ast = self.__parser.parse()
-    ast = DiagnoseIOType(ast, VarDict(globals, locals))
-    self.executeAst(ast, globals, locals)
-
-  def executeAst(self, ast, globals, locals):
+    self.executeParsed(self.__parser.parse(), globals, locals)
+
+  def executeParsed(self, ast, globals, locals):
+    vardict = VarDict(globals, locals)
+    # DiagnoseIOType modifies ast.
+    ast = DiagnoseIOType(ast, vardict)
+    self.executeAst(ast, globals, locals, vardict)
+
+  def executeAst(self, ast, globals, locals, vardict):
+    fused = FusiblePyCmds(ast)
+    if fused or IsNativeAst(ast, vardict):
+      arg = TaskArg(self.__rc, [], None,
+                    self.__after_folk,
+                    self.__exec_fail,
+                    globals, locals, vardict)
+      if fused:
+        RunPyCmdPipeline(arg, *fused)
+      else:
+        RunNativeAst(arg, PipeFd(None, sys.stdin.fileno(),
+                                 sys.stdout.fileno()), ast)
+      return
     # TODO: Fix exception handling.
     pool = []
-    cond = threading.Condition()
-    write_done = []
+    ioloop = IOLoop()
     arg = TaskArg(self.__rc, pool,
-                  write_done, cond,
+                  ioloop,
                   self.__after_folk,
                   self.__exec_fail,
-                  globals, locals)
+                  globals, locals, vardict)
     runner = Runner(
       EvalAstTask(arg,
                   PipeFd(None, sys.stdin.fileno(), sys.stdout.fileno()),
                   ast))
-    runner.run()
-    while not runner.done:
-      cond.acquire()
-      while len(write_done) == 0:
-        cond.wait()
-      cont, state, rc = write_done.pop()
-      cond.release()
-      cont.call(IdentityTask(rc), state)
+    try:
       runner.run()
+      while not runner.done:
+        for cont, state, rc in ioloop.wait():
+          cont.resume(state, rc)
+          runner.run()
+    finally:
+      ioloop.close()
 
 
-def start_global_wait_thread():
-  global global_wait_thread
-  if global_wait_thread:
-    return
-  global_wait_thread_lock.acquire()
-  if not global_wait_thread:
-    global_wait_thread = WaitChildThread()
-    global_wait_thread.start()
-    atexit.register(stop_global_wait_thread)
-  global_wait_thread_lock.release()
+def parse(cmd_str, alias_map=None, alias_version=None):
+  return FoldConstants(Parser(Tokenizer(cmd_str, alias_map=alias_map,
+                                        alias_version=alias_version)).parse())
 
 
-def stop_global_wait_thread():
-  assert global_wait_thread
-  global_wait_thread.stop()
-  global_wait_thread.join()
+# {(cmd_str, alias map version): ast}
+parse_cache = LRUCache(PARSE_CACHE_SIZE)
+
+
+def parse_cached(cmd_str, alias_map=None):
+  """Same as parse but reuses results of previous calls.
+
+  The returned ast is shared. Don't modify it (use run_ast to run it)."""
+  version = alias_map_versions.version(alias_map) if alias_map else None
+  key = (cmd_str, version)
+  ast = parse_cache.get(key)
+  if ast is None:
+    ast = parse(cmd_str, alias_map, version)
+    parse_cache.put(key, ast)
+  return ast
 
 
 def run(cmd_str, globals, locals, alias_map=None):
-  start_global_wait_thread()
-  tok = Tokenizer(cmd_str, alias_map=alias_map)
-  parser = Parser(tok)
-  evaluator = Evaluator(parser)
-  evaluator.execute(globals, locals)
+  return run_ast(parse_cached(cmd_str, alias_map), globals, locals)
+
+
+def run_ast(ast, globals, locals):
+  """Runs ast returned by parse.
+
+  ast is not modified, so it can be parsed once and run many times."""
+  evaluator = Evaluator(None)
+  evaluator.executeParsed(CopyAst(ast), globals, locals)
   return evaluator.rc()
@@ -0,0 +1,76 @@
+"""Benchmark of pipelines of pycmds."""
+
+import pysh.shell.builtin
+from pysh.benchlib import measure
+from pysh.benchlib import report
+from pysh.shell.evaluator import PyPipe
+from pysh.shell.evaluator import parse
+from pysh.shell.evaluator import run_ast
+
+ITEMS = 200000
+
+
+def gen(args, input, options):
+  return xrange(ITEMS)
+
+
+def inc(args, input, options):
+  for e in input:
+    yield e + 1
+
+
+def count(args, input, options):
+  n = 0
+  for _ in input:
+    n += 1
+  yield n
+
+
+def read_pypipe(generators, items):
+  pipe = PyPipe('PY')
+  for _ in xrange(generators):
+    pipe.add_generator(iter(xrange(items)))
+  pipe.close()
+  for _ in pipe:
+    pass
+
+
+def main():
+  results = []
+  for generators, items in ((1, ITEMS), (ITEMS / 10, 10)):
+    elapsed = measure(lambda: read_pypipe(generators, items))
+    results.append(('pypipe_%d_generators_items_per_sec' % generators,
+                    ITEMS / elapsed, 'items/s'))
+  variables = {'gen': gen, 'inc': inc, 'count': count}
+  variables['data'] = range(ITEMS)
+  variables['f'] = lambda x: x + 1
+  for name, cmd in (('pipeline_2', '$gen | $count => out'),
+                    ('pipeline_5', '$gen | $inc | $inc | $inc | $count => out'),
+                    ('builtin_pipeline',
+                     'echo $data | map $f | filter $f | map $f => out'),
+                    ('to_native', 'echo $data | cat > /dev/null'),
+                    ('to_file', 'echo $data > /dev/null')):
+    ast = parse(cmd)
+    elapsed = measure(lambda: run_ast(ast, variables, {}), repeat=3)
+    results.append(('%s_items_per_sec' % name, ITEMS / elapsed, 'items/s'))
+  variables['small'] = range(10)
+  for name, cmd in (('small_pipeline', 'echo $small | map $f | filter $f => out'),
+                    ('small_pipeline_to_file', 'echo $small | map $f > /dev/null')):
+    ast = parse(cmd)
+    def run_100():
+      for _ in xrange(100):
+        run_ast(ast, variables, {})
+    results.append((name, measure(run_100) / 100, 's'))
+  for name, cmd in (('true', 'true'),
+                    ('true_pipeline_3', 'true | true | true')):
+    ast = parse(cmd)
+    def run_100():
+      for _ in xrange(100):
+        run_ast(ast, {}, {})
+    results.append(('%s_commands_per_sec' % name, 100 / measure(run_100),
+                    'commands/s'))
+  report('evaluator', results)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,11 +1,22 @@
+import itertools
 import os
+import pty
+import select
 import shutil
+import subprocess
+import sys
 import tempfile
+import threading
 import unittest
 
 import pysh.shell
+import pysh.shell.evaluator
 from pysh.shell.evaluator import DiagnoseIOType
+from pysh.shell.evaluator import PyPipe
+from pysh.shell.evaluator import VarDict
+from pysh.shell.evaluator import parse
 from pysh.shell.evaluator import run
+from pysh.shell.evaluator import run_ast
 from pysh.shell.pycmd import register_pycmd, IOType, PyCmd
 from pysh.shell.parser import Parser
 from pysh.shell.tokenizer import Tokenizer
@@ -72,6 +83,98 @@ def PyCmdExample(args, input, options):
 
 register_pycmd('pycmd', PyCmdExample)
 
+class VarDictTest(unittest.TestCase):
+  def setUp(self):
+    os.environ['YUNABE_PYSH_TEST_VAR'] = 'env'
+    self.globals = {'g': 'global', 'x': 'global x',
+                    'YUNABE_PYSH_TEST_VAR': 'global env'}
+    self.locals = {'l': 'local', 'x': 'local x'}
+    self.vardict = VarDict(self.globals, self.locals)
+
+  def tearDown(self):
+    del os.environ['YUNABE_PYSH_TEST_VAR']
+
+  def testLookup(self):
+    self.assertEquals('local x', self.vardict['x'])
+    self.assertEquals('global', self.vardict['g'])
+    self.assertEquals('global env', self.vardict['YUNABE_PYSH_TEST_VAR'])
+    self.assertEquals('env', VarDict({}, {})['YUNABE_PYSH_TEST_VAR'])
+    self.assertRaises(KeyError, lambda: self.vardict['undefined'])
+    self.assertEquals(None, self.vardict.get('undefined'))
+    self.assertTrue('l' in self.vardict)
+    self.assertFalse('undefined' in self.vardict)
+
+  def testNotCopied(self):
+    self.globals['g'] = 'modified'
+    self.assertEquals('modified', self.vardict['g'])
+
+  def testEval(self):
+    self.assertEquals('local x/global', self.vardict.eval('x + "/" + g'))
+    self.assertEquals(3, self.vardict.eval('len(l) - 2'))
+    self.assertRaises(NameError, lambda: self.vardict.eval('undefined'))
+
+  def testEvalListComprehension(self):
+    self.assertEquals(['local', 'local'],
+                      self.vardict.eval('[l for i in range(2)]'))
+    # The loop variable doesn't leak to the next evaluation.
+    self.assertRaises(NameError, lambda: self.vardict.eval('i'))
+
+  def testEvalNestedCode(self):
+    self.assertEquals(['local x', 'local x'],
+                      self.vardict.eval('map(lambda i: x, range(2))'))
+    self.assertEquals(['global', 'global'],
+                      list(self.vardict.eval('(g for i in range(2))')))
+
+
+class PyPipeTest(unittest.TestCase):
+  def testOrder(self):
+    pipe = PyPipe('PY')
+    pipe.add_generator(iter([1, 2]))
+    pipe.add_generator(iter([]))
+    pipe.add_generator(iter([3]))
+    pipe.close()
+    self.assertEquals([1, 2, 3], list(pipe))
+
+  def testAddWhileReading(self):
+    pipe = PyPipe('PY')
+    def write():
+      for i in xrange(100):
+        pipe.add_generator(iter([i]))
+      pipe.close()
+    th = threading.Thread(target=write)
+    th.start()
+    self.assertEquals(range(100), list(pipe))
+    th.join()
+
+  def testStats(self):
+    pipe = PyPipe('PY')
+    pipe.add_generator(iter([1]))
+    pipe.add_generator(iter([2]))
+    pipe.close()
+    self.assertEquals({'depth': 2, 'max_depth': 2, 'generators': 2},
+                      pipe.stats())
+    list(pipe)
+    self.assertEquals({'depth': 0, 'max_depth': 2, 'generators': 2},
+                      pipe.stats())
+
+  def testBatches(self):
+    pipe = PyPipe('PY')
+    pipe.add_generator(iter([[1, 2], [], [3]]), batch=True)
+    pipe.add_generator(iter(xrange(4, 7)))
+    pipe.add_generator(xrange(7, 10))
+    pipe.close()
+    # Items of iterators are not accumulated because they may come slowly.
+    self.assertEquals([[1, 2], [], [3], [4], [5], [6], [7, 8, 9]],
+                      list(pipe.batches()))
+
+  def testItemsOfBatches(self):
+    pipe = PyPipe('PY')
+    pipe.add_generator(iter([[1, 2], [], [3]]), batch=True)
+    pipe.add_generator(iter([4]))
+    pipe.close()
+    self.assertEquals([1, 2, 3, 4], list(pipe))
+
+
 class TempDir(object):
   def __init__(self):
     self.path = None
@@ -150,6 +253,13 @@ class RunTest(unittest.TestCase):
         globals(), locals())
     self.assertEquals('{3: [22]}\n', file('out.txt').read())
 
+  def testExpressionInLoop(self):
+    ast = parse('echo ${i * 2}"/$name" >> out.txt')
+    for i in xrange(3):
+      name = 'x%d' % i
+      run_ast(ast, globals(), locals())
+    self.assertEquals('0/x0\n2/x1\n4/x2\n', file('out.txt').read())
+
   def testListComprehension(self):
     def tmp(args, input, options):
       return [x * x for x in xrange(3)]
@@ -317,11 +427,106 @@ class RunTest(unittest.TestCase):
              globals(), locals())
     self.assertEquals('foo\nbar\n', file('out.txt').read())
 
+  def testAndOrChain(self):
+    run('python -c "import sys;sys.exit(1)" && echo a >> out.txt || '
+        'echo b >> out.txt && echo c >> out.txt || echo d >> out.txt',
+        globals(), locals())
+    self.assertEquals('b\nc\n', file('out.txt').read())
+
+  def testLongPipeline(self):
+    file('tmp.txt', 'w').write('a\nb\n')
+    run('cat tmp.txt' + ' | pycmd | cat' * 20 + ' > out.txt',
+        globals(), locals())
+    self.assertEquals('pycmd\n' * 20 + 'a\nb\n',
+                      file('out.txt').read())
+
+  def testLongChain(self):
+    def tmp(args, input, options):
+      return args[1:]
+    rc = run('($tmp' + ' && $tmp' * 2000 + ') -> rc' +
+             '; $tmp 2 >> out.txt' * 2000, globals(), locals())
+    self.assertEquals(0, rc['rc'])
+    self.assertEquals('2\n' * 2000, file('out.txt').read())
+
+  def testOtherChildNotReaped(self):
+    # Children which are not started by pysh are left to their owners.
+    proc = subprocess.Popen(['python', '-c', 'import sys; sys.exit(3)'])
+    run('python -c "import time; time.sleep(0.2)"', globals(), locals())
+    self.assertEquals(3, proc.wait())
+
+  def testPyCmdPipelineToClosedPipe(self):
+    # The reader exits before the infinite output of gen is written.
+    gen = lambda args, input, options: itertools.count()
+    inc = lambda args, input, options: (x + 1 for x in input)
+    r, w = os.pipe()
+    os.close(r)
+    stdout = sys.stdout
+    sys.stdout = os.fdopen(w, 'w')
+    try:
+      rc = run('$gen | $inc -> rc', globals(), locals())
+    finally:
+      sys.stdout = stdout
+    self.assertEquals(0, rc['rc'])
+
+  def testSlowPyCmdToTerminal(self):
+    master, slave = pty.openpty()
+    def gen(args, input, options):
+      for i in xrange(3):
+        yield i
+        # The previous line must be shown before the next item is produced.
+        readable, _, _ = select.select([master], [], [], 5.0)
+        received.append(os.read(master, 1024) if readable else None)
+    empty = lambda args, input, options: []
+    stdout, stdout_fd = sys.stdout, os.dup(1)
+    sys.stdout = os.fdopen(os.dup(slave), 'w')
+    os.dup2(slave, 1)
+    try:
+      # The pycmd pipeline runs in this thread. The sequence runs in tasks
+      # and its output is written by a thread.
+      for cmd in ('$gen', '$gen; $empty'):
+        received = []
+        run(cmd, globals(), locals())
+        self.assertEquals(['0\r\n', '1\r\n', '2\r\n'], received, cmd)
+    finally:
+      sys.stdout.close()
+      sys.stdout = stdout
+      os.dup2(stdout_fd, 1)
+      os.close(stdout_fd)
+      os.close(slave)
+      os.close(master)
+
+  def testPyCmdPipelineToClosedFifo(self):
+    gen = lambda args, input, options: itertools.count()
+    os.mkfifo('fifo')
+    def read_one():
+      reader = file('fifo')
+      reader.read(1)
+      reader.close()
+    th = threading.Thread(target=read_one)
+    th.start()
+    rc = run('$gen > fifo -> rc', globals(), locals())
+    th.join()
+    self.assertEquals(0, rc['rc'])
+
   def testExpandUser(self):
     rc = run('echo ~/test.txt > out.txt', globals(), locals())
     path = os.path.expanduser('~/test.txt')
     self.assertEquals(path + '\n', file('out.txt').read())
 
+  def testExpandUserAfterParse(self):
+    ast = parse('echo ~/test.txt \'~\'/a > out.txt')
+    home = os.environ.get('HOME')
+    os.environ['HOME'] = '/pysh/home'
+    try:
+      run_ast(ast, globals(), locals())
+    finally:
+      if home is None:
+        del os.environ['HOME']
+      else:
+        os.environ['HOME'] = home
+    self.assertEquals('/pysh/home/test.txt /pysh/home/a\n',
+                      file('out.txt').read())
+
   def testGlob(self):
     run('echo foo > foo.txt', globals(), locals())
     run('echo bar > bar.txt', globals(), locals())
@@ -382,6 +587,20 @@ class RunTest(unittest.TestCase):
     self.assertEquals('pycmd\na\npycmd\n1\n2\nfoo\nbar\nb\n',
                       file('out.txt').read())
 
+  def testLargeOutputInBackQuote(self):
+    # Outputs larger than the buffer of a pipe.
+    def tmp(args, input, options):
+      return ('x' * 99 for _ in xrange(2000))
+    rc = run('true | pycmd `$tmp` => out', globals(), locals())
+    self.assertEquals(['pycmd'] + ['x' * 99] * 2000, rc['out'])
+    rc = run('echo `seq 20000` => out', globals(), locals())
+    self.assertEquals(map(str, xrange(1, 20001)), rc['out'][0].split())
+
+  def testManyBackQuotes(self):
+    rc = run('echo ' + ' '.join(['`echo %d`' % i for i in xrange(30)]) +
+             ' => out', globals(), locals())
+    self.assertEquals([' '.join(map(str, xrange(30)))], rc['out'])
+
   def testPyCmdAndNativeBackquote(self):
     def tmp(args, input, options):
       return args
@@ -451,6 +670,97 @@ class RunTest(unittest.TestCase):
     run('$tmp | $represent > out.txt', globals(), locals())
     self.assertEquals('\'1\'\n\'2\'\n\'3\'\n', file('out.txt').read())
 
+  def testBatchPyCmd(self):
+    def double(args, input, options):
+      return ([e * 2 for e in batch] for batch in input)
+    double = PyCmd(double, '', batch=True)
+    def gen(args, input, options):
+      return range(3)
+    rc = run('$gen | $double | $double => out', globals(), locals())
+    self.assertEquals([0, 4, 8], rc['out'])
+
+  def testBatchPyCmdWithItemPyCmds(self):
+    def count(args, input, options):
+      return [[len(batch) for batch in input]]
+    count = PyCmd(count, '', batch=True)
+    def gen(args, input, options):
+      return xrange(2000)
+    def incr(args, input, options):
+      return (e + 1 for e in input)
+    # Outputs of item pycmds are given to batch pycmds as soon as they are
+    # produced.
+    rc = run('$gen | $count => out', globals(), locals())
+    self.assertEquals([1] * 2000, rc['out'])
+    rc = run('$gen | $count | $incr => out', globals(), locals())
+    self.assertEquals([2] * 2000, rc['out'])
+
+  def testBatchPyCmdFileInputOutput(self):
+    def upper(args, input, options):
+      return ([line.upper() for line in batch] for batch in input)
+    upper = PyCmd(upper, '', batch=True)
+    run('/bin/echo "a\\nb" | $upper | cat > out.txt', globals(), locals())
+    self.assertEquals('A\nB\n', file('out.txt').read())
+    run('/bin/echo c | $upper > out.txt', globals(), locals())
+    self.assertEquals('C\n', file('out.txt').read())
+
+  def testBatchPyCmdNoOutput(self):
+    def tmp(args, input, options):
+      return [[], []]
+    tmp = PyCmd(tmp, '', inType=IOType.No, outType=IOType.No, batch=True)
+    response = run('$tmp -> rc', globals(), locals())
+    self.assertEquals(0, response['rc'])
+
+  def testPyCmdPipelineInCallingThread(self):
+    threads = []
+    def gen(args, input, options):
+      threads.append(threading.current_thread())
+      return xrange(3)
+    def double(args, input, options):
+      threads.append(threading.current_thread())
+      return ([e * 2 for e in batch] for batch in input)
+    double = PyCmd(double, '', batch=True)
+    def incr(args, input, options):
+      threads.append(threading.current_thread())
+      return (e + 1 for e in input)
+    rc = run('$gen | $double | $incr => out', globals(), locals())
+    self.assertEquals([1, 3, 5], rc['out'])
+    self.assertEquals([threading.current_thread()] * 3, threads)
+
+  def testPyCmdPipelineInCallingThread_fileAndRc(self):
+    def gen(args, input, options):
+      return args[1:]
+    def fail(args, input, options):
+      for e in input:
+        yield e
+      raise Exception('Error!')
+    rc = run('$gen a b | $fail > out.txt -> rc', globals(), locals())
+    self.assertEquals('a\nb\n', file('out.txt').read())
+    self.assertEquals(1, rc['rc'])
+    rc = run('$gen c | $fail | $gen d >> out.txt -> rc', globals(), locals())
+    self.assertEquals('a\nb\nd\n', file('out.txt').read())
+    self.assertEquals(0, rc['rc'])
+
+  def testNativeCommandsWithoutTasks(self):
+    original = pysh.shell.evaluator.IOLoop
+    def fail():
+      raise Exception('IOLoop is used.')
+    pysh.shell.evaluator.IOLoop = fail
+    try:
+      rc = run('seq 5 | tail -2 | sort -r > out.txt -> rc; '
+               'false && echo a >> out.txt || echo b >> out.txt -> rc2; '
+               'sh -c "exit 3" 2>&1 -> rc3', globals(), locals())
+    finally:
+      pysh.shell.evaluator.IOLoop = original
+    self.assertEquals('5\n4\nb\n', file('out.txt').read())
+    self.assertEquals(0, rc['rc'])
+    self.assertEquals(0, rc['rc2'])
+    self.assertEquals(3 << 8, rc['rc3'])
+
+  def testNativePipelineEarlyExit(self):
+    rc = run('yes | head -1 > out.txt -> rc', globals(), locals())
+    self.assertEquals('y\n', file('out.txt').read())
+    self.assertEquals(0, rc['rc'])
+
   def testNoDeadLock_pipeAndBackquote(self):
     def tmp(args, input, options):
       return []
@@ -463,6 +773,30 @@ class RunTest(unittest.TestCase):
       error = True
     self.assertTrue(error)
 
+  def testRunAstMultipleTimes(self):
+    def tmp(args, input, options):
+      return ['tmp']
+    ast = parse('echo `echo $i` | $tmp >> out.txt && echo $i >> out.txt')
+    for i in xrange(2):
+      run_ast(ast, globals(), locals())
+    self.assertEquals('tmp\n0\ntmp\n1\n', file('out.txt').read())
+
+  def testParseCache(self):
+    stats = pysh.shell.evaluator.parse_cache.stats()
+    for i in xrange(3):
+      run('echo $i >> out.txt', globals(), locals())
+    new_stats = pysh.shell.evaluator.parse_cache.stats()
+    self.assertEquals(1, new_stats['misses'] - stats['misses'])
+    self.assertEquals(2, new_stats['hits'] - stats['hits'])
+    self.assertEquals('0\n1\n2\n', file('out.txt').read())
+
+  def testParseCacheAliasMapModified(self):
+    alias_map = {'foo': ('echo foo', False)}
+    run('foo >> out.txt', globals(), locals(), alias_map)
+    alias_map['foo'] = ('echo bar', False)
+    run('foo >> out.txt', globals(), locals(), alias_map)
+    self.assertEquals('foo\nbar\n', file('out.txt').read())
+
   def testNoDeadLock_pipeRightCommandEarlyReturn(self):
     # Usually, echo bar exits earlier than echo `echo foo`
     run('echo `echo foo` | echo bar > /dev/null', globals(), locals())
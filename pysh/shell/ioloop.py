@@ -0,0 +1,248 @@
+"""An event loop for an evaluation of a command.
+
+The thread which runs tasks (Evaluator.executeAst) waits in IOLoop.wait for
+completions reported by other threads. While it waits, it reads outputs of
+native commands captured to Python lists (backquotes and =>), so captures
+don't need a thread each, and reaps child processes started by the
+evaluation. Other threads report completions with post, which wakes up
+poll through a pipe.
+"""
+
+import errno
+import fcntl
+import os
+import select
+import threading
+
+from pysh.shell import spawn
+
+READ_SIZE = 65536
+
+# Intervals to check children with waitpid(WNOHANG) if pidfd is not
+# supported, in milliseconds.
+MIN_CHILD_POLL_INTERVAL = 1
+MAX_CHILD_POLL_INTERVAL = 50
+
+# Children which were still running when their IOLoop was closed. They are
+# reaped by later IOLoops not to leave zombies.
+orphans = set()
+
+
+def SetBlocking(fd, blocking):
+  flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+  if blocking:
+    flags &= ~os.O_NONBLOCK
+  else:
+    flags |= os.O_NONBLOCK
+  fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+
+class Capture(object):
+  """Lines read from fd to output."""
+  __slots__ = ('fd', 'output', 'rest')
+
+  def __init__(self, fd, output):
+    self.fd = fd
+    self.output = output
+    # Chunks of the last line which doesn't end with a newline yet. They
+    # are joined once the line ends, so long lines are not copied per read.
+    self.rest = []
+
+
+def WaitPid(pid, options):
+  """Returns the status of pid, or None if it is running (WNOHANG)."""
+  while True:
+    try:
+      wpid, status = os.waitpid(pid, options)
+    except OSError, e:
+      if e.errno == errno.EINTR:
+        continue
+      if e.errno == errno.ECHILD:
+        # Somebody else reaped the child. Its status is unknown.
+        return 0
+      raise
+    if wpid == 0:
+      return None
+    return status
+
+
+def ReapOrphans():
+  for pid in list(orphans):
+    if WaitPid(pid, os.WNOHANG) is not None:
+      orphans.discard(pid)
+
+
+class IOLoop(object):
+  def __init__(self):
+    self.__poll = select.poll()
+    self.__captures = {}  # {fd: Capture}
+    # Children watched with pidfds. {pidfd: (pid, callback)}
+    self.__pidfds = {}
+    # Children watched with waitpid(WNOHANG). {pid: callback}
+    self.__children = {}
+    self.__child_poll_interval = MIN_CHILD_POLL_INTERVAL
+    self.__events = []
+    self.__closed = False
+    self.__lock = threading.Lock()
+    self.__wakeup_r, self.__wakeup_w = os.pipe()
+    SetBlocking(self.__wakeup_r, False)
+    SetBlocking(self.__wakeup_w, False)
+    self.__poll.register(self.__wakeup_r, select.POLLIN)
+    if orphans:
+      ReapOrphans()
+
+  def capture(self, fd, output):
+    """Appends lines read from fd to output without newlines until EOF.
+
+    fd is read in wait. Call finish_capture before closing fd.
+    """
+    SetBlocking(fd, False)
+    self.__captures[fd] = Capture(fd, output)
+    self.__poll.register(fd, select.POLLIN)
+
+  def finish_capture(self, fd):
+    """Reads fd until EOF and stops capturing it.
+
+    Like join of a thread which reads fd, this blocks until all writers
+    of fd close it.
+    """
+    capture = self.__captures.get(fd)
+    if capture is None:
+      # EOF was already read in wait.
+      return
+    SetBlocking(fd, True)
+    while self.__read(capture):
+      pass
+
+  def watch_child(self, pid, callback):
+    """Calls callback with the exit status of the child pid in wait.
+
+    Only pid is waited for, so children of other libraries are not reaped.
+    """
+    pidfd = spawn.pidfd_open(pid)
+    if pidfd is not None:
+      self.__pidfds[pidfd] = (pid, callback)
+      self.__poll.register(pidfd, select.POLLIN)
+    else:
+      self.__children[pid] = callback
+      self.__child_poll_interval = MIN_CHILD_POLL_INTERVAL
+
+  def post(self, event):
+    """Adds event to the result of wait. This is called by other threads.
+
+    Events posted after close are ignored (e.g. a process which exits after
+    the evaluation failed).
+    """
+    self.__lock.acquire()
+    try:
+      if self.__closed:
+        return
+      self.__events.append(event)
+      if len(self.__events) == 1:
+        try:
+          os.write(self.__wakeup_w, 'x')
+        except OSError, e:
+          # The pipe is full, so wait will wake up anyway.
+          if e.errno != errno.EAGAIN:
+            raise
+    finally:
+      self.__lock.release()
+
+  def wait(self):
+    """Returns events posted since the last call. Blocks if there is none."""
+    while True:
+      self.__lock.acquire()
+      events = self.__events
+      if events:
+        self.__events = []
+      self.__lock.release()
+      if events:
+        return events
+      timeout = None
+      if self.__children:
+        timeout = self.__child_poll_interval
+        self.__child_poll_interval = min(self.__child_poll_interval * 2,
+                                         MAX_CHILD_POLL_INTERVAL)
+      try:
+        ready = self.__poll.poll(timeout)
+      except select.error, e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      for fd, _ in ready:
+        if fd == self.__wakeup_r:
+          self.__drain_wakeup()
+        elif fd in self.__pidfds:
+          self.__reap_pidfd(fd)
+        else:
+          capture = self.__captures.get(fd)
+          if capture:
+            self.__read(capture)
+      if self.__children:
+        self.__reap_children()
+
+  def close(self):
+    for fd in self.__captures.keys():
+      self.__poll.unregister(fd)
+    self.__captures.clear()
+    for pidfd, (pid, _) in self.__pidfds.iteritems():
+      os.close(pidfd)
+      orphans.add(pid)
+    self.__pidfds.clear()
+    orphans.update(self.__children)
+    self.__children.clear()
+    ReapOrphans()
+    self.__lock.acquire()
+    self.__closed = True
+    os.close(self.__wakeup_r)
+    os.close(self.__wakeup_w)
+    self.__lock.release()
+
+  def __reap_pidfd(self, pidfd):
+    pid, callback = self.__pidfds.pop(pidfd)
+    self.__poll.unregister(pidfd)
+    os.close(pidfd)
+    callback(WaitPid(pid, 0))
+
+  def __reap_children(self):
+    for pid, callback in self.__children.items():
+      status = WaitPid(pid, os.WNOHANG)
+      if status is not None:
+        del self.__children[pid]
+        callback(status)
+
+  def __drain_wakeup(self):
+    try:
+      while os.read(self.__wakeup_r, READ_SIZE):
+        pass
+    except OSError, e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def __read(self, capture):
+    """Reads fd of capture. Returns False at EOF."""
+    try:
+      data = os.read(capture.fd, READ_SIZE)
+    except OSError, e:
+      if e.errno == errno.EAGAIN or e.errno == errno.EINTR:
+        return True
+      raise
+    if not data:
+      if capture.rest:
+        capture.output.append(''.join(capture.rest).rstrip('\r'))
+      self.__poll.unregister(capture.fd)
+      del self.__captures[capture.fd]
+      return False
+    if '\n' not in data:
+      capture.rest.append(data)
+      return True
+    if capture.rest:
+      capture.rest.append(data)
+      data = ''.join(capture.rest)
+    lines = data.split('\n')
+    last = lines.pop()
+    capture.rest = [last] if last else []
+    output = capture.output
+    for line in lines:
+      output.append(line.rstrip('\r'))
+    return True
@@ -0,0 +1,63 @@
+"""Benchmark of commands which capture outputs to Python.
+
+Counts the threads started by each command as well as the time.
+"""
+
+import threading
+
+from pysh.benchlib import measure
+from pysh.benchlib import report
+from pysh.shell.evaluator import parse
+from pysh.shell.evaluator import run_ast
+
+
+class ThreadCounter(object):
+  """Counts calls of threading.Thread.start."""
+
+  def __init__(self):
+    self.count = 0
+    self.__start = threading.Thread.start
+
+  def __enter__(self):
+    counter = self
+    original = self.__start
+    def start(thread):
+      counter.count += 1
+      original(thread)
+    threading.Thread.start = start
+    return self
+
+  def __exit__(self, *unused):
+    threading.Thread.start = self.__start
+
+
+def upper(args, input, options):
+  for line in input:
+    yield line.upper()
+
+
+def main():
+  results = []
+  variables = {'upper': upper}
+  cases = (
+    ('backquotes_30', 'echo ' + ' '.join(['`echo %d`' % i for i in xrange(30)])
+     + ' => out'),
+    ('captures_30', '; '.join(['echo %d => out%d' % (i, i)
+                               for i in xrange(30)])),
+    ('mixed_pipeline', 'seq 100000 | $upper | cat | $upper => out'),
+    ('long_line', 'head -c 30000000 /dev/zero => out'),
+    ('cat_pipeline_100', 'seq 1000 | ' + ' | '.join(['cat'] * 100) +
+     ' > /dev/null'),
+    )
+  for name, cmd in cases:
+    ast = parse(cmd)
+    with ThreadCounter() as counter:
+      run_ast(ast, variables, {})
+    results.append((name + '_threads', counter.count, 'threads'))
+    elapsed = measure(lambda: run_ast(ast, variables, {}))
+    results.append((name, elapsed, 's'))
+  report('ioloop', results)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,126 @@
+import os
+import subprocess
+import sys
+import threading
+import unittest
+
+from pysh.shell import spawn
+from pysh.shell.ioloop import IOLoop
+
+
+class IOLoopTest(unittest.TestCase):
+  def setUp(self):
+    self.loop = IOLoop()
+    self.fds = []
+
+  def tearDown(self):
+    self.loop.close()
+    for fd in self.fds:
+      os.close(fd)
+
+  def pipe(self):
+    r, w = os.pipe()
+    self.fds.append(r)
+    return r, w
+
+  def write(self, w, data):
+    """Writes data to w in a thread and posts 'done'."""
+    def run():
+      os.write(w, data)
+      os.close(w)
+      self.loop.post('done')
+    th = threading.Thread(target=run)
+    th.start()
+    return th
+
+  def testCapture(self):
+    r, w = self.pipe()
+    out = []
+    self.loop.capture(r, out)
+    th = self.write(w, 'a\nb\r\n\nc')
+    self.assertEquals(['done'], self.loop.wait())
+    th.join()
+    self.loop.finish_capture(r)
+    self.assertEquals(['a', 'b', '', 'c'], out)
+
+  def testCaptureLargeOutput(self):
+    # The writer blocks unless the loop reads the pipe while it waits.
+    r, w = self.pipe()
+    out = []
+    self.loop.capture(r, out)
+    th = self.write(w, 'x' * 99 + '\n' * 10000)
+    self.assertEquals(['done'], self.loop.wait())
+    th.join()
+    self.loop.finish_capture(r)
+    self.assertEquals(['x' * 99] + [''] * 9999, out)
+
+  def testCaptureLongLine(self):
+    r, w = self.pipe()
+    out = []
+    self.loop.capture(r, out)
+    line = 'x' * 1000000
+    th = self.write(w, 'a\n' + line + '\r\n' + line)
+    self.assertEquals(['done'], self.loop.wait())
+    th.join()
+    self.loop.finish_capture(r)
+    self.assertEquals(['a', line, line], out)
+
+  def testFinishCapture(self):
+    r, w = self.pipe()
+    out = []
+    self.loop.capture(r, out)
+    os.write(w, 'a\nb')
+    os.close(w)
+    self.loop.finish_capture(r)
+    self.assertEquals(['a', 'b'], out)
+    # Does nothing for fds which reached EOF.
+    self.loop.finish_capture(r)
+
+  def testPost(self):
+    threads = [threading.Thread(target=self.loop.post, args=(i,))
+               for i in xrange(10)]
+    for th in threads:
+      th.start()
+    events = []
+    while len(events) < 10:
+      events.extend(self.loop.wait())
+    for th in threads:
+      th.join()
+    self.assertEquals(range(10), sorted(events))
+
+  def spawnExit(self, code):
+    return subprocess.Popen(
+      [sys.executable, '-c', 'import sys; sys.exit(%d)' % code]).pid
+
+  def watchChildren(self):
+    for code in xrange(5):
+      self.loop.watch_child(self.spawnExit(code), self.loop.post)
+    # Not watched by the loop.
+    other = subprocess.Popen([sys.executable, '-c', 'import sys; sys.exit(7)'])
+    statuses = []
+    while len(statuses) < 5:
+      statuses.extend(self.loop.wait())
+    self.assertEquals(range(5), sorted(map(os.WEXITSTATUS, statuses)))
+    self.assertEquals(7, other.wait())
+
+  def testWatchChild(self):
+    self.watchChildren()
+
+  def testWatchChildWithoutPidfd(self):
+    if spawn.LoadLibc():
+      supported = spawn.libc.pidfd_supported
+      spawn.libc.pidfd_supported = False
+    try:
+      self.watchChildren()
+    finally:
+      if spawn.LoadLibc():
+        spawn.libc.pidfd_supported = supported
+
+  def testPostAfterClose(self):
+    loop = IOLoop()
+    loop.close()
+    loop.post('ignored')
+
+
+if __name__ == '__main__':
+  unittest.main()
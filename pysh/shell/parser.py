@@ -18,6 +18,9 @@ from pysh.shell.tokenizer import (
   SEMICOLON,
   BACKQUOTE,
   EOF,
+  CONSTANT,
+  TOKEN_NAMES,
+  Token,
 
   VARIABLE_PATTERN,
   REDIRECT_PATTERN, # need test
@@ -31,6 +34,9 @@ from pysh.shell.tokenizer import RegexMather
 
 
 class Process(object):
+  # inType and outType are set by DiagnoseIOType.
+  __slots__ = ('args', 'redirects', 'inType', 'outType')
+
   def __init__(self, args, redirects):
     self.args = args
     self.redirects = redirects
@@ -41,84 +47,228 @@ class Process(object):
   def __repr__(self):
     return str(self)
 
-class BinaryOp(object):
-  def __init__(self, op, left, right):
-    self.op = op
-    self.left = left
-    self.right = right
+class Pipeline(object):
+  """cmds connected with |."""
+  __slots__ = ('cmds', 'inType', 'outType')
+
+  def __init__(self, cmds):
+    self.cmds = cmds
+
+
+class Sequence(object):
+  """cmds separated with ;."""
+  __slots__ = ('cmds', 'inType', 'outType')
+
+  def __init__(self, cmds):
+    self.cmds = cmds
+
+
+class AndOr(object):
+  """cmds connected with && and ||.
+
+  ops[i] is the operator between cmds[i] and cmds[i + 1]. Operators have the
+  same precedence and are evaluated from left to right.
+  """
+  __slots__ = ('cmds', 'ops', 'inType', 'outType')
+
+  def __init__(self, cmds, ops):
+    assert len(cmds) == len(ops) + 1
+    self.cmds = cmds
+    self.ops = ops
+
 
 class Assign(object):
+  __slots__ = ('cmd', 'name', 'inType', 'outType')
+
   def __init__(self, cmd, name):
     self.cmd = cmd
     self.name = name
 
 
+def CopyAst(ast):
+  """Returns a copy of ast which can be modified by DiagnoseIOType.
+
+  Tokens are shared with the original ast because they are never modified.
+  """
+  if isinstance(ast, Process):
+    args = []
+    for arg in ast.args:
+      args.append([Token(BACKQUOTE, CopyAst(tok.text))
+                   if tok.kind == BACKQUOTE else tok for tok in arg])
+    return Process(args, ast.redirects)
+  elif isinstance(ast, Pipeline):
+    return Pipeline([CopyAst(cmd) for cmd in ast.cmds])
+  elif isinstance(ast, Sequence):
+    return Sequence([CopyAst(cmd) for cmd in ast.cmds])
+  elif isinstance(ast, AndOr):
+    return AndOr([CopyAst(cmd) for cmd in ast.cmds], ast.ops)
+  else:
+    assert isinstance(ast, Assign)
+    return Assign(CopyAst(ast.cmd), ast.name)
+
+
+class CompiledSubstitution(Token):
+  """A SUBSTITUTION token with the compiled code of its expression."""
+  __slots__ = ('code',)
+
+  def __init__(self, text, code):
+    Token.__init__(self, SUBSTITUTION, text)
+    self.code = code
+
+
+def SubstitutionExpr(text):
+  """Returns the Python expression of the text of a SUBSTITUTION token."""
+  if text.startswith('${'):
+    # remove ${ and }
+    return text[2:-1]
+  else:
+    # remove $
+    return text[1:]
+
+
+def CompileSubstitution(tok):
+  try:
+    code = compile(SubstitutionExpr(tok.text), '<string>', 'eval')
+  except SyntaxError:
+    # Leave the error to the evaluation.
+    return tok
+  return CompiledSubstitution(tok.text, code)
+
+
+def FoldConstants(ast):
+  """Evaluates arguments of ast which don't depend on variables in advance.
+
+  An argument which consists only of literals and quoted strings without
+  glob patterns becomes a CONSTANT token whose text is the value of the
+  argument. Quoted strings in other arguments become CONSTANT tokens too.
+  The first argument is folded only if it is a single literal because a
+  quoted command name doesn't refer to a pycmd. Substitutions are compiled
+  to CompiledSubstitution tokens. ast is modified in place and returned.
+  """
+  if isinstance(ast, Process):
+    args = ast.args
+    arg0 = args[0]
+    if len(arg0) == 1 and arg0[0].kind == LITERAL and not HasGlobPattern(arg0):
+      args[0] = [Token(CONSTANT, arg0[0].text)]
+    else:
+      FoldBackQuotes(arg0)
+      args[0] = [CompileSubstitution(tok) if tok.kind == SUBSTITUTION else tok
+                 for tok in arg0]
+    for i in xrange(1, len(args)):
+      args[i] = FoldArg(args[i])
+    redirects = ast.redirects
+    for i, redirect in enumerate(redirects):
+      if len(redirect) == 3 and isinstance(redirect[2], list):
+        redirects[i] = (redirect[0], redirect[1], FoldArg(redirect[2]))
+  elif (isinstance(ast, Pipeline) or isinstance(ast, Sequence) or
+        isinstance(ast, AndOr)):
+    for cmd in ast.cmds:
+      FoldConstants(cmd)
+  else:
+    assert isinstance(ast, Assign)
+    FoldConstants(ast.cmd)
+  return ast
+
+
+def FoldArg(arg):
+  FoldBackQuotes(arg)
+  if HasGlobPattern(arg):
+    constant = False
+  else:
+    constant = True
+    for tok in arg:
+      if tok.kind != LITERAL and tok.kind != SINGLE_QUOTED_STRING:
+        constant = False
+        break
+  if constant:
+    # os.path.expanduser is left to evaluation because it depends on $HOME.
+    return [Token(CONSTANT, ''.join([
+            tok.text if tok.kind == LITERAL else eval(tok.text)
+            for tok in arg]))]
+  return [FoldToken(tok) for tok in arg]
+
+
+def FoldToken(tok):
+  kind = tok.kind
+  if kind == SINGLE_QUOTED_STRING:
+    return Token(CONSTANT, eval(tok.text))
+  elif kind == SUBSTITUTION:
+    return CompileSubstitution(tok)
+  else:
+    return tok
+
+
+def FoldBackQuotes(arg):
+  for tok in arg:
+    if tok.kind == BACKQUOTE:
+      FoldConstants(tok.text)
+
+
+def HasGlobPattern(arg):
+  for tok in arg:
+    if tok.kind == LITERAL:
+      if '*' in tok.text or '?' in tok.text:
+        return True
+  return False
+
+
 class Parser(object):
   def __init__(self, tokenizer):
     self.__tokenizer = tokenizer
 
   def parse(self):
     self.__in_bquote = False
-    tok, string = self.__tokenizer.next()
+    self.__tokenizer.next()
     return self.parseExpr()
 
   def parseExpr(self):
-    left = None
+    cmds = []
     while True:
-      assign = self.parseAndOrTest()
-      left = BinaryOp(';', left, assign) if left else assign
-      tok, _ = self.__tokenizer.cur
-      if tok != SEMICOLON:
-        return left
-      self.__tokenizer.next()
-      tok, _ = self.__tokenizer.cur
+      cmds.append(self.parseAndOrTest())
+      if self.__tokenizer.cur.kind != SEMICOLON:
+        break
+      tok = self.__tokenizer.next().kind
       if tok == EOF or tok == PARENTHESIS_END or tok == BACKQUOTE:
-        return left
+        break
+    return cmds[0] if len(cmds) == 1 else Sequence(cmds)
 
   def parseAndOrTest(self):
-    left = None
-    op = None
+    cmds = [self.parsePiped()]
+    ops = []
     while True:
-      piped = self.parsePiped()
-      if left:
-        left = BinaryOp(op, left, piped)
-      else:
-        left = piped
-      tok, _ = self.__tokenizer.cur
+      tok = self.__tokenizer.cur.kind
       if tok == AND_OP:
-        op = '&&'
-        self.__tokenizer.next()
+        ops.append('&&')
       elif tok == OR_OP:
-        op = '||'
-        self.__tokenizer.next()
+        ops.append('||')
       else:
-        return left
+        break
+      self.__tokenizer.next()
+      cmds.append(self.parsePiped())
+    return AndOr(cmds, ops) if ops else cmds[0]
 
   def parsePiped(self):
-    left = self.parseCmd()
+    cmds = [self.parseCmd()]
     while True:
-      tok, _ = self.__tokenizer.cur
+      tok = self.__tokenizer.cur.kind
       if tok == PIPE:
         self.__tokenizer.next()
-        cmd = self.parseCmd()
-        left = BinaryOp('|', left, cmd)
+        cmds.append(self.parseCmd())
       elif tok == RIGHT_ARROW:
-        self.__tokenizer.next()
-        tok, string = self.__tokenizer.cur
+        tok, string = self.__tokenizer.next()
         if tok != LITERAL or not PYTHON_VARIABLE_PATTERN.match(string):
           raise Exception('-> must be followed with python var.')
         self.__tokenizer.next()
-        left = Assign(left, string)
+        # -> takes the pipeline on its left.
+        cmds = [Assign(cmds[0] if len(cmds) == 1 else Pipeline(cmds), string)]
       else:
-        return left
+        return cmds[0] if len(cmds) == 1 else Pipeline(cmds)
 
   def parseCmd(self):
-    tok, _ = self.__tokenizer.cur
-    if tok == PARENTHESIS_START:
+    if self.__tokenizer.cur.kind == PARENTHESIS_START:
       self.__tokenizer.next()
       expr = self.parseExpr()
-      tok, _ = self.__tokenizer.cur
-      if tok != PARENTHESIS_END:
+      if self.__tokenizer.cur.kind != PARENTHESIS_END:
         raise Exception('Parenthesis mismatch')
       self.__tokenizer.next()
       return expr
@@ -130,15 +280,15 @@ class Parser(object):
     redirects = []
     args.append(self.parseArg())
     while True:
-      tok, string = self.__tokenizer.cur
+      cur = self.__tokenizer.cur
+      tok = cur.kind
       if tok == SPACE:
-        self.__tokenizer.next()
-        if self.__tokenizer.cur[0] == BACKQUOTE and self.__in_bquote:
+        if self.__tokenizer.next().kind == BACKQUOTE and self.__in_bquote:
           # A hack to ignore space in backquote
           break
         args.append(self.parseArg())
       elif tok == REDIRECT:
-        append, src_num, dst_num = self.parseRedirectToken((tok, string))
+        append, src_num, dst_num = self.parseRedirectToken(cur)
         self.__tokenizer.next()
         if dst_num != -1:
           redirects.append((append, src_num, dst_num))
@@ -146,18 +296,17 @@ class Parser(object):
           target = self.parseArg()
           redirects.append((append, src_num, target))
       elif tok == BOLD_RIGHT_ARROW:
-        self.__tokenizer.next()
-        tok, string = self.__tokenizer.cur
+        tok, string = self.__tokenizer.next()
         if tok != LITERAL or not PYTHON_VARIABLE_PATTERN.match(string):
           raise Exception('=> must be followed with python var.')
         redirects.append(('=>', string))
         self.__tokenizer.next()
       else:
         break
-    return Process(args, redirects)
+    return Process(args[:], redirects)
 
   def parseRedirectToken(self, tok):
-    m = REDIRECT_PATTERN.match(tok[1])
+    m = REDIRECT_PATTERN.match(tok.text)
     src_num = sys.stdout.fileno()
     if m.group(1):
       src_num = int(m.group(1))
@@ -174,17 +323,21 @@ class Parser(object):
   def parseArg(self):
     result = []
     while True:
-      tok, string = self.__tokenizer.cur
+      cur = self.__tokenizer.cur
+      tok = cur.kind
       if self.isArgToken(tok):
-        self.appendToken((tok, string), result)
+        self.appendToken(cur, result)
         self.__tokenizer.next()
       elif tok == BACKQUOTE and not self.__in_bquote:
         result.append(self.parseBackQuote())
       else:
         break
     if not result:
-      raise Exception('Unexpected token: %s: %s' % (tok, string))
-    return result
+      raise Exception('Unexpected token: %s: %s' % (TOKEN_NAMES[tok],
+                                                    cur.text))
+    # Copy to drop the over-allocation of append and extend. Large commands
+    # have many arguments and most of them are only one or two tokens.
+    return result[:]
 
   def isArgToken(self, tok):
     return (tok == LITERAL or
@@ -193,23 +346,22 @@ class Parser(object):
             tok == SUBSTITUTION)
 
   def appendToken(self, tok, tokens):
-    if tok[0] == DOUBLE_QUOTED_STRING:
-      tokens.extend(DoubleQuotedStringExpander(eval(tok[1])))
+    if tok.kind == DOUBLE_QUOTED_STRING:
+      tokens.extend(DoubleQuotedStringExpander(eval(tok.text)))
     else:
       tokens.append(tok)
 
   def parseBackQuote(self):
-    while self.__tokenizer.next()[0] == SPACE:
+    while self.__tokenizer.next().kind == SPACE:
       # A hack to ignore space in backquote
       pass
     self.__in_bquote = True
     expr = self.parseExpr()
     self.__in_bquote = False
-    tok, _ = self.__tokenizer.cur
-    if tok != BACKQUOTE:
+    if self.__tokenizer.cur.kind != BACKQUOTE:
       raise Exception('backquote mismatch')
     self.__tokenizer.next()
-    return (BACKQUOTE, expr)
+    return Token(BACKQUOTE, expr)
 
 
 class DoubleQuotedStringExpander(object):
@@ -232,12 +384,12 @@ class DoubleQuotedStringExpander(object):
       if token is None:
         token, string, consumed = LITERAL, '$', 1
       self.__input = input[consumed:]
-      return token, string
+      return Token(token, string)
     else:
       pos = input.find('$')
       if pos == -1:
         self.__input = ''
-        return SINGLE_QUOTED_STRING, repr(input)
+        return Token(SINGLE_QUOTED_STRING, repr(input))
       else:
         self.__input = input[pos:]
-        return SINGLE_QUOTED_STRING, repr(input[:pos])
+        return Token(SINGLE_QUOTED_STRING, repr(input[:pos]))
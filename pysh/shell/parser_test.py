@@ -1,10 +1,15 @@
 import unittest
 
 from pysh.shell.tokenizer import Tokenizer
-from pysh.shell.parser import BinaryOp
+from pysh.shell.parser import AndOr
+from pysh.shell.parser import Assign
 from pysh.shell.parser import Parser
+from pysh.shell.parser import Pipeline
 from pysh.shell.parser import Process
+from pysh.shell.parser import Sequence
 from pysh.shell.parser import DoubleQuotedStringExpander
+from pysh.shell.parser import CompiledSubstitution
+from pysh.shell.parser import FoldConstants
 
 from pysh.shell.tokenizer import (
   SPACE,
@@ -23,6 +28,7 @@ from pysh.shell.tokenizer import (
   SEMICOLON,
   BACKQUOTE,
   EOF,
+  CONSTANT,
 )
 
 
@@ -44,34 +50,75 @@ class ParserTest(unittest.TestCase):
     input = 'echo hoge$foo || echo piyo && cat'
     parser = Parser(Tokenizer(input))
     ast = parser.parse()
-    self.assertTrue(isinstance(ast, BinaryOp))
-    self.assertEquals('&&', ast.op)
-    self.assertTrue(isinstance(ast.left, BinaryOp))
-    self.assertEquals('||', ast.left.op)
-    proc0 = ast.left.left
+    self.assertTrue(isinstance(ast, AndOr))
+    self.assertEquals(['||', '&&'], ast.ops)
+    self.assertEquals(3, len(ast.cmds))
+    proc0 = ast.cmds[0]
     self.assertTrue(isinstance(proc0, Process))
-    self.assertEquals([[('literal', 'echo')],
-                       [('literal', 'hoge'), ('substitution', '$foo')]],
+    self.assertEquals([[(LITERAL, 'echo')],
+                       [(LITERAL, 'hoge'), (SUBSTITUTION, '$foo')]],
                       proc0.args)
     self.assertFalse(proc0.redirects)
-    proc1 = ast.left.right
+    proc1 = ast.cmds[1]
     self.assertTrue(isinstance(proc1, Process))
-    self.assertEquals([[('literal', 'echo')], [('literal', 'piyo')]],
+    self.assertEquals([[(LITERAL, 'echo')], [(LITERAL, 'piyo')]],
                       proc1.args)
     self.assertFalse(proc1.redirects)
-    proc2 = ast.right
+    proc2 = ast.cmds[2]
     self.assertTrue(isinstance(proc2, Process))
-    self.assertEquals([[('literal', 'cat')]], proc2.args)
+    self.assertEquals([[(LITERAL, 'cat')]], proc2.args)
     self.assertFalse(proc2.redirects)
 
   def testSemicolon(self):
     input = 'echo; cat;'
     parser = Parser(Tokenizer(input))
     ast = parser.parse()
-    self.assertTrue(isinstance(ast, BinaryOp))
-    self.assertEquals(';', ast.op)
-    self.assertTrue(isinstance(ast.left, Process))
-    self.assertTrue(isinstance(ast.right, Process))
+    self.assertTrue(isinstance(ast, Sequence))
+    self.assertEquals(2, len(ast.cmds))
+    self.assertTrue(isinstance(ast.cmds[0], Process))
+    self.assertTrue(isinstance(ast.cmds[1], Process))
+
+  def testPipeline(self):
+    input = 'cat a | grep b | wc -l -> n'
+    parser = Parser(Tokenizer(input))
+    ast = parser.parse()
+    self.assertTrue(isinstance(ast, Assign))
+    self.assertEquals('n', ast.name)
+    self.assertTrue(isinstance(ast.cmd, Pipeline))
+    self.assertEquals([[[(LITERAL, 'cat')], [(LITERAL, 'a')]],
+                       [[(LITERAL, 'grep')], [(LITERAL, 'b')]],
+                       [[(LITERAL, 'wc')], [(LITERAL, '-l')]]],
+                      [cmd.args for cmd in ast.cmd.cmds])
+
+  def testAssignInPipeline(self):
+    input = 'cat a -> x | cat'
+    parser = Parser(Tokenizer(input))
+    ast = parser.parse()
+    self.assertTrue(isinstance(ast, Pipeline))
+    self.assertEquals(2, len(ast.cmds))
+    self.assertTrue(isinstance(ast.cmds[0], Assign))
+    self.assertTrue(isinstance(ast.cmds[1], Process))
+
+  def testNested(self):
+    input = 'true; (a | b && c; d) || e'
+    parser = Parser(Tokenizer(input))
+    ast = parser.parse()
+    self.assertTrue(isinstance(ast, Sequence))
+    self.assertTrue(isinstance(ast.cmds[1], AndOr))
+    self.assertEquals(['||'], ast.cmds[1].ops)
+    inner = ast.cmds[1].cmds[0]
+    self.assertTrue(isinstance(inner, Sequence))
+    self.assertTrue(isinstance(inner.cmds[0], AndOr))
+    self.assertTrue(isinstance(inner.cmds[0].cmds[0], Pipeline))
+
+  def testLongChains(self):
+    # Long chains are flat and don't hit the recursion limit.
+    n = 5000
+    for sep, cls in ((';', Sequence), ('&&', AndOr), ('|', Pipeline)):
+      ast = Parser(Tokenizer(sep.join(['true'] * n))).parse()
+      self.assertTrue(isinstance(ast, cls))
+      self.assertEquals(n, len(ast.cmds))
+      FoldConstants(ast)
 
   def testBackquote(self):
     input = 'echo `echo foo`'
@@ -118,8 +165,70 @@ class ParserTest(unittest.TestCase):
     self.assertEquals(2, len(ast.args))
     self.assertEquals(1, len(ast.args[1]))
     self.assertEquals(BACKQUOTE, ast.args[1][0][0])
-    self.assertEquals('|', ast.args[1][0][1].op)
+    self.assertTrue(isinstance(ast.args[1][0][1], Pipeline))
 
 
+
+class FoldConstantsTest(unittest.TestCase):
+  def parse(self, input):
+    return FoldConstants(Parser(Tokenizer(input)).parse())
+
+  def testLiteralArgs(self):
+    ast = self.parse('echo a \'b c\' d"e"\'f\' "x\\ty" ~/z')
+    self.assertEquals([[(CONSTANT, 'echo')],
+                       [(CONSTANT, 'a')],
+                       [(CONSTANT, 'b c')],
+                       [(CONSTANT, 'def')],
+                       [(CONSTANT, 'x\ty')],
+                       [(CONSTANT, '~/z')]],
+                      ast.args)
+
+  def testSubstitution(self):
+    ast = self.parse('echo a$x \'b\'${y}"c$z"')
+    self.assertEquals([[(CONSTANT, 'echo')],
+                       [(LITERAL, 'a'), (SUBSTITUTION, '$x')],
+                       [(CONSTANT, 'b'), (SUBSTITUTION, '${y}'),
+                        (CONSTANT, 'c'), (SUBSTITUTION, '$z')]],
+                      ast.args)
+
+  def testCompiledSubstitution(self):
+    ast = self.parse('$cmd ${x + 1}"/$y"')
+    tok = ast.args[0][0]
+    self.assertTrue(isinstance(tok, CompiledSubstitution))
+    self.assertEquals('$cmd', tok.text)
+    self.assertEquals(3, eval(tok.code, {'cmd': 3}))
+    arg = ast.args[1]
+    self.assertEquals([(SUBSTITUTION, '${x + 1}'), (CONSTANT, '/'),
+                       (SUBSTITUTION, '$y')], arg)
+    self.assertEquals(2, eval(arg[0].code, {'x': 1}))
+    self.assertEquals('a', eval(arg[2].code, {'y': 'a'}))
+
+  def testGlob(self):
+    ast = self.parse('echo *\'*\'.txt')
+    self.assertEquals([[(CONSTANT, 'echo')],
+                       [(LITERAL, '*'), (CONSTANT, '*'), (LITERAL, '.txt')]],
+                      ast.args)
+
+  def testFirstArg(self):
+    # Only a single literal is folded because the first argument names a
+    # pycmd.
+    for input in ('\'echo\' a', 'e\'cho\' a', '$cmd a', '*.sh a'):
+      arg0 = Parser(Tokenizer(input)).parse().args[0]
+      self.assertEquals(arg0, self.parse(input).args[0])
+
+  def testRedirect(self):
+    ast = self.parse('echo a > "out.txt" 2>&1')
+    self.assertEquals([(False, 1, [(CONSTANT, 'out.txt')]), (False, 2, 1)],
+                      ast.redirects)
+
+  def testBackquote(self):
+    ast = self.parse('echo `echo \'foo\'` && (cat a || cat b) -> rc')
+    arg = ast.cmds[0].args[1]
+    self.assertEquals(BACKQUOTE, arg[0].kind)
+    self.assertEquals([[(CONSTANT, 'echo')], [(CONSTANT, 'foo')]],
+                      arg[0].text.args)
+    self.assertEquals([[(CONSTANT, 'cat')], [(CONSTANT, 'b')]],
+                      ast.cmds[1].cmd.cmds[1].args)
+
 if __name__ == '__main__':
   unittest.main()
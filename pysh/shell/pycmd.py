@@ -1,17 +1,35 @@
+import itertools
+
 __pycmd_map = {}
+# name -> module which registers the pycmd when it is imported.
+__lazy_pycmd_map = {}
 
 
 def register_pycmd(name, pycmd):
   __pycmd_map[name] = pycmd
 
 
+def declare_pycmds(module, names):
+  """Declares pycmds which are registered by module.
+
+  module is imported on the first get_pycmd lookup of one of names, so that
+  scripts which don't use them don't pay the import cost.
+  """
+  for name in names:
+    __lazy_pycmd_map[name] = module
+
+
 def get_pycmd(name):
-  if isinstance(name, str) and name in __pycmd_map:
-    return __pycmd_map[name]
-  elif callable(name):
-    return name
-  else:
-    return None
+  if not isinstance(name, str):
+    return name if callable(name) else None
+  if name not in __pycmd_map and name in __lazy_pycmd_map:
+    # The module registers all of its pycmds. Keep pycmds which were
+    # registered before it, e.g. user pycmds named like builtins.
+    registered = dict(__pycmd_map)
+    __import__(__lazy_pycmd_map[name])
+    __pycmd_map.update(registered)
+  return __pycmd_map.get(name)
+
 
 class PyCmdOption(object):
   def __init__(self, globals, locals):
@@ -25,12 +43,49 @@ class PyCmdOption(object):
     return self.__locals
 
 
+# The number of items in a batch made from a stream of items.
+BATCH_SIZE = 1024
+
+
+def batches(iterable, size=BATCH_SIZE):
+  """Yields lists of at most size items of iterable.
+
+  Only containers (objects with len) and files are read size items at a
+  time. Items of other iterables, e.g. generators, may be produced slowly,
+  so each of them is yielded in its own list as soon as it is available.
+  """
+  if not (hasattr(iterable, '__len__') or isinstance(iterable, file)):
+    for item in iterable:
+      yield [item]
+    return
+  it = iter(iterable)
+  islice = itertools.islice
+  while True:
+    batch = list(islice(it, size))
+    if not batch:
+      return
+    yield batch
+
+
 class PyCmd(object):
-    def __init__(self, body, name, inType=None, outType=None):
+    """A command written in Python.
+
+    body is called with (args, input, options) and returns an iterable of
+    output items. If batch is True, input is an iterable of lists of items
+    instead and body returns an iterable of lists (or an object with a
+    batches method like PyshTable), so items are passed between batch
+    commands a list at a time. The evaluator converts between batches and
+    items when a batch command is connected to a command which is not.
+    Lines read from a native command are given without newlines. Batches
+    must not be modified by readers.
+    """
+
+    def __init__(self, body, name, inType=None, outType=None, batch=False):
         self.__body = body
         self.__name = name
         self.__inType = inType
         self.__outType = outType
+        self.__batch = batch
 
     def __call__(self, *args, **kwds):
         return self.__body(*args, **kwds)
@@ -44,6 +99,9 @@ class PyCmd(object):
     def outType(self):
         return self.__outType
 
+    def batch(self):
+        return self.__batch
+
 
 def pycmd(*args, **kwds):
     if args:
@@ -0,0 +1,143 @@
+"""Formats of records written from Python objects to native streams.
+
+Outputs of pycmds given to native commands or redirected with > are
+written one record per item. The format is line (str and a newline) by
+default. The records pycmd selects another format for a pipeline, e.g.
+`echo $paths | records nul | xargs -0 ls`.
+"""
+
+import itertools
+
+from pysh.shell.pycmd import batches
+
+# Records are written when this many bytes are encoded.
+WRITE_BUFFER_SIZE = 65536
+
+__formats = {}
+
+
+class EncodedRecords(str):
+  """Records which were already encoded. They are written as they are."""
+
+
+class RecordFormat(object):
+  def encode(self, items):
+    """Returns the records of a list of items as a str."""
+    raise NotImplementedError()
+
+
+class LineFormat(RecordFormat):
+  """str of an item and a newline."""
+
+  def encode(self, items):
+    if not items:
+      return ''
+    return '\n'.join(map(str, items)) + '\n'
+
+
+class NulFormat(RecordFormat):
+  """str of an item and a NUL character, e.g. for xargs -0."""
+
+  def encode(self, items):
+    if not items:
+      return ''
+    return '\0'.join(map(str, items)) + '\0'
+
+
+class JsonFormat(RecordFormat):
+  """JSON lines."""
+
+  def encode(self, items):
+    if not items:
+      return ''
+    # json is imported here because most scripts don't use this format.
+    import json
+    return '\n'.join(map(json.dumps, items)) + '\n'
+
+
+class ReprFormat(RecordFormat):
+  """repr of an item and a newline."""
+
+  def encode(self, items):
+    if not items:
+      return ''
+    return '\n'.join(map(repr, items)) + '\n'
+
+
+def register_record_format(name, format):
+  __formats[name] = format
+
+
+def get_record_format(name):
+  format = __formats.get(name)
+  if format is None:
+    raise Exception('Unknown record format: %s' % name)
+  return format
+
+
+register_record_format('line', LineFormat())
+register_record_format('nul', NulFormat())
+register_record_format('json', JsonFormat())
+register_record_format('repr', ReprFormat())
+
+LINE = get_record_format('line')
+
+
+class Records(object):
+  """Items which are written to native streams in format.
+
+  Python commands read the items as they are.
+  """
+
+  def __init__(self, batches, format):
+    self.__batches = batches
+    self.__format = format
+
+  def __iter__(self):
+    return itertools.chain.from_iterable(self.__batches)
+
+  def batches(self):
+    return self.__batches
+
+  def encoded_batches(self):
+    """Yields lists of EncodedRecords."""
+    encode = self.__format.encode
+    for batch in self.__batches:
+      yield [EncodedRecords(encode(batch))]
+
+
+def write_records(batches, out, format=LINE):
+  """Writes lists of items to the file out as records of format.
+
+  Records of many items are joined into a write call. If out is a
+  terminal, each list is written and flushed as soon as it comes instead,
+  so that a slow producer is shown as it goes. Lists of EncodedRecords are
+  written as they are.
+  """
+  encode = format.encode
+  interactive = hasattr(out, 'isatty') and out.isatty()
+  chunks = []
+  size = 0
+  for batch in batches:
+    if batch and type(batch[0]) is EncodedRecords:
+      data = ''.join(batch)
+    else:
+      data = encode(batch)
+    if interactive:
+      out.write(data)
+      out.flush()
+      continue
+    chunks.append(data)
+    size += len(data)
+    if size >= WRITE_BUFFER_SIZE:
+      out.write(''.join(chunks))
+      chunks = []
+      size = 0
+  if chunks:
+    out.write(''.join(chunks))
+  out.flush()
+
+
+def write_items(items, out, format=LINE):
+  """Same as write_records, but for an iterable of items."""
+  write_records(batches(items), out, format)
@@ -0,0 +1,102 @@
+import json
+import os
+import pty
+import select
+import unittest
+
+from pysh.shell import records
+from pysh.shell.records import EncodedRecords
+from pysh.shell.records import get_record_format
+from pysh.shell.records import register_record_format
+from pysh.shell.records import write_items
+from pysh.shell.records import write_records
+
+
+class WriteCounter(object):
+  def __init__(self):
+    self.writes = []
+    self.flushed = False
+
+  def write(self, data):
+    self.writes.append(data)
+
+  def flush(self):
+    self.flushed = True
+
+
+class RecordFormatTest(unittest.TestCase):
+  def testLine(self):
+    self.assertEquals('1\na b\n', get_record_format('line').encode([1, 'a b']))
+    self.assertEquals('', get_record_format('line').encode([]))
+
+  def testNul(self):
+    self.assertEquals('a\nb\0c\0',
+                      get_record_format('nul').encode(['a\nb', 'c']))
+
+  def testJson(self):
+    data = get_record_format('json').encode(['a\nb', {'c': [1]}])
+    self.assertEquals(['a\nb', {'c': [1]}],
+                      map(json.loads, data.splitlines()))
+
+  def testRepr(self):
+    self.assertEquals("'a\\nb'\n1\n",
+                      get_record_format('repr').encode(['a\nb', 1]))
+
+  def testUnknown(self):
+    self.assertRaises(Exception, get_record_format, 'unknown')
+
+  def testRegister(self):
+    class Upper(records.RecordFormat):
+      def encode(self, items):
+        return ''.join([str(e).upper() + '\n' for e in items])
+    register_record_format('records_test_upper', Upper())
+    out = WriteCounter()
+    write_items(['a', 'b'], out, get_record_format('records_test_upper'))
+    self.assertEquals('A\nB\n', ''.join(out.writes))
+
+
+class WriteRecordsTest(unittest.TestCase):
+  def testCoalesce(self):
+    out = WriteCounter()
+    write_records([[1, 2], [3]], out)
+    self.assertEquals(['1\n2\n3\n'], out.writes)
+    self.assertTrue(out.flushed)
+
+  def testLargeOutput(self):
+    out = WriteCounter()
+    item = 'x' * 99
+    write_items([item] * 10000, out)
+    self.assertEquals((item + '\n') * 10000, ''.join(out.writes))
+    self.assertTrue(len(out.writes) < 20)
+
+  def testEncodedRecords(self):
+    out = WriteCounter()
+    write_records([[EncodedRecords('a\0')], [1]], out)
+    self.assertEquals('a\x001\n', ''.join(out.writes))
+
+  def testTerminal(self):
+    master, slave = pty.openpty()
+    out = os.fdopen(slave, 'w')
+    received = []
+    def slow_gen():
+      for i in xrange(3):
+        yield i
+        # The previous line must be shown before the next item is produced.
+        readable, _, _ = select.select([master], [], [], 5.0)
+        self.assertTrue(readable)
+        received.append(os.read(master, 1024))
+    try:
+      write_items(slow_gen(), out)
+    finally:
+      out.close()
+      os.close(master)
+    self.assertEquals(['0\r\n', '1\r\n', '2\r\n'], received)
+
+  def testEmpty(self):
+    out = WriteCounter()
+    write_records([], out)
+    self.assertEquals([], out.writes)
+
+
+if __name__ == '__main__':
+  unittest.main()
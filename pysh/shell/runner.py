@@ -1,11 +1,44 @@
-import pysh.shell.builtin
 import pysh.shell.evaluator
+from pysh.shell.pycmd import declare_pycmds
 
-def run(cmd_str, globals, locals, responses=None, alias_map=None):
-  rc = pysh.shell.evaluator.run(cmd_str, globals, locals, alias_map)
+
+# pycmds registered by pysh.shell.builtin. The module is imported when one
+# of them is used for the first time.
+BUILTIN_PYCMDS = (
+  'cd',
+  'echo',
+  'filter',
+  'fromcsv',
+  'map',
+  'orderby',
+  'pyls',
+  'records',
+  'reduce',
+  'select',
+  'tocsv',
+  'where',
+  )
+declare_pycmds('pysh.shell.builtin', BUILTIN_PYCMDS)
+
+
+def extract_responses(rc, responses):
   if not responses:
     return None
   result = []
   for response in responses:
     result.append(rc[response] if response in rc else None)
   return tuple(result)
+
+
+def run(cmd_str, globals, locals, responses=None, alias_map=None):
+  rc = pysh.shell.evaluator.run(cmd_str, globals, locals, alias_map)
+  return extract_responses(rc, responses)
+
+
+def parse(cmd_str, alias_map=None):
+  return pysh.shell.evaluator.parse(cmd_str, alias_map)
+
+
+def run_ast(ast, globals, locals, responses=None):
+  rc = pysh.shell.evaluator.run_ast(ast, globals, locals)
+  return extract_responses(rc, responses)
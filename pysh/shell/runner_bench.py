@@ -0,0 +1,55 @@
+"""Benchmark of the time to import pysh.shell.runner.
+
+Every converted script imports pysh.shell.runner, so its import time is a
+part of the startup time of all scripts. Each import is measured in a new
+interpreter.
+"""
+
+import os
+import subprocess
+import sys
+
+from pysh.benchlib import report
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+TIMER = ('import sys, time\n'
+         'start = time.time()\n'
+         '%s\n'
+         'sys.stdout.write(repr(time.time() - start))\n')
+
+
+def measure_import(statement, repeat=20):
+  """Returns the best time of statement in a new interpreter."""
+  env = dict(os.environ)
+  path = env.get('PYTHONPATH')
+  env['PYTHONPATH'] = ROOT + (':' + path if path else '')
+  best = None
+  for _ in xrange(repeat):
+    proc = subprocess.Popen([sys.executable, '-c', TIMER % statement],
+                            env=env, stdout=subprocess.PIPE)
+    elapsed = float(proc.communicate()[0])
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def count_modules(statement):
+  code = 'import sys\n%s\nprint len(sys.modules)' % statement
+  proc = subprocess.Popen([sys.executable, '-c', code],
+                          env=dict(os.environ, PYTHONPATH=ROOT),
+                          stdout=subprocess.PIPE)
+  return int(proc.communicate()[0])
+
+
+def main():
+  runner = 'import pysh.shell.runner'
+  builtin = 'import pysh.shell.runner; import pysh.shell.builtin'
+  report('runner', [
+      ('import_runner', measure_import(runner), 's'),
+      ('import_runner_modules', count_modules(runner), 'modules'),
+      ('import_runner_and_builtin', measure_import(builtin), 's'),
+      ])
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,91 @@
+import os
+import subprocess
+import sys
+import unittest
+
+import pysh.shell
+import pysh.shell.pycmd
+import pysh.shell.runner
+from pysh.shell.pycmd import batches
+from pysh.shell.pycmd import get_pycmd
+from pysh.shell.pycmd import PyCmd
+
+# Builtins are imported lazily.
+assert not hasattr(pysh.shell, 'builtin')
+
+
+class RunnerTest(unittest.TestCase):
+  def testLazyBuiltin(self):
+    rc = pysh.shell.runner.run('echo foo => x', globals(), locals(), ['x'])
+    self.assertEquals((['foo'],), rc)
+    self.assertTrue('pysh.shell.builtin' in sys.modules)
+
+  def testDeclaredBuiltinNames(self):
+    import pysh.shell.builtin
+    for name in pysh.shell.runner.BUILTIN_PYCMDS:
+      self.assertTrue(isinstance(get_pycmd(name), PyCmd), name)
+    # All pycmds registered by builtin must be declared.
+    registered = getattr(pysh.shell.pycmd, '__pycmd_map')
+    self.assertEquals(sorted(pysh.shell.runner.BUILTIN_PYCMDS),
+                      sorted(registered.keys()))
+
+  def testUserPyCmdOverridesLazyBuiltin(self):
+    # Runs in a new interpreter because builtin must not be imported yet.
+    script = ('import pysh.shell.runner\n'
+              'from pysh.shell.pycmd import pycmd\n'
+              '@pycmd(name="map")\n'
+              'def user_map(args, input, options):\n'
+              '  return ["user map"]\n'
+              'print pysh.shell.runner.run("echo x | map 1 => a",\n'
+              '                            globals(), locals(), ["a"])\n')
+    root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..')
+    proc = subprocess.Popen([sys.executable, '-c', script], cwd=root,
+                            stdout=subprocess.PIPE)
+    self.assertEquals("(['user map'],)\n", proc.communicate()[0])
+
+  def testJsonIsNotImported(self):
+    # json is imported only when records are written in the json format.
+    script = ('import sys\n'
+              'import pysh.shell.runner\n'
+              'print "json" in sys.modules\n')
+    root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..')
+    proc = subprocess.Popen([sys.executable, '-c', script], cwd=root,
+                            stdout=subprocess.PIPE)
+    self.assertEquals('False\n', proc.communicate()[0])
+
+  def testUnknownName(self):
+    self.assertEquals(None, get_pycmd('pysh_no_such_command'))
+    self.assertEquals(None, get_pycmd(None))
+    self.assertEquals(len, get_pycmd(len))
+
+
+class BatchesTest(unittest.TestCase):
+  def testContainer(self):
+    self.assertEquals([[0, 1], [2, 3], [4]], list(batches(range(5), 2)))
+    self.assertEquals([[0, 1], [2]], list(batches(xrange(3), 2)))
+    self.assertEquals([], list(batches([])))
+
+  def testGeneratorIsNotAccumulated(self):
+    def gen():
+      yield 1
+      raise Exception('The second item must not be read.')
+    self.assertEquals([1], batches(gen()).next())
+
+  def testPerItemProducerToBatchPyCmd(self):
+    events = []
+    def ticker(args, input, options):
+      for i in xrange(3):
+        events.append('produce %d' % i)
+        yield i
+    def sink(args, input, options):
+      for i in input:
+        events.append('consume %d' % i)
+      return []
+    f = lambda x: x
+    pysh.shell.runner.run('$ticker | map $f | $sink', globals(), locals())
+    self.assertEquals(['produce 0', 'consume 0', 'produce 1', 'consume 1',
+                       'produce 2', 'consume 2'], events)
+
+
+if __name__ == '__main__':
+  unittest.main()
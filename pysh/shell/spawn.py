@@ -0,0 +1,130 @@
+"""Starts native commands with posix_spawnp(3).
+
+posix_spawnp doesn't copy the address space of pysh (glibc uses
+clone(CLONE_VM | CLONE_VFORK)), so its cost doesn't grow with the memory
+pysh uses, and it doesn't run Python code in the child, which is unsafe
+after fork while other threads hold locks. The C library is loaded by
+ctypes on the first use to keep the import time of pysh.shell.runner.
+"""
+
+import errno
+import os
+import sys
+
+# Set to False to start commands with fork (e.g. to compare them).
+enabled = True
+
+# pidfd_open(2) on Linux >= 5.3. The number is the same on all architectures
+# but alpha.
+SYS_PIDFD_OPEN = 434
+
+# Large enough for posix_spawn_file_actions_t of C libraries we know
+# (80 bytes on glibc x86_64).
+FILE_ACTIONS_SIZE = 256
+
+
+class Libc(object):
+  """Functions of the C library used to spawn processes."""
+
+  def __init__(self):
+    import ctypes
+    self.ctypes = ctypes
+    lib = ctypes.CDLL(None, use_errno=True)
+    self.posix_spawnp = lib.posix_spawnp
+    self.init = lib.posix_spawn_file_actions_init
+    self.destroy = lib.posix_spawn_file_actions_destroy
+    self.addclose = lib.posix_spawn_file_actions_addclose
+    self.adddup2 = lib.posix_spawn_file_actions_adddup2
+    # glibc >= 2.34
+    self.addclosefrom = getattr(
+      lib, 'posix_spawn_file_actions_addclosefrom_np', None)
+    self.environ = ctypes.POINTER(ctypes.c_char_p).in_dll(lib, 'environ')
+    self.syscall = lib.syscall
+    self.pidfd_supported = sys.platform.startswith('linux')
+
+
+# None: not loaded yet, False: not available.
+libc = None
+
+
+def LoadLibc():
+  global libc
+  if libc is None:
+    try:
+      libc = Libc()
+    except (ImportError, OSError, AttributeError, ValueError):
+      libc = False
+  return libc
+
+
+def available():
+  return enabled and bool(LoadLibc())
+
+
+def CheckError(err):
+  if err != 0:
+    raise OSError(err, os.strerror(err))
+
+
+class FileActions(object):
+  """posix_spawn_file_actions_t. Actions run in the child in order."""
+
+  def __init__(self):
+    lib = LoadLibc()
+    self.__lib = lib
+    self.__actions = lib.ctypes.create_string_buffer(FILE_ACTIONS_SIZE)
+    CheckError(lib.init(self.__actions))
+
+  def close(self, fd):
+    CheckError(self.__lib.addclose(self.__actions, fd))
+
+  def dup2(self, fd, newfd):
+    CheckError(self.__lib.adddup2(self.__actions, fd, newfd))
+
+  def closefrom(self, fd):
+    """Closes all file descriptors >= fd. Returns False if not supported."""
+    if not self.__lib.addclosefrom:
+      return False
+    CheckError(self.__lib.addclosefrom(self.__actions, fd))
+    return True
+
+  def destroy(self):
+    if self.__actions is not None:
+      self.__lib.destroy(self.__actions)
+      self.__actions = None
+
+  def actions(self):
+    return self.__actions
+
+
+def pidfd_open(pid):
+  """Returns a pidfd of the child pid, or None if pidfd is not supported.
+
+  The pidfd becomes readable when the child exits.
+  """
+  lib = LoadLibc()
+  if not lib or not lib.pidfd_supported:
+    return None
+  fd = lib.syscall(SYS_PIDFD_OPEN, pid, 0)
+  if fd >= 0:
+    return fd
+  err = lib.ctypes.get_errno()
+  if err == errno.ENOSYS or err == errno.EPERM:
+    # Old kernels or seccomp.
+    lib.pidfd_supported = False
+    return None
+  raise OSError(err, os.strerror(err))
+
+
+def spawnp(args, actions):
+  """Starts args[0] found in PATH with args and returns its pid.
+
+  OSError is raised if the command can not be started.
+  """
+  lib = LoadLibc()
+  ctypes = lib.ctypes
+  argv = (ctypes.c_char_p * (len(args) + 1))(*args)
+  pid = ctypes.c_int()
+  CheckError(lib.posix_spawnp(ctypes.byref(pid), args[0], actions.actions(),
+                              None, argv, lib.environ))
+  return pid.value
@@ -0,0 +1,43 @@
+"""Benchmark of the latency to run a native command.
+
+Commands are started with posix_spawnp and with fork. The cost of fork grows
+with the memory of pysh, so they are measured again with a large heap.
+"""
+
+from pysh.benchlib import measure
+from pysh.benchlib import report
+from pysh.shell import spawn
+from pysh.shell.evaluator import parse
+from pysh.shell.evaluator import run_ast
+
+
+def measure_commands(results, suffix):
+  ast = parse('true')
+  n = 200
+  def run_commands():
+    for _ in xrange(n):
+      run_ast(ast, {}, {})
+  enabled = spawn.enabled
+  try:
+    for name, value in (('spawn', True), ('fork', False)):
+      spawn.enabled = value
+      elapsed = measure(run_commands, repeat=3)
+      results.append(('%s_true%s' % (name, suffix), elapsed / n, 's'))
+  finally:
+    spawn.enabled = enabled
+
+
+def main():
+  results = []
+  measure_commands(results, '')
+  # Touch every page so that fork needs to copy page tables of them.
+  heap = bytearray(512 * 1024 * 1024)
+  for i in xrange(0, len(heap), 4096):
+    heap[i] = 1
+  measure_commands(results, '_512mb_heap')
+  del heap
+  report('spawn', results)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,118 @@
+import errno
+import os
+import sys
+import unittest
+
+from pysh.shell import spawn
+from pysh.shell.evaluator import run
+
+
+def Spawn(args, setup):
+  """Spawns args with stdout to a pipe and returns (output, exit status)."""
+  r, w = os.pipe()
+  actions = spawn.FileActions()
+  try:
+    actions.dup2(w, 1)
+    actions.close(r)
+    setup(actions)
+    pid = spawn.spawnp(args, actions)
+  finally:
+    actions.destroy()
+    os.close(w)
+  f = os.fdopen(r)
+  out = f.read()
+  f.close()
+  return out, os.waitpid(pid, 0)[1]
+
+
+class SpawnTest(unittest.TestCase):
+  def setUp(self):
+    if not spawn.available():
+      self.skipTest('posix_spawnp is not available.')
+
+  def testSpawn(self):
+    self.assertEquals(('foo bar\n', 0),
+                      Spawn(['echo', 'foo', 'bar'], lambda actions: None))
+
+  def testExitCode(self):
+    out, status = Spawn([sys.executable, '-c', 'import sys; sys.exit(3)'],
+                        lambda actions: None)
+    self.assertEquals(3, os.WEXITSTATUS(status))
+
+  def testDup2(self):
+    # 2>&1
+    self.assertEquals(('err\n', 0), Spawn(
+      [sys.executable, '-c', 'import sys; sys.stderr.write("err\\n")'],
+      lambda actions: actions.dup2(1, 2)))
+
+  def testCloseFrom(self):
+    fd = os.open(os.devnull, os.O_RDONLY)
+    try:
+      check = ('import os\ntry:\n  os.fstat(%d)\n  print "open"\n'
+               'except OSError:\n  print "closed"' % fd)
+      self.assertEquals(('open\n', 0), Spawn([sys.executable, '-c', check],
+                                             lambda actions: None))
+      def closefrom(actions):
+        if not actions.closefrom(3):
+          self.skipTest('closefrom is not supported.')
+      self.assertEquals(('closed\n', 0), Spawn([sys.executable, '-c', check],
+                                               closefrom))
+    finally:
+      os.close(fd)
+
+  def testNotFound(self):
+    actions = spawn.FileActions()
+    try:
+      spawn.spawnp(['pysh-command-not-found'], actions)
+      self.fail('OSError is not raised.')
+    except OSError, e:
+      self.assertEquals(errno.ENOENT, e.errno)
+    finally:
+      actions.destroy()
+
+
+class ForkFallbackTest(unittest.TestCase):
+  """Runs commands with and without posix_spawnp."""
+
+  def setUp(self):
+    self.enabled = spawn.enabled
+    self.fd = os.open(os.devnull, os.O_RDONLY)
+
+  def tearDown(self):
+    spawn.enabled = self.enabled
+    os.close(self.fd)
+
+  def runBoth(self, cmd):
+    results = []
+    for enabled in (True, False):
+      spawn.enabled = enabled
+      results.append(run(cmd, globals(), locals()))
+    self.assertEquals(results[0], results[1])
+    return results[0]
+
+  def testPipeAndRedirect(self):
+    rc = self.runBoth('echo foo | tr a-z A-Z 2>&1 => out')
+    self.assertEquals(['FOO'], rc['out'])
+
+  def testNotFound(self):
+    rc = self.runBoth('pysh-command-not-found 2> /dev/null -> rc')
+    self.assertEquals(1, os.WEXITSTATUS(rc['rc']))
+
+  def testRedirectError(self):
+    rc = self.runBoth('echo a > /pysh/no/such/dir 2> /dev/null -> rc')
+    self.assertEquals(1, os.WEXITSTATUS(rc['rc']))
+
+  def testStrayFdIsClosed(self):
+    spawn.enabled = True
+    if not spawn.available():
+      self.skipTest('posix_spawnp is not available.')
+    check = ('import os\ntry:\n  os.fstat(%d)\n  print "open"\n'
+             'except OSError:\n  print "closed"' % self.fd)
+    python = sys.executable
+    rc = run('$python -c $check => out', globals(), locals())
+    if spawn.libc.addclosefrom:
+      self.assertEquals(['closed'], rc['out'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,6 +1,8 @@
 import StringIO
 import tokenize
 
+from pysh.shell import pycmd
+
 class VarDict(object):
     def __init__(self, locals, row):
         self.__row = row
@@ -55,6 +57,13 @@ class PyshTable(object):
     def rows(self):
         return (Row(self, values) for values in self.__generator)
 
+    def batches(self, size=pycmd.BATCH_SIZE):
+        """Returns an iterator of lists of rows for batch pycmds."""
+        # Batches are made from values, so that tables of lists of values
+        # are read size rows at a time.
+        return ([Row(self, values) for values in batch]
+                for batch in pycmd.batches(self.__generator, size))
+
     def pretty_print(self, writer, sep=' |'):
         # key -> len(key)
         max_width = dict(zip(self.__cols, map(len, self.__cols)))
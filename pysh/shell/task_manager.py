@@ -4,6 +4,12 @@
 import threading
 
 
+# Kinds of entries of Runner's task stack.
+CALL = 0
+DONE = 1
+RESUME = 2
+
+
 class IdentityTask(object):
   def __init__(self, response):
     self.__response = response
@@ -13,22 +19,29 @@ class IdentityTask(object):
 
 
 class Controller(object):
+    __slots__ = ('__runner', '__task', '__state', '__parent', '__children',
+                 '__disposed')
+
     def __init__(self, runner, task, state, parent):
         self.__runner = runner
         self.__task = task
         self.__state = state
         self.__parent = parent
-        self.__children = {}
+        # Most tasks never have running children when they finish, so the
+        # set is created on the first add_child.
+        self.__children = None
         self.__disposed = False
 
     def add_child(self, child):
-        self.__children[id(child)] = child
+        if self.__children is None:
+            self.__children = set()
+        self.__children.add(child)
 
     def remove_child(self, child):
-        del self.__children[id(child)]
+        self.__children.remove(child)
 
     def children(self):
-        return self.__children.values()
+        return self.__children or ()
 
     def task(self):
         return self.__task
@@ -45,18 +58,29 @@ class Controller(object):
     def done(self, response):
         self.__runner.push_done(response, self)
 
+    def resume(self, state, response):
+        """Resumes the task of this controller with state and response.
+
+        Same as call(IdentityTask(response), state) without a child task.
+        """
+        self.__runner.push_resume(state, response, self)
+
     def sync_call(self, task, state):
         self.__runner.sync_push_call(task, state, self)
 
     def sync_done(self, response):
         self.__runner.sync_push_done(response, self)
 
+    def sync_resume(self, state, response):
+        self.__runner.sync_push_resume(state, response, self)
+
     def disposed(self):
         return self.__disposed
 
     def _dispose(self):
-        if hasattr(self.__task, 'dispose'):
-            self.__task.dispose()
+        dispose = getattr(self.__task, 'dispose', None)
+        if dispose:
+            dispose()
         self.__disposed = True
 
 
@@ -64,7 +88,7 @@ class Runner(object):
     def __init__(self, task):
         # tasks is FIFO to run tasks in DFS way.
         # To run tasks in BFS way, use collections.deque.
-        self.__tasks = [('call', task, '<init>', None)]
+        self.__tasks = [(CALL, task, '<init>', None)]
         self.__root_cont = None
         self.response = None
         self.done = False
@@ -80,12 +104,10 @@ class Runner(object):
             self.__sync_tasks = []
             self.__cond.release()
 
-        while self.__tasks:
+        tasks = self.__tasks
+        while tasks:
             self.run_internal()
 
-    def __push_task(self, task):
-        self.__tasks.append(task)
-
     def __sync_push_task(self, task):
         self.__cond.acquire()
         self.__sync_tasks.append(task)
@@ -93,55 +115,74 @@ class Runner(object):
         self.__cond.release()
 
     def push_call(self, task, state, cont):
-        self.__push_task(('call', task, state, cont))
+        self.__tasks.append((CALL, task, state, cont))
 
     def sync_push_call(self, task, state, cont):
-        self.__sync_push_task(('call', task, state, cont))
+        self.__sync_push_task((CALL, task, state, cont))
 
     def push_done(self, response, cont):
-        self.__push_task(('done', response, cont))
+        self.__tasks.append((DONE, response, None, cont))
 
-    def sync_push_done(self, callstack, response):
-        self.__sync_push_task(('done', response, cont))
+    def sync_push_done(self, response, cont):
+        self.__sync_push_task((DONE, response, None, cont))
 
-    def __handle_exception(self):
-        self.__call_dispose_recursively(self.__root_cont)
+    def push_resume(self, state, response, cont):
+        self.__tasks.append((RESUME, response, state, cont))
+
+    def sync_push_resume(self, state, response, cont):
+        self.__sync_push_task((RESUME, response, state, cont))
 
-    def __call_dispose_recursively(self, cont):
-        for child in cont.children():
-            self.__call_dispose_recursively(child)
-        cont._dispose()
+    def __handle_exception(self):
+        self.__dispose(self.__root_cont)
+
+    def __dispose(self, cont):
+        """Disposes cont and its descendants, children before parents."""
+        children = cont.children()
+        if not children:
+            cont._dispose()
+            return
+        # Iterative to dispose deep trees of tasks.
+        order = [cont]
+        stack = list(children)
+        while stack:
+            child = stack.pop()
+            order.append(child)
+            stack.extend(child.children())
+        for cont in reversed(order):
+            cont._dispose()
+
+    def __resume(self, cont, state, response):
+        try:
+            cont.task().resume(cont, state, response)
+        except:
+            self.__handle_exception()
+            raise
 
     def run_internal(self):
-        task = self.__tasks.pop()
-        type = task[0]
-        if type == 'call':
-            _, f, state, cont = task
-            newcont = Controller(self, f, state, cont)
+        kind, value, state, cont = self.__tasks.pop()
+        if kind == CALL:
+            newcont = Controller(self, value, state, cont)
             if cont:
                 cont.add_child(newcont)
             else:
                 self.__root_cont = newcont
             try:
-                f.start(newcont)
+                value.start(newcont)
             except:
                 self.__handle_exception()
                 raise
-        else:
-            # 'done'
-            _, response, cont = task
-            self.__call_dispose_recursively(cont)
+        elif kind == DONE:
+            self.__dispose(cont)
             parentcont = cont.parent()
             if not parentcont:
-                self.response = response
+                self.response = value
                 self.done = True
                 self.__root_cont = None
             else:
                 parentcont.remove_child(cont)
                 if not parentcont.disposed():
-                    try:
-                        parentcont.task().resume(
-                            parentcont, cont.state(), response)
-                    except:
-                        self.__handle_exception()
-                        raise
+                    self.__resume(parentcont, cont.state(), value)
+        else:
+            # RESUME
+            if not cont.disposed():
+                self.__resume(cont, state, value)
@@ -0,0 +1,73 @@
+"""Benchmark of the task scheduler and of scheduling of large commands."""
+
+from pysh.benchlib import measure
+from pysh.benchlib import report
+from pysh.shell.evaluator import parse
+from pysh.shell.evaluator import run_ast
+from pysh.shell.task_manager import IdentityTask
+from pysh.shell.task_manager import Runner
+
+
+class FanOutTask(object):
+  """Calls n IdentityTasks."""
+  def __init__(self, n):
+    self.__n = n
+
+  def start(self, cont):
+    for i in xrange(self.__n):
+      cont.call(IdentityTask(i), i)
+
+  def resume(self, cont, state, response):
+    self.__n -= 1
+    if not self.__n:
+      cont.done(None)
+
+
+class ChainTask(object):
+  """Calls ChainTask(depth - 1) and finishes when it finishes."""
+  def __init__(self, depth):
+    self.__depth = depth
+
+  def start(self, cont):
+    if self.__depth:
+      cont.call(ChainTask(self.__depth - 1), None)
+    else:
+      cont.done(None)
+
+  def resume(self, cont, state, response):
+    cont.done(response)
+
+
+def run_tasks(task):
+  runner = Runner(task)
+  runner.run()
+  assert runner.done
+
+
+def noop(args, input, options):
+  return ()
+
+
+def main():
+  results = []
+  n = 100000
+  elapsed = measure(lambda: run_tasks(FanOutTask(n)), repeat=3)
+  results.append(('fan_out_tasks_per_sec', n / elapsed, 'tasks/s'))
+  elapsed = measure(lambda: run_tasks(ChainTask(n)), repeat=3)
+  results.append(('chain_tasks_per_sec', n / elapsed, 'tasks/s'))
+  # Commands with many arguments run a pycmd so that the time is dominated
+  # by the evaluation and scheduling of arguments rather than by fork.
+  variables = {'noop': noop, 'x': 'x'}
+  for args in (100, 1000):
+    ast = parse('$noop ' + ' '.join('a%d$x' % i for i in xrange(args)) +
+                ' > /dev/null')
+    elapsed = measure(lambda: run_ast(ast, variables, {}))
+    results.append(('pycmd_args_%d' % args, elapsed, 's'))
+  ast = parse(' | '.join(['$noop'] * 100) + ' > /dev/null')
+  elapsed = measure(lambda: run_ast(ast, variables, {}))
+  results.append(('pycmd_pipeline_100', elapsed, 's'))
+  report('task_manager', results)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,104 @@
+import threading
+import unittest
+
+from pysh.shell.task_manager import IdentityTask
+from pysh.shell.task_manager import Runner
+
+
+class SumTask(object):
+  """Calls IdentityTask for each value and returns the sum of them."""
+  def __init__(self, values, log):
+    self.__values = values
+    self.__log = log
+    self.__sum = 0
+    self.__not_ready = len(values)
+
+  def start(self, cont):
+    for i, value in enumerate(self.__values):
+      cont.call(IdentityTask(value), i)
+
+  def resume(self, cont, state, response):
+    self.__log.append((state, response))
+    self.__sum += response
+    self.__not_ready -= 1
+    if not self.__not_ready:
+      cont.done(self.__sum)
+
+
+class NestTask(object):
+  """Calls NestTask(depth - 1) and raises an exception at depth 0."""
+  def __init__(self, depth, disposed):
+    self.__depth = depth
+    self.__disposed = disposed
+
+  def start(self, cont):
+    if not self.__depth:
+      raise Exception('leaf')
+    # Calls a task that never finishes to have more than one child.
+    cont.call(WaitTask(), 'wait')
+    cont.call(NestTask(self.__depth - 1, self.__disposed), 'nest')
+
+  def dispose(self):
+    self.__disposed.append(self.__depth)
+
+
+class WaitTask(object):
+  def start(self, cont):
+    pass
+
+
+class ResumeTask(object):
+  def __init__(self, sync):
+    self.__sync = sync
+
+  def start(self, cont):
+    if self.__sync:
+      th = threading.Thread(target=lambda: cont.sync_resume('sync', 3))
+      th.start()
+      th.join()
+    else:
+      cont.resume('async', 2)
+
+  def resume(self, cont, state, response):
+    cont.done((state, response))
+
+
+class RunnerTest(unittest.TestCase):
+  def testCallAndDone(self):
+    log = []
+    runner = Runner(SumTask([1, 2, 3], log))
+    runner.run()
+    self.assertTrue(runner.done)
+    self.assertEquals(6, runner.response)
+    # Tasks are run in LIFO order.
+    self.assertEquals([(2, 3), (1, 2), (0, 1)], log)
+
+  def testResume(self):
+    runner = Runner(ResumeTask(False))
+    runner.run()
+    self.assertTrue(runner.done)
+    self.assertEquals(('async', 2), runner.response)
+
+  def testSyncResume(self):
+    runner = Runner(ResumeTask(True))
+    runner.run()
+    self.assertFalse(runner.done)
+    runner.run()
+    self.assertTrue(runner.done)
+    self.assertEquals(('sync', 3), runner.response)
+
+  def testDisposeDeepTree(self):
+    # Tasks are disposed without recursion, children before parents.
+    depth = 5000
+    disposed = []
+    runner = Runner(NestTask(depth, disposed))
+    try:
+      runner.run()
+      self.fail('An exception is not raised.')
+    except Exception, e:
+      self.assertEquals('leaf', e.message)
+    self.assertEquals(range(depth + 1), disposed)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,30 +1,58 @@
 from __future__ import absolute_import
 
-import parser
+import collections
 import re
 import tokenize
-import token
-import StringIO
-
-SPACE = 'space'
-SINGLE_QUOTED_STRING = 'single_quoted'
-DOUBLE_QUOTED_STRING = 'double_quoted'
-SUBSTITUTION = 'substitution'
-REDIRECT = 'redirect'
-PIPE = 'pipe'
-RIGHT_ARROW = 'right_arrow'
-BOLD_RIGHT_ARROW = 'bright_arrow'
-LITERAL = 'literal'
-AND_OP = 'andop'
-OR_OP = 'orop'
-PARENTHESIS_START = 'parenthesis_start'
-PARENTHESIS_END = 'parenthesis_end'
-SEMICOLON = 'semicolon'
-BACKQUOTE = 'bquote'
-EOF = 'eof'
-
-SPACE_SENSITIVE = set((SINGLE_QUOTED_STRING, DOUBLE_QUOTED_STRING,
-                       SUBSTITUTION, LITERAL, BACKQUOTE))
+
+from pysh.shell.cache import AliasMapVersions
+from pysh.shell.cache import LRUCache
+
+# Kinds of tokens.
+SPACE = 0
+SINGLE_QUOTED_STRING = 1
+DOUBLE_QUOTED_STRING = 2
+SUBSTITUTION = 3
+REDIRECT = 4
+PIPE = 5
+RIGHT_ARROW = 6
+BOLD_RIGHT_ARROW = 7
+LITERAL = 8
+AND_OP = 9
+OR_OP = 10
+PARENTHESIS_START = 11
+PARENTHESIS_END = 12
+SEMICOLON = 13
+BACKQUOTE = 14
+EOF = 15
+# Not produced by Tokenizer. Its text is the value of (a part of) an argument
+# which was evaluated in advance (See FoldConstants in parser.py).
+CONSTANT = 16
+
+# Names of kinds for messages.
+TOKEN_NAMES = {
+  SPACE: 'space',
+  SINGLE_QUOTED_STRING: 'single_quoted',
+  DOUBLE_QUOTED_STRING: 'double_quoted',
+  SUBSTITUTION: 'substitution',
+  REDIRECT: 'redirect',
+  PIPE: 'pipe',
+  RIGHT_ARROW: 'right_arrow',
+  BOLD_RIGHT_ARROW: 'bright_arrow',
+  LITERAL: 'literal',
+  AND_OP: 'andop',
+  OR_OP: 'orop',
+  PARENTHESIS_START: 'parenthesis_start',
+  PARENTHESIS_END: 'parenthesis_end',
+  SEMICOLON: 'semicolon',
+  BACKQUOTE: 'bquote',
+  EOF: 'eof',
+  CONSTANT: 'constant',
+  }
+
+SPACE_SENSITIVE = frozenset((SINGLE_QUOTED_STRING, DOUBLE_QUOTED_STRING,
+                             SUBSTITUTION, LITERAL, BACKQUOTE))
+LITERAL_LIKE = frozenset((LITERAL, SINGLE_QUOTED_STRING, DOUBLE_QUOTED_STRING,
+                          SUBSTITUTION))
 
 REDIRECT_PATTERN = re.compile(r'(\d*)>(>)?(?:&(\d+))?')
 SPACE_PATTERN = re.compile(r'[ \t]+')
@@ -42,6 +70,185 @@ BACKQUOTE_PATTERN = re.compile(r'`')
 LITERAL_PATTERN = re.compile(r'([0-9A-Za-z\!\#\%\*\+\,\.\/\:'
                              r'\?\@\[\\\]\^\_\{\}\~]'
                              r'|\-(?!>)|\=(?!>))+')
+STRING_START_PATTERN = re.compile(r'[\'"]')
+EXPR_START_PATTERN = re.compile(r'\$\{')
+
+# (name, pattern, token type) in order of precedence. The types of 'string'
+# and 'expr' tokens are determined by their scanners.
+MATCHERS = (
+  ('redirect', REDIRECT_PATTERN, REDIRECT),
+  ('andop', AND_OPERATOR_PATTERN, AND_OP),
+  # should precede PIPE_PATTERN
+  ('orop', OR_OPERATOR_PATTERN, OR_OP),
+  ('pipe', PIPE_PATTERN, PIPE),
+  ('right_arrow', RIGHT_ARROW_PATTERN, RIGHT_ARROW),
+  ('bright_arrow', BOLD_RIGHT_ARROW_PATTERN, BOLD_RIGHT_ARROW),
+  ('parenthesis_start', PARENTHESIS_START_PATTERN, PARENTHESIS_START),
+  ('parenthesis_end', PARENTHESIS_END_PATTERN, PARENTHESIS_END),
+  ('semicolon', SEMICOLON_PATTERN, SEMICOLON),
+  ('bquote', BACKQUOTE_PATTERN, BACKQUOTE),
+  ('string', STRING_START_PATTERN, None),
+  ('variable', VARIABLE_PATTERN, SUBSTITUTION),
+  ('expr', EXPR_START_PATTERN, None),
+  ('dollar', SINGLE_DOLLAR_PATTERN, LITERAL),
+  ('space', SPACE_PATTERN, SPACE),
+  ('literal', LITERAL_PATTERN, LITERAL),
+  )
+# Alternatives are tried from left to right, so the first matcher which
+# matches wins. Please note that group names of MATCHERS are the outermost
+# groups and lastgroup of a match is the matched one.
+MASTER_PATTERN = re.compile('|'.join(
+    '(?P<%s>%s)' % (name, pattern.pattern) for name, pattern, _ in MATCHERS))
+MATCHER_TYPES = dict((name, type) for name, _, type in MATCHERS)
+
+# Python string literals, which are scanned like tokenize module.
+# A literal which ends in the line or a line continued by backslash.
+SINGLE_LINE_STRING_PATTERNS = {
+  '\'': re.compile(r"'[^\n'\\]*(?:\\.[^\n'\\]*)*('|\\\r?\n)"),
+  '"': re.compile(r'"[^\n"\\]*(?:\\.[^\n"\\]*)*("|\\\r?\n)'),
+  }
+# The rest of a literal continued by backslash.
+STRING_END_PATTERNS = {
+  '\'': re.compile(r"[^'\\]*(?:\\.[^'\\]*)*'"),
+  '"': re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"'),
+  }
+# The rest of a triple-quoted literal.
+TRIPLE_QUOTED_END_PATTERNS = {
+  '\'': re.compile(r"[^'\\]*(?:(?:\\[\s\S]|'(?!''))[^'\\]*)*'''"),
+  '"': re.compile(r'[^"\\]*(?:(?:\\[\s\S]|"(?!""))[^"\\]*)*"""'),
+  }
+# Characters in ${expr} which don't affect where expr ends.
+EXPR_CONTENT_PATTERN = re.compile(r'[^\'"#()\[\]{}]*')
+CLOSING_BRACKETS = {'(': ')', '[': ']', '{': '}'}
+
+
+class Token(object):
+  """A token.
+
+  kind is one of the kinds above and text is the string of the token. text
+  of BACKQUOTE token is the parsed command in backquotes instead.
+
+  For compatibility, a token behaves like a tuple (kind, text): it can be
+  unpacked and indexed, and it equals to the tuple.
+  """
+  __slots__ = ('kind', 'text')
+
+  def __init__(self, kind, text):
+    self.kind = kind
+    self.text = text
+
+  def __iter__(self):
+    yield self.kind
+    yield self.text
+
+  def __getitem__(self, index):
+    return (self.kind, self.text)[index]
+
+  def __eq__(self, other):
+    if isinstance(other, Token):
+      return self.kind == other.kind and self.text == other.text
+    elif isinstance(other, tuple):
+      return (self.kind, self.text) == other
+    else:
+      return NotImplemented
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    if result is NotImplemented:
+      return result
+    return not result
+
+  def __hash__(self):
+    return hash((self.kind, self.text))
+
+  def __repr__(self):
+    return '(%s, %r)' % (TOKEN_NAMES.get(self.kind, self.kind), self.text)
+
+
+# Tokens are never modified, so all space tokens can share one.
+SPACE_TOKEN = Token(SPACE, ' ')
+
+
+def scan_string_literal(input, pos):
+  """Returns the end of a Python string literal which starts at input[pos].
+
+  It accepts what tokenize.generate_tokens accepts. It raises
+  tokenize.TokenError if a multi-line literal is not terminated and
+  Exception if the literal is broken.
+  """
+  quote = input[pos]
+  if input.startswith(quote * 3, pos):
+    match = TRIPLE_QUOTED_END_PATTERNS[quote].match(input, pos + 3)
+    if not match:
+      raise tokenize.TokenError('EOF in multi-line string', (1, 0))
+    return match.end()
+
+  match = SINGLE_LINE_STRING_PATTERNS[quote].match(input, pos)
+  if not match:
+    raise Exception('Wrong string format')
+  if match.group(1) == quote:
+    return match.end()
+  # The literal is continued to the next line.
+  end_pattern = STRING_END_PATTERNS[quote]
+  line_start = match.end()
+  while True:
+    if line_start >= len(input):
+      raise tokenize.TokenError('EOF in multi-line string', (1, 0))
+    line_end = input.find('\n', line_start) + 1 or len(input)
+    match = end_pattern.match(input, line_start, line_end)
+    if match:
+      return match.end()
+    if not (input.endswith('\\\n', line_start, line_end) or
+            input.endswith('\\\r\n', line_start, line_end)):
+      raise Exception('Wrong string format')
+    line_start = line_end
+
+
+def find_expr_end(input, pos):
+  """Returns the position of } which ends expr in ${expr}.
+
+  pos is the beginning of expr. expr ends at the first } which does not
+  close a bracket and is not in a string literal or a comment.
+  """
+  brackets = []
+  while True:
+    pos = EXPR_CONTENT_PATTERN.match(input, pos).end()
+    if pos >= len(input):
+      raise Exception('Expected } but EOF found.')
+    c = input[pos]
+    if c == '\'' or c == '"':
+      pos = scan_string_literal(input, pos)
+    elif c == '#':
+      pos = input.find('\n', pos)
+      if pos == -1:
+        raise Exception('Expected } but EOF found.')
+    elif c == '(' or c == '[' or c == '{':
+      brackets.append(c)
+      pos += 1
+    elif c == '}' and not brackets:
+      return pos
+    elif brackets and CLOSING_BRACKETS[brackets[-1]] == c:
+      brackets.pop()
+      pos += 1
+    else:
+      # A mismatched bracket.
+      raise SyntaxError('invalid syntax')
+
+
+def scan_expr(input, pos):
+  """Returns the end of ${expr} which starts at input[pos].
+
+  expr is validated by compile, which raises SyntaxError.
+  """
+  start = pos + 2
+  try:
+    end = find_expr_end(input, start)
+  except Exception:
+    # Report the syntax error in the rest of input if Python finds it.
+    compile(input[start:], '<string>', 'eval')
+    raise
+  compile(input[start:end], '<string>', 'eval')
+  return end + 1
 
 
 class RegexMather(object):
@@ -50,7 +257,7 @@ class RegexMather(object):
     self.__type = type
 
   def consume(self, input):
-    match = self.__pattern.match(input) 
+    match = self.__pattern.match(input)
     if not match:
       return None, None, 0
     string = match.group(0)
@@ -68,12 +275,8 @@ class StringMatcher(object):
       type = SINGLE_QUOTED_STRING
 
     if type is not None:
-      toks = tokenize.generate_tokens(StringIO.StringIO(input).readline)
-      tok = toks.next()
-      if tok[0] == token.STRING:
-        return type, tok[1], len(tok[1])
-      else:
-        raise Exception('Wrong string format')
+      end = scan_string_literal(input, 0)
+      return type, input[:end], end
     else:
       return None, None, 0
 
@@ -82,48 +285,31 @@ class ExprMatcher(object):
   def consume(self, input):
     if not input.startswith('${'):
       return None, None, 0
-    input = input[2:]
-    try:
-      parser.expr(input)
-      raise Exception('Expected } but EOF found.')
-    except SyntaxError, e:
-      if input[e.offset - 1] != '}':
-        raise
-    expr = input[:e.offset - 1]
-    parser.expr(expr)
-    string = '${%s}' % expr
-    return SUBSTITUTION, string, len(string)
+    end = scan_expr(input, 0)
+    return SUBSTITUTION, input[:end], end
+
+ALIAS_CACHE_SIZE = 1024
+# {(alias map version, alias name, global_alias_only, alias history): tokens}
+alias_cache = LRUCache(ALIAS_CACHE_SIZE)
+alias_map_versions = AliasMapVersions()
+
 
 class Tokenizer(object):
   def __init__(self, input,
-               global_alias_only=False, alias_map=None, alias_history=None):
+               global_alias_only=False, alias_map=None, alias_history=None,
+               alias_version=None):
+    """alias_version is alias_map_versions.version(alias_map) if the caller
+    already knows it. Otherwise it is computed when an alias is expanded."""
     self.cur = None
     self.__next = None
     self.__input = input.strip()
+    self.__pos = 0
     self.__global_alias_only = global_alias_only
-    self.__tokens = []
+    self.__tokens = collections.deque()
     self.__alias_map = alias_map
     self.__eof = False
     self.__alias_history = alias_history or set()
-    self.__matchers = [
-      RegexMather(REDIRECT_PATTERN, REDIRECT),
-      RegexMather(AND_OPERATOR_PATTERN, AND_OP),
-      # should precede PIPE_PATTERN
-      RegexMather(OR_OPERATOR_PATTERN, OR_OP),
-      RegexMather(PIPE_PATTERN, PIPE),
-      RegexMather(RIGHT_ARROW_PATTERN, RIGHT_ARROW),
-      RegexMather(BOLD_RIGHT_ARROW_PATTERN, BOLD_RIGHT_ARROW),
-      RegexMather(PARENTHESIS_START_PATTERN, PARENTHESIS_START),
-      RegexMather(PARENTHESIS_END_PATTERN, PARENTHESIS_END),
-      RegexMather(SEMICOLON_PATTERN, SEMICOLON),
-      RegexMather(BACKQUOTE_PATTERN, BACKQUOTE),
-      StringMatcher(),
-      RegexMather(VARIABLE_PATTERN, SUBSTITUTION),
-      ExprMatcher(),
-      RegexMather(SINGLE_DOLLAR_PATTERN, LITERAL),
-      RegexMather(SPACE_PATTERN, SPACE),
-      RegexMather(LITERAL_PATTERN, LITERAL),
-      ]
+    self.__alias_version = alias_version
 
   def __iter__(self):
     return self
@@ -132,20 +318,22 @@ class Tokenizer(object):
     if not self.cur:
       self.cur = self.__get_next()
     else:
-      if self.cur[0] == EOF:
+      if self.cur.kind == EOF:
         raise StopIteration()
       self.cur = self.__next
       self.__next = None
-    if self.cur and self.cur[0] == EOF:
+    if self.cur and self.cur.kind == EOF:
       return self.cur
 
     self.__next = self.__get_next()
     while True:
       # skip space toke if it's unnecessary.
       # Please note that we call break if self.__next is EOF.
-      if self.__next[0] == SPACE and not self.cur[0] in SPACE_SENSITIVE:
+      if (self.__next.kind == SPACE and
+          not self.cur.kind in SPACE_SENSITIVE):
         self.__next = self.__get_next()
-      elif self.cur[0] == SPACE and not self.__next[0] in SPACE_SENSITIVE:
+      elif (self.cur.kind == SPACE and
+            not self.__next.kind in SPACE_SENSITIVE):
         self.cur = self.__next
         self.__next = self.__get_next()
       else:
@@ -154,29 +342,24 @@ class Tokenizer(object):
 
   def __get_next(self):
     if self.__tokens:
-      next = self.__tokens[0]
-      self.__tokens = self.__tokens[1:]
+      next = self.__tokens.popleft()
     else:
       next = self.__next_exalias()
     self.__global_alias_only = True
     return next
 
-  def __is_literal_like(self, tok):
-    return (tok[0] == LITERAL or tok[0] == SINGLE_QUOTED_STRING or
-            tok[0] == DOUBLE_QUOTED_STRING or tok[0] == SUBSTITUTION)
-
   def __next_exalias(self):
     # If tok is literal, try to expand alias.
     tok = self.__next_internal()
-    if tok[0] != LITERAL or (self.cur and self.__is_literal_like(self.cur)):
+    if tok.kind != LITERAL or (self.cur and self.cur.kind in LITERAL_LIKE):
       return tok
 
     next = self.__next_internal()
-    if self.__is_literal_like(next):
+    if next.kind in LITERAL_LIKE:
       self.__tokens.append(next)
       return tok
 
-    expanded = self.__expand_alias(tok[1])
+    expanded = self.__expand_alias(tok)
     if expanded:
       self.__tokens.extend(expanded[1:])
       self.__tokens.append(next)
@@ -184,40 +367,64 @@ class Tokenizer(object):
     else:
       return next
 
-  def __expand_alias(self, text):
+  def __expand_alias(self, tok):
+    text = tok.text
     if (not self.__alias_map or text in self.__alias_history or
         not text in self.__alias_map):
-      return [(LITERAL, text)]
+      return [tok]
 
     alias, is_global = self.__alias_map[text]
     if self.__global_alias_only and not is_global:
-      return [(LITERAL, text)]
+      return [tok]
+    if self.__alias_version is None:
+      self.__alias_version = alias_map_versions.version(self.__alias_map)
+    # The expansion depends on the alias history because aliases in it are
+    # not expanded again.
+    key = (self.__alias_version, text, self.__global_alias_only,
+           frozenset(self.__alias_history))
+    result = alias_cache.get(key)
+    if result is not None:
+      return result
     self.__alias_history.add(text)
     alias_tokenizer = Tokenizer(alias,
                                 global_alias_only=self.__global_alias_only,
                                 alias_map=self.__alias_map,
-                                alias_history=self.__alias_history)
-    # strip eof
-    result = list(alias_tokenizer)[:-1]
+                                alias_history=self.__alias_history,
+                                alias_version=self.__alias_version)
+    # strip eof. Tokens are never modified, so they can be shared.
+    result = tuple(alias_tokenizer)[:-1]
     self.__alias_history.remove(text)
+    alias_cache.put(key, result)
     return result
 
   def __next_internal(self):
     input = self.__input
-    if not input:
+    pos = self.__pos
+    if pos >= len(input):
       if self.__eof:
         raise StopIteration()
       else:
         self.__eof = True
-        return EOF, ''
-
-    for matcher in self.__matchers:
-      token, string, consumed = matcher.consume(input)
-      if token is not None:
-        self.__input = self.__input[consumed:]
-        if token == SPACE:
-          return token, ' '
-        else:
-          return token, string
-
-    raise Exception('Failed to tokenize: ' + self.__input[:100])
+        return Token(EOF, '')
+
+    match = MASTER_PATTERN.match(input, pos)
+    if not match:
+      raise Exception('Failed to tokenize: ' + input[pos:pos + 100])
+    name = match.lastgroup
+    if name == 'space':
+      self.__pos = match.end()
+      return SPACE_TOKEN
+    elif name == 'string':
+      end = scan_string_literal(input, pos)
+      self.__pos = end
+      if input[pos] == '"':
+        return Token(DOUBLE_QUOTED_STRING, input[pos:end])
+      else:
+        return Token(SINGLE_QUOTED_STRING, input[pos:end])
+    elif name == 'expr':
+      end = scan_expr(input, pos)
+      self.__pos = end
+      return Token(SUBSTITUTION, input[pos:end])
+    else:
+      self.__pos = match.end()
+      return Token(MATCHER_TYPES[name], match.group(name))
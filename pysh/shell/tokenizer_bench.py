@@ -0,0 +1,61 @@
+"""Benchmark of Tokenizer on long command lines."""
+
+from pysh.benchlib import measure
+from pysh.benchlib import report
+from pysh.shell.tokenizer import Tokenizer
+from pysh.shell.tokenizer import alias_map_versions
+
+
+def command(args):
+  return 'echo ' + ' '.join('arg%d' % i for i in xrange(args))
+
+
+def quoted_command(args):
+  return 'echo ' + ' '.join('"arg%d" \'x\' $v' % i for i in xrange(args / 3))
+
+
+def substitution_command(args):
+  return 'echo ' + ' '.join('${x[%d] + "}"}' % i for i in xrange(args))
+
+
+def alias_map(size):
+  alias_map = dict(('alias%d' % i, ('cmd%d --opt%d | grep x' % (i, i), False))
+                   for i in xrange(size))
+  alias_map['ll'] = ('ls -l --color=auto', False)
+  alias_map['G'] = ('| grep -i', True)
+  alias_map['L'] = ('| less -R', True)
+  return alias_map
+
+
+def main():
+  results = []
+  for args in (1000, 16000, 64000):
+    cmd = command(args)
+    elapsed = measure(lambda: list(Tokenizer(cmd)), repeat=3)
+    results.append(('literal_args_%d' % args, elapsed, 's'))
+  for args in (1000, 16000):
+    cmd = quoted_command(args)
+    elapsed = measure(lambda: list(Tokenizer(cmd)), repeat=3)
+    results.append(('quoted_args_%d' % args, elapsed, 's'))
+  for args in (100, 1000, 4000):
+    cmd = substitution_command(args)
+    elapsed = measure(lambda: list(Tokenizer(cmd)), repeat=3)
+    results.append(('substitution_args_%d' % args, elapsed, 's'))
+  cmd = 'ls -l | grep foo > /tmp/out.txt && echo done'
+  elapsed = measure(lambda: [list(Tokenizer(cmd)) for _ in xrange(1000)])
+  results.append(('short_command_x1000', elapsed, 's'))
+  # Different commands with aliases like pysh.shell.runner.run tokenizes
+  # them. It computes the version of the alias map once per command.
+  aliases = alias_map(10000)
+  cmds = ['ll /tmp/%d G foo%d L' % (i, i) for i in xrange(1000)]
+  def tokenize_aliases():
+    for cmd in cmds:
+      version = alias_map_versions.version(aliases)
+      list(Tokenizer(cmd, alias_map=aliases, alias_version=version))
+  elapsed = measure(tokenize_aliases)
+  results.append(('alias_commands_1000', elapsed, 's'))
+  report('tokenizer', results)
+
+
+if __name__ == '__main__':
+  main()
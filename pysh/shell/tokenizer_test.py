@@ -18,6 +18,8 @@ from pysh.shell.tokenizer import (
   EOF,
 )
 
+from pysh.shell.tokenizer import Token
+from pysh.shell.tokenizer import alias_cache
 from pysh.shell.tokenizer import Tokenizer
 from pysh.shell.tokenizer import RegexMather
 
@@ -45,6 +47,29 @@ class RegexMatherTest(unittest.TestCase):
     self.assertTrue(type is None)
 
 
+class TokenTest(unittest.TestCase):
+  def test(self):
+    tok = Token(LITERAL, 'cat')
+    self.assertEquals(LITERAL, tok.kind)
+    self.assertEquals('cat', tok.text)
+    kind, text = tok
+    self.assertEquals((LITERAL, 'cat'), (kind, text))
+    self.assertEquals(LITERAL, tok[0])
+    self.assertEquals('cat', tok[1])
+
+  def testEquality(self):
+    tok = Token(LITERAL, 'cat')
+    self.assertTrue(tok == (LITERAL, 'cat'))
+    self.assertTrue(tok == Token(LITERAL, 'cat'))
+    self.assertFalse(tok != Token(LITERAL, 'cat'))
+    self.assertTrue(tok != Token(SINGLE_QUOTED_STRING, 'cat'))
+    self.assertTrue(tok != (LITERAL, 'dog'))
+    self.assertEquals(hash((LITERAL, 'cat')), hash(tok))
+
+  def testNoDict(self):
+    self.assertFalse(hasattr(Token(LITERAL, 'cat'), '__dict__'))
+
+
 class TokenizerTest(unittest.TestCase):
   def test0(self):
     tok = Tokenizer('cat /tmp/www/foo.txt')
@@ -139,6 +164,25 @@ class TokenizerTest(unittest.TestCase):
                        (EOF, ''),
                        ], list(tok))
 
+  def testExpressionWithBracesInString(self):
+    tok = Tokenizer('echo ${"}" + \'{\' + x[0]}${(1, 2)}')
+    self.assertEquals([(LITERAL, 'echo'),
+                       (SPACE, ' '),
+                       (SUBSTITUTION, '${"}" + \'{\' + x[0]}'),
+                       (SUBSTITUTION, '${(1, 2)}'),
+                       (EOF, ''),
+                       ], list(tok))
+
+  def testExpressionError(self):
+    self.assertRaises(SyntaxError, list, Tokenizer('echo ${a b}'))
+    self.assertRaises(SyntaxError, list, Tokenizer('echo ${(a}'))
+    self.assertRaises(SyntaxError, list, Tokenizer('echo ${"a}'))
+    try:
+      list(Tokenizer('echo ${a'))
+      self.fail()
+    except Exception, e:
+      self.assertEquals('Expected } but EOF found.', str(e))
+
   def testSubstitutionUnderscore(self):
     tok = Tokenizer('echo $__init__')
     self.assertEquals([(LITERAL, 'echo'),
@@ -382,5 +426,57 @@ class AliasTest(unittest.TestCase):
                        ], list(tok))
 
 
+
+class AliasCacheTest(unittest.TestCase):
+  def testCached(self):
+    alias_map = {'ls': ('ls -la', False),
+                 'sl': ('ls', True)}
+    expected = [(LITERAL, 'ls'),
+                (SPACE, ' '),
+                (LITERAL, '-la'),
+                (SPACE, ' '),
+                (LITERAL, 'foo'),
+                (EOF, ''),
+                ]
+    self.assertEquals(expected,
+                      list(Tokenizer('sl foo', alias_map=alias_map)))
+    hits = alias_cache.stats()['hits']
+    self.assertEquals(expected,
+                      list(Tokenizer('sl foo', alias_map=alias_map)))
+    self.assertEquals(hits + 1, alias_cache.stats()['hits'])
+
+  def testModified(self):
+    alias_map = {'ls': ('ls -la', False)}
+    self.assertEquals([(LITERAL, 'ls'), (SPACE, ' '), (LITERAL, '-la'),
+                       (EOF, '')],
+                      list(Tokenizer('ls', alias_map=alias_map)))
+    alias_map['ls'] = ('ls -l', False)
+    self.assertEquals([(LITERAL, 'ls'), (SPACE, ' '), (LITERAL, '-l'),
+                       (EOF, '')],
+                      list(Tokenizer('ls', alias_map=alias_map)))
+
+  def testNestedModified(self):
+    alias_map = {'ls': ('ls -la', False),
+                 'sl': ('ls', True)}
+    list(Tokenizer('sl', alias_map=alias_map))
+    alias_map['ls'] = ('ls -l', False)
+    self.assertEquals([(LITERAL, 'ls'), (SPACE, ' '), (LITERAL, '-l'),
+                       (EOF, '')],
+                      list(Tokenizer('sl', alias_map=alias_map)))
+
+  def testHistory(self):
+    # The expansion of b differs in a and at the top level.
+    alias_map = {'a': ('b', False),
+                 'b': ('a x', False)}
+    self.assertEquals([(LITERAL, 'a'), (SPACE, ' '), (LITERAL, 'x'),
+                       (EOF, '')],
+                      list(Tokenizer('a', alias_map=alias_map)))
+    self.assertEquals([(LITERAL, 'b'), (SPACE, ' '), (LITERAL, 'x'),
+                       (EOF, '')],
+                      list(Tokenizer('b', alias_map=alias_map)))
+    self.assertEquals([(LITERAL, 'a'), (SPACE, ' '), (LITERAL, 'x'),
+                       (EOF, '')],
+                      list(Tokenizer('a', alias_map=alias_map)))
+
 if __name__ == '__main__':
   unittest.main()